@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import fcntl
+import netCDF4
+import numpy as np
+from general.functions import NETCDF_LOCK
+
+RESOLUTIONS = {"hourly": 3600, "daily": 86400, "weekly": 7 * 86400}  # [s]
+WEEK_ORIGIN = 4 * 86400  # 1970-01-05, weeks start on Monday
+STATISTICS = ["mean", "min", "max", "count"]
+UNKNOWN_SOURCE = -1  # Bins aggregated before the sources were recorded
+SHARED_SOURCE = -2  # Bins with data of several sources, see AggregatePyramid.read_shared
+
+
+class AggregatePyramid:
+    """
+    Hourly, daily and weekly aggregates (NaN-aware mean, min, max and count) of Level2 variables, for quick-look
+    sections over several years. Each resolution is a NetCDF file {title}_{resolution}.nc with dimensions time (start
+    of the bins) and depth (fixed grid of depth_resolution).
+
+    The hourly bins are updated from the data of each processed file (source): the contribution of the source to the
+    bins is replaced (e.g. reprocessed files, growing files). The hourly file stores the source of each bin, and the
+    contribution of each source to the bins shared by several sources (first and last hours of the files) is kept in
+    {title}_hourly_shared.npz, so that a source can be replaced without the data of the others. The daily and weekly
+    bins containing updated hourly bins are then recomputed from the hourly bins.
+
+    Parameters:
+        folder (str): folder of the aggregate files
+        title (str): prefix of the aggregate files
+        variables (list): variables to aggregate, with (depth, time) dimensions
+        depth_resolution (float): resolution of the depth grid [m]
+        log (logger): logger
+    """
+    def __init__(self, folder, title, variables=("u", "v", "w", "vel_mag", "Sv"), depth_resolution=1., log=False):
+        self.folder = folder
+        self.title = title
+        self.variables = variables
+        self.depth_resolution = depth_resolution
+        self.log = log
+
+    def file(self, resolution):
+        return os.path.join(self.folder, "{}_{}.nc".format(self.title, resolution))
+
+    def update(self, data, attributes, source=None, since=None, time_label="time", depth_label="depth"):
+        """
+        Update the aggregates with the data of a file.
+
+        Parameters:
+            data (dict): time (n_time), depth (n_depth) and variables (n_depth*n_time)
+            attributes (dict): units and long_name of each variable (e.g. ADCP.variables)
+            source (str): file of the data, its previous contribution to the updated bins is replaced
+            since (float): only the bins from the bin of since are updated, the data must contain all the samples of
+                           the source in these bins (e.g. incremental runs)
+        Returns:
+            files (list): updated aggregate files
+        """
+        return self.update_statistics(self.statistics(data, since, time_label, depth_label), attributes, source)
+
+    def statistics(self, data, since=None, time_label="time", depth_label="depth"):
+        """
+        Hourly statistics of data, which can be merged with merge_statistics (e.g. blocks of a file) before
+        update_statistics.
+
+        Returns:
+            statistics (dict): bins, stats (mean, min, max and count of each variable), time_min and time_max, =False
+                               without data
+        """
+        variables = [v for v in self.variables if v in data]
+        time = np.asarray(data[time_label], dtype=float)
+        rows = np.round(np.asarray(data[depth_label], dtype=float) / self.depth_resolution).astype(int)
+        valid = ~np.isnan(time)
+        if since is not None:
+            valid &= time >= bin_start(since, RESOLUTIONS["hourly"])
+        if not np.any(valid) or len(variables) == 0:
+            return False
+        bins = bin_start(time[valid], RESOLUTIONS["hourly"])
+        unique = np.unique(bins)
+        columns = np.searchsorted(unique, bins)
+        shape = (rows.max() + 1, len(unique))
+        statistics = {"bins": unique,
+                      "stats": {v: aggregate(np.asarray(data[v], dtype=float)[:, valid], rows, columns, shape) for v in variables},
+                      "time_min": np.full(len(unique), np.nan),
+                      "time_max": np.full(len(unique), np.nan)}
+        np.fmin.at(statistics["time_min"], columns, time[valid])
+        np.fmax.at(statistics["time_max"], columns, time[valid])
+        return statistics
+
+    def update_statistics(self, statistics, attributes, source=None):
+        """
+        Update the aggregates with the hourly statistics of a source file, see update.
+        """
+        if not statistics:
+            return []
+        variables = list(statistics["stats"])
+        new_bins = statistics["bins"]
+        if self.log:
+            self.log.info("Updating {} aggregates of {}.".format(", ".join(RESOLUTIONS), ", ".join(variables)), indent=2)
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, ".lock"), "w") as lock, NETCDF_LOCK:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            depths = max(s[0].shape[0] for s in statistics["stats"].values())
+            with self.open("hourly", variables, attributes, depths) as nc:
+                depths = len(nc.dimensions["depth"])
+                sources = json.loads(nc.sources)
+                if source not in sources:
+                    sources.append(source)
+                    nc.sources = json.dumps(sources)
+                owner = sources.index(source)
+                stats = {v: [pad(s, depths, i) for i, s in enumerate(statistics["stats"][v])] for v in variables}
+                time_min, time_max = statistics["time_min"].copy(), statistics["time_max"].copy()
+                owners = np.full(len(new_bins), owner)
+
+                # Bins of other sources are shared, the contribution of each source is kept to be replaced separately
+                stored_bins = nc.variables["time"][:].filled(np.nan)
+                exists = np.where(np.isin(new_bins, stored_bins))[0]
+                index = np.searchsorted(stored_bins, new_bins[exists])
+                stored_owners = np.ma.filled(nc.variables["source"][index], UNKNOWN_SOURCE) if len(index) else []
+                others = [j for j, o in enumerate(stored_owners) if o != owner]
+                if others:
+                    shared = self.read_shared(variables, depths)
+                    stored = self.read(nc, variables, index[others])
+                    for k, j in enumerate(others):
+                        b = new_bins[exists[j]]
+                        if stored_owners[j] != SHARED_SOURCE:
+                            shared[(b, int(stored_owners[j]))] = contribution(stored, variables, k)
+                        shared[(b, owner)] = contribution({"time_min": time_min, "time_max": time_max, **stats}, variables, exists[j])
+                        parts = [c for key, c in shared.items() if key[0] == b]
+                        for v in variables:
+                            combined = parts[0][v]
+                            for c in parts[1:]:
+                                combined = combine(combined, c[v], depths)
+                            for s, c in zip(stats[v], combined):
+                                s[:, exists[j]] = c
+                        time_min[exists[j]] = np.nanmin([c["time_min"] for c in parts])
+                        time_max[exists[j]] = np.nanmax([c["time_max"] for c in parts])
+                        owners[exists[j]] = SHARED_SOURCE
+                    self.write_shared(shared, variables)
+                self.write(nc, variables, new_bins, stats, time_min, time_max, owners)
+                hourly = new_bins
+
+            for resolution in ["daily", "weekly"]:
+                coarse = np.unique(bin_start(hourly, RESOLUTIONS[resolution]))
+                with netCDF4.Dataset(self.file("hourly"), "r") as nc:
+                    fine = nc.variables["time"][:].filled(np.nan)
+                    start = np.searchsorted(fine, coarse[0])
+                    end = np.searchsorted(fine, coarse[-1] + RESOLUTIONS[resolution])
+                    stored = self.read(nc, variables, slice(start, end))
+                    depths = len(nc.dimensions["depth"])
+                # Only the hourly bins of the updated coarse bins, which are not necessarily contiguous
+                fine_bins = bin_start(fine[start:end], RESOLUTIONS[resolution])
+                updated = np.isin(fine_bins, coarse)
+                columns = np.searchsorted(coarse, fine_bins[updated])
+                stats = {}
+                for v in variables:
+                    mean, vmin, vmax, count = [s[:, updated] for s in stored[v]]
+                    weights = np.where(count > 0, count, 0).astype(float)
+                    total = np.zeros((depths, len(coarse)))
+                    sums = np.zeros((depths, len(coarse)))
+                    vmin_out = np.full((depths, len(coarse)), np.nan)
+                    vmax_out = np.full((depths, len(coarse)), np.nan)
+                    for j, c in enumerate(columns):
+                        total[:, c] += weights[:, j]
+                        sums[:, c] += np.where(weights[:, j] > 0, mean[:, j] * weights[:, j], 0.)
+                        vmin_out[:, c] = np.fmin(vmin_out[:, c], vmin[:, j])
+                        vmax_out[:, c] = np.fmax(vmax_out[:, c], vmax[:, j])
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        stats[v] = [np.where(total > 0, sums / total, np.nan), vmin_out, vmax_out, total]
+                time_min = np.full(len(coarse), np.nan)
+                time_max = np.full(len(coarse), np.nan)
+                np.fmin.at(time_min, columns, stored["time_min"][updated])
+                np.fmax.at(time_max, columns, stored["time_max"][updated])
+                with self.open(resolution, variables, attributes, depths) as nc:
+                    self.write(nc, variables, coarse, stats, time_min, time_max)
+        return [self.file(resolution) for resolution in RESOLUTIONS]
+
+    def open(self, resolution, variables, attributes, depths):
+        """
+        Open the aggregate file of a resolution, created if it does not exist, with a depth grid of at least depths
+        values.
+        """
+        file = self.file(resolution)
+        if not os.path.isfile(file):
+            with netCDF4.Dataset(file, mode="w", format="NETCDF4") as nc:
+                nc.title = "{} aggregates of {}".format(resolution, self.title)
+                nc.createDimension("time", None)
+                nc.createDimension("depth", None)
+                var = nc.createVariable("time", np.float64, ("time",), fill_value=np.nan)
+                var.units = "seconds since 1970-01-01 00:00:00"
+                var.long_name = "start of the {} bins".format(resolution)
+                for name in ["time_min", "time_max"]:
+                    var = nc.createVariable(name, np.float64, ("time",), fill_value=np.nan)
+                    var.units = "seconds since 1970-01-01 00:00:00"
+                    var.long_name = "{} time of the data in the bins".format(name.split("_")[1])
+                var = nc.createVariable("depth", np.float32, ("depth",), fill_value=np.nan)
+                var.units = "m"
+                var.long_name = "nominal depth"
+        nc = netCDF4.Dataset(file, mode="a")
+        if resolution == "hourly" and "source" not in nc.variables:
+            var = nc.createVariable("source", np.int32, ("time",), fill_value=UNKNOWN_SOURCE)
+            var.long_name = "index of the source file of the bins in sources, {} for several sources".format(SHARED_SOURCE)
+            nc.sources = json.dumps([])
+        for v in variables:
+            if v + "_mean" not in nc.variables:
+                for statistic in STATISTICS:
+                    name = "{}_{}".format(v, statistic)
+                    if statistic == "count":
+                        var = nc.createVariable(name, np.uint32, ("depth", "time"), fill_value=0, zlib=True, complevel=4, chunksizes=(256, 64))
+                        var.units = "-"
+                    else:
+                        var = nc.createVariable(name, np.float32, ("depth", "time"), fill_value=np.nan, zlib=True, complevel=4, chunksizes=(256, 64))
+                        var.units = attributes[v]["unit"] if v in attributes else "-"
+                    long_name = attributes[v]["long_name"] if v in attributes else v
+                    var.long_name = "{} {} of {}".format(resolution, statistic, long_name)
+        if len(nc.dimensions["depth"]) < depths:
+            nc.variables["depth"][:] = np.arange(depths) * self.depth_resolution
+        return nc
+
+    def read(self, nc, variables, index):
+        stored = {v: [np.ma.filled(nc.variables["{}_{}".format(v, s)][:, index].astype(float), np.nan)
+                      for s in STATISTICS] for v in variables}
+        for v in variables:
+            stored[v][3] = np.nan_to_num(stored[v][3])
+        stored["time_min"] = np.ma.filled(nc.variables["time_min"][index], np.nan)
+        stored["time_max"] = np.ma.filled(nc.variables["time_max"][index], np.nan)
+        return stored
+
+    def write(self, nc, variables, bins, stats, time_min, time_max, owners=None):
+        """
+        Write bins (sorted) to an aggregate file. Existing bins are overwritten, new bins after the last bin are
+        appended and the bins after the first new bin are rewritten otherwise. owners are the sources of the hourly
+        bins.
+        """
+        stored_bins = nc.variables["time"][:].filled(np.nan)
+        exists = np.isin(bins, stored_bins)
+        depths = len(nc.dimensions["depth"])
+        series = {"time": bins, "time_min": time_min, "time_max": time_max}
+        if owners is not None:
+            series["source"] = owners
+        if np.any(exists):
+            index = np.searchsorted(stored_bins, bins[exists])
+            for key, values in series.items():
+                nc.variables[key][index] = values[exists]
+            for v in variables:
+                for s, values in zip(STATISTICS, stats[v]):
+                    nc.variables["{}_{}".format(v, s)][:, index] = values[:depths, exists]
+        new = ~exists
+        if np.any(new):
+            n = len(stored_bins)  # The time dimension grows with the first variable written
+            start = np.searchsorted(stored_bins, bins[new][0])
+            order = np.argsort(np.append(stored_bins[start:], bins[new]))
+            for key, values in series.items():
+                fill = UNKNOWN_SOURCE if key == "source" else np.nan
+                nc.variables[key][start:] = np.append(np.ma.filled(nc.variables[key][start:n], fill), values[new])[order]
+            for v in variables:
+                for s, values in zip(STATISTICS, stats[v]):
+                    var = nc.variables["{}_{}".format(v, s)]
+                    tail = np.ma.filled(var[:, start:n].astype(float), 0 if s == "count" else np.nan)
+                    var[:, start:] = np.concatenate((tail, values[:depths, new]), axis=1)[:, order]
+
+    def read_shared(self, variables, depths):
+        """
+        Contributions of the sources to the shared hourly bins.
+
+        Returns:
+            shared (dict): {(bin, source index): {variable: [mean, min, max, count] (n_depth), time_min, time_max}}
+        """
+        shared = {}
+        file = os.path.join(self.folder, "{}_hourly_shared.npz".format(self.title))
+        if not os.path.isfile(file):
+            return shared
+        with np.load(file) as f:
+            stored = {key: f[key] for key in f.files}
+        for j, (b, source) in enumerate(zip(stored["bins"], stored["sources"])):
+            part = {"time_min": stored["time_min"][j], "time_max": stored["time_max"][j]}
+            for v in variables:
+                part[v] = [pad(stored["{}_{}".format(v, s)][:, j], depths, i) if "{}_{}".format(v, s) in stored
+                           else np.full(depths, 0. if i == 3 else np.nan) for i, s in enumerate(STATISTICS)]
+            shared[(float(b), int(source))] = part
+        return shared
+
+    def write_shared(self, shared, variables):
+        file = os.path.join(self.folder, "{}_hourly_shared.npz".format(self.title))
+        keys = sorted(shared)
+        arrays = {"bins": np.array([k[0] for k in keys], dtype=float), "sources": np.array([k[1] for k in keys], dtype=int),
+                  "time_min": np.array([shared[k]["time_min"] for k in keys], dtype=float),
+                  "time_max": np.array([shared[k]["time_max"] for k in keys], dtype=float)}
+        depths = max(len(shared[k][v][0]) for k in keys for v in variables)
+        for v in variables:
+            for i, s in enumerate(STATISTICS):
+                arrays["{}_{}".format(v, s)] = np.stack([pad(shared[k][v][i], depths, i) for k in keys], axis=1)
+        with open(file + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(file + ".tmp", file)
+
+
+def bin_start(time, resolution):
+    origin = WEEK_ORIGIN if resolution == RESOLUTIONS["weekly"] else 0
+    return np.floor((np.asarray(time, dtype=float) - origin) / resolution) * resolution + origin
+
+
+def aggregate(values, rows, columns, shape):
+    """
+    NaN-aware mean, min, max and count of values (n_depth*n_time) in the bins (rows, columns) of a grid of shape.
+    """
+    index = (rows[:, None] * shape[1] + columns[None, :]).ravel()
+    values = values.ravel()
+    finite = ~np.isnan(values)
+    index, values = index[finite], values[finite]
+    count = np.bincount(index, minlength=shape[0] * shape[1]).reshape(shape).astype(float)
+    total = np.bincount(index, weights=values, minlength=shape[0] * shape[1]).reshape(shape)
+    vmin = np.full(shape[0] * shape[1], np.nan)
+    vmax = np.full(shape[0] * shape[1], np.nan)
+    np.fmin.at(vmin, index, values)
+    np.fmax.at(vmax, index, values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, total / count, np.nan)
+    return [mean, vmin.reshape(shape), vmax.reshape(shape), count]
+
+
+def combine(a, b, depths):
+    """
+    Combine two sets of aggregates [mean, min, max, count] of the same bins.
+    """
+    b = [pad(s, depths, i) for i, s in enumerate(b)]
+    count = a[3] + b[3]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, (np.nan_to_num(a[0]) * a[3] + np.nan_to_num(b[0]) * b[3]) / count, np.nan)
+    return [mean, np.fmin(a[1], b[1]), np.fmax(a[2], b[2]), count]
+
+
+def pad(values, depths, statistic):
+    # Values of a statistic (index in STATISTICS) padded to depths rows, NaN or count 0
+    return np.pad(values, [(0, depths - values.shape[0])] + [(0, 0)] * (values.ndim - 1),
+                  constant_values=np.nan if statistic < 3 else 0)
+
+
+def contribution(stored, variables, column):
+    # Statistics of a bin (column) of stored, see AggregatePyramid.read_shared
+    part = {"time_min": float(stored["time_min"][column]), "time_max": float(stored["time_max"][column])}
+    for v in variables:
+        part[v] = [s[:, column].copy() for s in stored[v]]
+    return part
+
+
+def merge_statistics(a, b):
+    """
+    Merge the hourly statistics of two parts of a source (see AggregatePyramid.statistics), e.g. blocks of a file.
+    """
+    if not a or not b:
+        return a or b
+    bins = np.union1d(a["bins"], b["bins"])
+    depths = max(s[0].shape[0] for part in (a, b) for s in part["stats"].values())
+    merged = {"bins": bins, "stats": {}, "time_min": np.full(len(bins), np.nan), "time_max": np.full(len(bins), np.nan)}
+    for part in (a, b):
+        columns = np.searchsorted(bins, part["bins"])
+        for v, stats in part["stats"].items():
+            if v not in merged["stats"]:
+                merged["stats"][v] = [np.full((depths, len(bins)), 0. if i == 3 else np.nan) for i in range(len(STATISTICS))]
+            current = [s[:, columns] for s in merged["stats"][v]]
+            for s, c in zip(merged["stats"][v], combine(current, stats, depths)):
+                s[:, columns] = c
+        merged["time_min"][columns] = np.fmin(merged["time_min"][columns], part["time_min"])
+        merged["time_max"][columns] = np.fmax(merged["time_max"][columns], part["time_max"])
+    return merged
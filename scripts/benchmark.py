@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from time import perf_counter
+from datetime import datetime, timezone
+from instruments import ADCP
+from general.functions import logger
+from functions import absolute_backscatter, moving_average_filter, perform_rotate_velocity
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Instrument settings of the synthetic datasets, close to the LéXPLORE deployments (see notes/parameters.json). The
+# transducer depths are chosen so that the profiles of all the SIZES reach the side lobe range of the surface (600 kHz,
+# up) or of the bottom (300 kHz, down) tested by the interface test of quality_checks_adcp.qa_adcp_bitmask.
+SETTINGS = {
+    "600": {"bin_size": 0.25, "blank_dist": 0.88, "transmit_pulse_m": 0.43, "beam_angle": 20., "freq": 600,
+            "transducer_depth": 10., "bottom_depth": 100., "up": True},
+    "300": {"bin_size": 1., "blank_dist": 1.76, "transmit_pulse_m": 1.1, "beam_angle": 20., "freq": 300,
+            "transducer_depth": 50., "bottom_depth": 100., "up": False},
+}
+SIZES = {"week": (50, 7), "month": (100, 31), "year": (200, 365)}  # Number of bins, number of days
+ENSEMBLE_INTERVAL = 600  # [s]
+
+
+class SyntheticLevel0:
+    """
+    Source of parsed Level0 data for ADCP.read_data with the interface of cache.Level0Cache, so that the synthetic
+    datasets go through the same code as the cached Level0 files.
+    """
+    def __init__(self, raw, attrs):
+        self.raw = raw
+        self.attrs = attrs
+
+    def load(self, file):
+        return self.raw, self.attrs
+
+    def store(self, file, raw, attrs):
+        pass
+
+
+def synthetic_level0(frequency, bins, days, seed=0):
+    """
+    Synthetic RDI Workhorse data in the format of ADCP.parse_level0: tidal-like velocities with noise and missing
+    values, correlation and echo decreasing with range, and a tilted instrument with a varying temperature.
+
+    Parameters:
+        frequency (str): "300" or "600", instrument settings of SETTINGS
+        bins (int): number of depth bins
+        days (int): duration of the deployment [days]
+    Returns:
+        raw (dict of np.arrays): parsed data, see ADCP.parse_level0
+        attrs (dict): instrument attributes
+    """
+    settings = SETTINGS[frequency]
+    rng = np.random.default_rng(seed)
+    n = int(days * 86400 / ENSEMBLE_INTERVAL)
+    time = np.datetime64("2024-01-01T00:00:00", "s") + np.arange(n) * np.timedelta64(ENSEMBLE_INTERVAL, "s")
+    seconds = np.arange(n) * ENSEMBLE_INTERVAL
+    distance = settings["blank_dist"] + settings["bin_size"] * (np.arange(bins) + 1)
+    decay = np.exp(-distance / distance[-1])[:, None]
+
+    vel = np.empty((4, bins, n))
+    phase = 2 * np.pi * seconds / 44712.
+    vel[0] = 0.05 * np.sin(phase)[None, :] * decay + rng.normal(0, 0.02, (bins, n))
+    vel[1] = 0.03 * np.cos(phase)[None, :] * decay + rng.normal(0, 0.02, (bins, n))
+    vel[2] = rng.normal(0, 0.005, (bins, n))
+    vel[3] = rng.normal(0, 0.02, (bins, n))
+    vel[:, rng.random((bins, n)) < 0.02] = np.nan
+
+    corr = np.clip(140 * decay[None] + rng.normal(0, 8, (4, bins, n)), 0, 255).astype(np.uint8)
+    amp = np.clip(40 + 120 * decay[None] + rng.normal(0, 4, (4, bins, n)), 0, 255).astype(np.uint8)
+    prcnt_gd = np.clip(100 - 20 * (1 - decay[None]) - rng.exponential(3, (4, bins, n)), 0, 100).astype(np.uint8)
+    raw = {"time": time, "range": distance, "vel": vel, "corr": corr, "amp": amp, "prcnt_gd": prcnt_gd,
+           "heading": np.mod(180 + rng.normal(0, 5, n).cumsum() * 0.1, 360),
+           "roll": rng.normal(1, 0.5, n), "pitch": rng.normal(-1, 0.5, n),
+           "temp": 12 + 6 * np.sin(2 * np.pi * seconds / (365 * 86400.)) + rng.normal(0, 0.1, n)}
+    attrs = {"transmit_pulse_m": settings["transmit_pulse_m"], "beam_angle": settings["beam_angle"],
+             "blank_dist": settings["blank_dist"], "freq": settings["freq"], "bandwidth": 0}
+    return raw, attrs
+
+
+def timed(timings, step, function, *args, **kwargs):
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    timings[step] = perf_counter() - start
+    return result
+
+
+def benchmark_case(frequency, size, repeat=3):
+    """
+    Time the processing steps of main.process_file on a synthetic dataset: read_data, quality_flags, the Level1
+    export, mask_data, derive_variables and the Level2 export, then absolute_backscatter, moving_average_filter and
+    perform_rotate_velocity on their own.
+
+    Returns:
+        results (dict): minimum time of each step over the repetitions [s]
+        cells (int): number of depth x time cells after read_data
+    """
+    settings = SETTINGS[frequency]
+    bins, days = SIZES[size]
+    source = SyntheticLevel0(*synthetic_level0(frequency, bins, days))
+    file = "synthetic_{}_{}.LTA".format(frequency, size)
+    import envass  # Imported by quality_flags on first use, not part of the timings
+    results = {}
+    cells = 0
+    for i in range(repeat):
+        timings = {}
+        folder = tempfile.mkdtemp()
+        try:
+            sensor = ADCP(log=logger(buffered=True))
+            if not timed(timings, "read_data", sensor.read_data, file, transducer_depth=settings["transducer_depth"],
+                         bottom_depth=settings["bottom_depth"], cabled=True, up=settings["up"], cache=source):
+                raise ValueError("Failed to read the synthetic dataset {}".format(file))
+            cells = int(np.size(sensor.data["depth"]) * np.size(sensor.data["time"]))
+            timed(timings, "quality_flags", sensor.quality_flags, envass_file=os.path.join(REPO, "notes/quality_assurance.json"),
+                  adcp_file=os.path.join(REPO, "notes/quality_specific_adcp.json"))
+            timed(timings, "export_l1", sensor.export, os.path.join(folder, "Level1"), "L1_ADCP", remove_existing=True)
+            timed(timings, "mask_data", sensor.mask_data)
+            timed(timings, "derive_variables", sensor.derive_variables, 0)
+            timed(timings, "export_l2", sensor.export, os.path.join(folder, "Level2"), "L2_ADCP", remove_existing=True)
+            timed(timings, "absolute_backscatter", absolute_backscatter, sensor.data["echo"], sensor.data["temp"],
+                  sensor.general_attributes["beam_freq"], sensor.general_attributes["beam_angle"], True,
+                  sensor.data["zrange"], sensor.data["depth"], sensor.general_attributes["xmit_length"], np.nan,
+                  sensor.general_attributes["Er"], sensor.general_attributes["bandwidth"])
+            u = np.array(sensor.data["u"], dtype=float)
+            timed(timings, "moving_average_filter", moving_average_filter, u)
+            timed(timings, "perform_rotate_velocity", perform_rotate_velocity, u, np.array(sensor.data["v"], dtype=float), 40)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        for step, seconds in timings.items():
+            results[step] = min(results.get(step, np.inf), seconds)
+    return results, cells
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, dirty
+
+
+def load_results(path):
+    if not os.path.isfile(path):
+        return []
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def baseline_results(records, commit, host, baseline=False):
+    """
+    Results to compare with: those of the baseline commit, or by default of the latest commit benchmarked on the same
+    host before the current one.
+
+    Returns:
+        baseline (dict): {(case, step): seconds}
+        baseline_commit (str): commit of the baseline, False if there is none
+    """
+    records = [record for record in records if record["host"] == host]
+    if not baseline:
+        previous = [record["commit"] for record in records if record["commit"] != commit]
+        if not previous:
+            return {}, False
+        baseline = previous[-1]
+    selected = {}
+    for record in records:
+        if record["commit"].startswith(baseline):
+            selected[(record["case"], record["step"])] = record["seconds"]  # The latest run of the commit is kept
+            baseline = record["commit"]
+    return selected, baseline if selected else False
+
+
+def benchmark(frequencies=("300", "600"), sizes=("week", "month"), repeat=3, threshold=0.2, min_delta=0.01,
+              results=os.path.join(REPO, "logs/adcp/benchmarks.jsonl"), baseline=False, save=True):
+    """
+    Run the synthetic benchmark, store the results with the commit and flag the steps slower than the baseline by more
+    than threshold (relative) and min_delta [s].
+
+    Returns:
+        regressions (list of str): steps slower than the baseline
+    """
+    commit, dirty = git_commit()
+    host = platform.node()
+    date = datetime.now(timezone.utc).isoformat()
+    reference, reference_commit = baseline_results(load_results(results), commit, host, baseline)
+    print("Benchmark of commit {}{} on {}, compared to {}".format(commit[:10], " (modified)" if dirty else "", host,
+                                                                   reference_commit[:10] if reference_commit else "no baseline"))
+    records = []
+    regressions = []
+    for frequency in frequencies:
+        for size in sizes:
+            case = "{}_{}".format(frequency, size)
+            timings, cells = benchmark_case(frequency, size, repeat)
+            print("\n{}: {} bins x {} days, {} cells after read_data".format(case, SIZES[size][0], SIZES[size][1], cells))
+            for step, seconds in timings.items():
+                previous = reference.get((case, step))
+                status = ""
+                if previous is not None:
+                    change = seconds / previous - 1 if previous > 0 else 0.
+                    status = "{:+7.1%}".format(change)
+                    if change > threshold and seconds - previous > min_delta:
+                        status += "  REGRESSION"
+                        regressions.append("{} {}: {:.3f} s instead of {:.3f} s".format(case, step, seconds, previous))
+                print("    {:<24}{:>10.4f} s{:>14.0f} cells/s  {}".format(step, seconds, cells / seconds if seconds > 0 else np.inf, status))
+                records.append({"commit": commit, "dirty": dirty, "date": date, "host": host,
+                                "python": platform.python_version(), "numpy": np.__version__, "case": case,
+                                "step": step, "seconds": seconds, "cells": cells, "repeat": repeat})
+    if save:
+        os.makedirs(os.path.dirname(os.path.abspath(results)), exist_ok=True)
+        with open(results, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    if regressions:
+        print("\n{} regressions over {:.0%}:".format(len(regressions), threshold))
+        for regression in regressions:
+            print("    " + regression)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic ADCP benchmark of the processing steps")
+    parser.add_argument('--frequencies', '-f', help="Instrument settings, comma separated", default="300,600")
+    parser.add_argument('--sizes', '-s', help="Dataset sizes ({}), comma separated".format(", ".join(SIZES)), default="week,month")
+    parser.add_argument('--repeat', '-r', help="Repetitions of each case, the fastest is kept", type=int, default=3)
+    parser.add_argument('--threshold', '-t', help="Relative slowdown flagged as a regression", type=float, default=0.2)
+    parser.add_argument('--min-delta', '-md', help="Minimum slowdown flagged as a regression [s]", type=float, default=0.01)
+    parser.add_argument('--results', '-o', help="JSON-lines file of the results", default=os.path.join(REPO, "logs/adcp/benchmarks.jsonl"))
+    parser.add_argument('--baseline', '-b', help="Commit to compare with, default: previous benchmarked commit", default=False)
+    parser.add_argument('--no-save', '-n', help="Do not store the results", action='store_true')
+    args = vars(parser.parse_args())
+    regressions = benchmark(args["frequencies"].split(","), args["sizes"].split(","), args["repeat"], args["threshold"],
+                            args["min_delta"], args["results"], args["baseline"], not args["no_save"])
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import argparse
+import subprocess
+import numpy as np
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def cold_import(statement, python=sys.executable):
+    """
+    Time a statement in a new interpreter, so that no module is already imported.
+
+    Parameters:
+        statement (str): python code to time (e.g. "from instruments import ADCP")
+        python (str): python interpreter
+    Returns:
+        duration (float): time taken by the statement [s]
+        imports (list of tuples): (cumulative time [s], module) of the imports, from python -X importtime
+    """
+    code = "import time; t = time.perf_counter(); {}; print(time.perf_counter() - t)".format(statement)
+    process = subprocess.run([python, "-X", "importtime", "-c", code], cwd=SCRIPTS, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise ValueError("Failed to run {}:\n{}".format(statement, process.stderr))
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        parts = line.split("|")
+        imports.append((int(parts[1]) / 1e6, parts[2].rstrip()))
+    return float(process.stdout.strip().splitlines()[-1]), imports
+
+
+def benchmark_imports(statement="from instruments import ADCP", budget=2., repeat=5, top=15):
+    """
+    Cold-import benchmark: run statement repeat times in new interpreters and compare the median time to budget.
+    Prints the slowest top-level imports of the last run.
+
+    Returns:
+        passed (bool): =True if the median time is within the budget
+    """
+    durations = []
+    for i in range(repeat):
+        duration, imports = cold_import(statement)
+        durations.append(duration)
+    median = float(np.median(durations))
+    print("{}: median {:.3f} s, min {:.3f} s, max {:.3f} s over {} runs (budget {:.3f} s)".format(
+        statement, median, min(durations), max(durations), repeat, budget))
+    roots = [(duration, module.strip()) for duration, module in imports if not module.startswith("  ")]
+    for duration, module in sorted(roots, reverse=True)[:top]:
+        print("    {:8.3f} s  {}".format(duration, module))
+    if median > budget:
+        print("FAILED: cold import over budget by {:.3f} s".format(median - budget))
+        return False
+    print("PASSED")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if the cold import of the processing modules is over budget")
+    parser.add_argument('--statement', '-s', help="Python statement to time", default="from instruments import ADCP")
+    parser.add_argument('--budget', '-b', help="Maximum median cold-import time [s]", type=float, default=2.)
+    parser.add_argument('--repeat', '-r', help="Number of cold imports", type=int, default=5)
+    parser.add_argument('--top', '-t', help="Number of slowest imports listed", type=int, default=15)
+    args = vars(parser.parse_args())
+    sys.exit(0 if benchmark_imports(args["statement"], args["budget"], args["repeat"], args["top"]) else 1)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+
+class Level0Cache:
+    """
+    On-disk cache of the arrays parsed from Level0 files, so that reprocessing an unchanged file skips the binary
+    decoding. Each entry is a folder of .npy files (loaded memory-mapped) and a meta.json file with the attributes.
+
+    Entries are keyed on the file path and validated with its size and modification time. When these differ, the
+    content hash of the file is compared before the entry is discarded, so a file that was downloaded again with
+    identical content is still a hit. The least recently used entries are evicted when the cache exceeds max_size.
+
+    Parameters:
+        folder (str): cache folder
+        max_size (float): size budget of the cache [bytes]
+    """
+    def __init__(self, folder, max_size=20e9):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(self.folder, exist_ok=True)
+
+    def entry(self, file):
+        return os.path.join(self.folder, hashlib.sha1(os.path.abspath(file).encode("utf-8")).hexdigest())
+
+    def load(self, file):
+        """
+        Returns:
+            (variables, attrs) for a valid cache entry, False otherwise
+        """
+        entry = self.entry(file)
+        meta_file = os.path.join(entry, "meta.json")
+        if not os.path.isfile(meta_file):
+            return False
+        try:
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+            stat = os.stat(file)
+            if meta["size"] != stat.st_size or meta["mtime"] != stat.st_mtime_ns:
+                if meta["size"] != stat.st_size or meta["hash"] != file_hash(file):
+                    shutil.rmtree(entry, ignore_errors=True)
+                    return False
+                meta["mtime"] = stat.st_mtime_ns
+            variables = {key: np.load(os.path.join(entry, key + ".npy"), mmap_mode="r") for key in meta["variables"]}
+            meta["last_used"] = time.time()
+            with open(meta_file, "w") as f:
+                json.dump(meta, f)
+            return variables, meta["attrs"]
+        except Exception:
+            shutil.rmtree(entry, ignore_errors=True)
+            return False
+
+    def store(self, file, variables, attrs):
+        entry = self.entry(file)
+        tmp = "{}.tmp{}".format(entry, os.getpid())
+        try:
+            stat = os.stat(file)
+            os.makedirs(tmp, exist_ok=True)
+            for key, values in variables.items():
+                np.save(os.path.join(tmp, key + ".npy"), np.asarray(values))
+            meta = {"file": os.path.abspath(file), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                    "hash": file_hash(file), "last_used": time.time(), "variables": list(variables.keys()),
+                    "attrs": {key: json_value(value) for key, value in attrs.items()}}
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.folder):
+            meta_file = os.path.join(self.folder, name, "meta.json")
+            if not os.path.isfile(meta_file):
+                continue
+            try:
+                with open(meta_file, "r") as f:
+                    last_used = json.load(f)["last_used"]
+            except Exception:
+                last_used = 0
+            size = folder_size(os.path.join(self.folder, name))
+            entries.append((last_used, size, name))
+            total += size
+        entries.sort()
+        while total > self.max_size and len(entries) > 1:
+            last_used, size, name = entries.pop(0)
+            shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+            total -= size
+
+
+def file_hash(file, block_size=2**20):
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+
+def json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
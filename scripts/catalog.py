@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import sqlite3
+import numpy as np
+from datetime import datetime, timezone
+from cache import file_hash
+
+COLUMNS = ["path", "instrument", "level", "start", "end", "depth_min", "depth_max", "size", "mtime", "checksum",
+           "parameters", "updated"]
+
+
+class FileCatalog:
+    """
+    SQLite catalog of the Level0, Level1 and Level2 files, so that files can be selected by instrument, level and time
+    range without walking the data folders or opening the files. Each file is recorded with its instrument (e.g.
+    RDI600), level (L0, L1, L2), time range [s since epoch], depth range [m], size, checksum and the mooring
+    parameters used to process it. Checksums are computed on request (see checksum), so that recording a file appended
+    in place does not read the whole file.
+
+    A connection is opened for each operation, so that the catalog can be updated from writer threads and worker
+    processes.
+
+    Parameters:
+        path (str): SQLite database file
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, instrument TEXT, level TEXT, "
+                       "start REAL, end REAL, depth_min REAL, depth_max REAL, size INTEGER, mtime INTEGER, "
+                       "checksum TEXT, parameters TEXT, updated REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS files_time ON files (instrument, level, start, end)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def record(self, path, instrument, level, start=None, end=None, depth_min=None, depth_max=None, parameters=None, merge=True):
+        """
+        Add or update a file of the catalog. The checksum is kept when the size and modification time of the file did
+        not change, and is otherwise cleared until it is requested.
+
+        Parameters:
+            path (str): file
+            instrument (str): instrument name (e.g. RDI600)
+            level (str): L0, L1 or L2
+            start, end (float): time range of the data in the file [s since epoch], None if unknown
+            depth_min, depth_max (float): depth range of the data in the file [m], None if unknown
+            parameters (dict): parameters used to process the file
+            merge (bool): =True to extend the time and depth ranges already recorded (e.g. data appended to the
+                file), =False to replace them
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        values = {"start": start, "end": end, "depth_min": depth_min, "depth_max": depth_max}
+        values = {key: None if value is None or np.isnan(value) else float(value) for key, value in values.items()}
+        with self.connect() as db:
+            row = db.execute("SELECT start, end, depth_min, depth_max, size, mtime, checksum, parameters FROM files "
+                             "WHERE path = ?", (path,)).fetchone()
+            checksum = None
+            if row is not None:
+                if row[4] == stat.st_size and row[5] == stat.st_mtime_ns:
+                    checksum = row[6]
+                if parameters is None and row[7] is not None:
+                    parameters = json.loads(row[7])
+                if merge:
+                    for key, old, function in zip(values, row[:4], [min, max, min, max]):
+                        if old is not None:
+                            values[key] = old if values[key] is None else function(old, values[key])
+            db.execute("INSERT OR REPLACE INTO files ({}) VALUES ({})".format(", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                       (path, instrument, level, values["start"], values["end"], values["depth_min"],
+                        values["depth_max"], stat.st_size, stat.st_mtime_ns, checksum,
+                        None if parameters is None else json.dumps(parameters), datetime.now().timestamp()))
+
+    def checksum(self, path):
+        """
+        Checksum of a file of the catalog, computed and stored if the file changed since it was last computed.
+
+        Returns:
+            checksum (str): sha256 of the file, None if the file is not in the catalog
+        """
+        path = os.path.abspath(path)
+        with self.connect() as db:
+            row = db.execute("SELECT size, mtime, checksum FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        stat = os.stat(path)
+        if row[2] is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        checksum = file_hash(path)
+        if os.stat(path).st_mtime_ns == stat.st_mtime_ns:  # Only stored if the file did not change while hashing
+            with self.connect() as db:
+                db.execute("UPDATE files SET size = ?, mtime = ?, checksum = ? WHERE path = ?",
+                           (stat.st_size, stat.st_mtime_ns, checksum, path))
+        return checksum
+
+    def files(self, instrument=None, level=None, start=None, end=None):
+        """
+        Files of the catalog, filtered by instrument, level and time range. Files with an unknown time range are only
+        returned when no time range is given.
+
+        Parameters:
+            instrument (str): instrument name (e.g. RDI600), None for all
+            level (str): L0, L1 or L2, None for all
+            start, end (datetime, %Y%m%d str or float [s since epoch]): files overlapping the period, None for no limit
+        Returns:
+            files (list of dicts): catalog entries sorted by start time and path
+        """
+        conditions = []
+        arguments = []
+        if instrument is not None:
+            conditions.append("instrument = ?")
+            arguments.append(instrument)
+        if level is not None:
+            conditions.append("level = ?")
+            arguments.append(level)
+        if start is not None:
+            conditions.append("end >= ?")
+            arguments.append(timestamp(start))
+        if end is not None:
+            conditions.append("start <= ?")
+            arguments.append(timestamp(end))
+        query = "SELECT {} FROM files".format(", ".join(COLUMNS))
+        if conditions:
+            query = query + " WHERE " + " AND ".join(conditions)
+        with self.connect() as db:
+            rows = db.execute(query + " ORDER BY start, path", arguments).fetchall()
+        files = [dict(zip(COLUMNS, row)) for row in rows]
+        for file in files:
+            if file["parameters"] is not None:
+                file["parameters"] = json.loads(file["parameters"])
+        return files
+
+    def paths(self, instrument=None, level=None, start=None, end=None):
+        return [file["path"] for file in self.files(instrument, level, start, end)]
+
+    def remove_missing(self):
+        """
+        Remove the files that no longer exist from the catalog.
+
+        Returns:
+            removed (list of str): removed files
+        """
+        with self.connect() as db:
+            removed = [row[0] for row in db.execute("SELECT path FROM files") if not os.path.exists(row[0])]
+            db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+        return removed
+
+
+def timestamp(value):
+    if isinstance(value, str):
+        value = datetime.strptime(value, "%Y%m%d").replace(tzinfo=timezone.utc)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float(value)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+from cache import file_hash
+
+
+class DependencyGraph:
+    """
+    Record of the inputs each Level0 file was processed with, so that only the files whose inputs changed are
+    processed again: the content hash of the Level0 file, the mooring parameters matched by select_parameters and the
+    sections of the QA configuration files used by the processing.
+
+    The content hash is only computed again when the size or modification time of the file changed.
+
+    Parameters:
+        path (str): JSON file where the graph is stored
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.files = json.load(f)
+
+    def dependencies(self, file, parameters, qa):
+        """
+        Returns:
+            dependencies (dict): input (size, mtime and hash of the file), parameters and qa hashes
+        """
+        stat = os.stat(file)
+        previous = self.files.get(os.path.abspath(file), {}).get("input", {})
+        if previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime_ns:
+            content = previous["hash"]
+        else:
+            content = file_hash(file)
+        return {"input": {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": content},
+                "parameters": json_hash(parameters), "qa": qa}
+
+    def outdated(self, file, dependencies):
+        """
+        Returns:
+            reasons (list of str): dependencies that changed since the file was processed ("input", "parameters",
+                "qa"), ["new"] for a file never processed, [] for an up-to-date file
+        """
+        entry = self.files.get(os.path.abspath(file), False)
+        if not entry:
+            return ["new"]
+        reasons = []
+        if entry["input"]["hash"] != dependencies["input"]["hash"]:
+            reasons.append("input")
+        for key in ["parameters", "qa"]:
+            if entry[key] != dependencies[key]:
+                reasons.append(key)
+        return reasons
+
+    def set(self, file, dependencies):
+        self.files[os.path.abspath(file)] = dependencies
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.files, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def qa_hash(envass_file, adcp_file, variables):
+    """
+    Hash of the sections of the QA configuration files used by the processing: the envass parameters of the
+    variables and the ADCP-specific quality checks.
+    """
+    with open(envass_file, "r") as f:
+        envass = json.load(f)
+    with open(adcp_file, "r") as f:
+        adcp = json.load(f)
+    return json_hash({"envass": {key: envass[key] for key in sorted(variables) if key in envass}, "adcp": adcp})
+
+
+def json_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
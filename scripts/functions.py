@@ -2,20 +2,80 @@ import os
 import copy
 import json
 import ftplib
+import threading
+import contextlib
 import numpy as np
-from datetime import datetime
-from envass import qualityassurance
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from general.functions import logger
 
+FTP_SESSIONS = {}  # Listing connections kept open by ftp_session
+TRANSFER_SESSIONS = {}  # Idle transfer connections kept open by transfer_session
+TRANSFER_LOCK = threading.Lock()
+RESUME_OVERLAP = 4096  # Bytes before the resume offset downloaded again to check that the server file was not replaced
+
+
+def retrieve_new_files(folder, creds, server_location=["data"], filetype=".csv", log=logger(), connections=4, catalog=False):
+    """
+    Download new or grown files from the FTP server. Each server directory is listed once (MLSD, with sizes), files
+    that grew since the last download are resumed from the local size (REST) so that only the missing tail is
+    transferred, and the transfers are shared between a small pool of FTP connections, kept open for the next call
+    (see transfer_session). Files replaced on the server are downloaded again from the start (see server_transfers
+    and download_file).
+
+    Parameters:
+        folder (str): local Level0 folder
+        creds (dict): FTP credentials with keys "ftp", "user", "password" and optionally "port"
+        server_location (list of str): server directories to look for new files
+        filetype (str): extension of the files to download
+        log (logger): logger
+        connections (int): number of FTP connections used to download files in parallel
+        catalog (FileCatalog): file catalog where the downloaded files are recorded as Level0 (L0) files
+    Returns:
+        files (list of str): local paths of the new or updated files
+    """
+    transfers = server_transfers(folder, creds, server_location, filetype, log)
 
-def retrieve_new_files(folder, creds, server_location=["data"], filetype=".csv", log=logger()):
     files = []
+
+    def transfer(file, local_path, offset, modify):
+        with transfer_connection(creds) as ftp:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            return download_file(file, local_path, ftp, offset=offset, modify=modify)
+
+    with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+        futures = [executor.submit(transfer, *t) for t in transfers]
+        for (file, local_path, offset, modify), future in zip(transfers, futures):
+            try:
+                resumed = future.result()
+                if resumed > 0:
+                    log.info("Resuming file {} from byte {}".format(local_path, offset), indent=2)
+                else:
+                    log.info("Downloading file {}{}".format(local_path, " (replaced on the server)" if offset > 0 else ""), indent=2)
+                files.append(local_path)
+                if catalog:
+                    catalog.record(local_path, os.path.basename(os.path.dirname(local_path)), "L0")
+            except Exception as e:
+                log.warning("Failed to download {}: {}".format(file, e), indent=2)
+    files.sort()
+    return files
+
+
+def server_transfers(folder, creds, server_location=["data"], filetype=".csv", log=logger()):
+    """
+    List the files of the FTP server that are new or grew since the last download (see retrieve_new_files). The
+    modification time of the server file is given to the local file when it is downloaded, so a server file older
+    than the local file was replaced (appending data makes it newer) and is downloaded again from the start.
+
+    Returns:
+        transfers (list of (str, str, int, float)): server path, local path, local size (offset to resume from) and
+            modification time of the server file [s since epoch] (None if not available)
+    """
     log.info("Connecting to {}.".format(creds["ftp"]), indent=1)
-    ftp = ftplib.FTP(creds["ftp"], timeout=100)
-    ftp.login(creds["user"], creds["password"])
+    ftp = ftp_session(creds)
+    transfers = []
     for location in server_location:
-        server_files = ftp.nlst(location)
-        for file in server_files:
+        for file, size, modify in list_server_files(ftp, location):
             file_name = os.path.basename(file)
             if file.endswith(filetype):
                 if file_name.startswith("L3"):
@@ -26,24 +86,168 @@ def retrieve_new_files(folder, creds, server_location=["data"], filetype=".csv",
                 else:
                     subfolder = "RDI600"
                 local_path = os.path.join(folder, subfolder, file_name)
-                try:
-                    if os.path.exists(local_path) and ftp.size(file) <= os.path.getsize(local_path):
-                        log.info("Skipping file with identical size.", indent=2)
-                        continue
-                except Exception as e:
+                local_size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+                if size is None:
                     log.info("Could not retrieve size for {}.".format(file), indent=2)
-                    pass
+                    local_size = 0
+                elif os.path.exists(local_path) and size <= local_size:
+                    log.info("Skipping file with identical size.", indent=2)
+                    continue
+                elif local_size > 0 and modify is not None and modify < os.path.getmtime(local_path):
+                    log.info("{} is older than the local file, downloading it again.".format(file), indent=2)
+                    local_size = 0
+                transfers.append((file, local_path, local_size, modify))
+    return transfers
+
+
+def ftp_connect(creds, timeout=100):
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(creds["ftp"], int(creds.get("port", 21)))
+    ftp.login(creds["user"], creds["password"])
+    return ftp
 
-                log.info("Downloading file {}".format(os.path.join(folder, subfolder, file_name)), indent=2)
-                download_file(file, local_path, ftp)
-                files.append(local_path)
-    files.sort()
-    return files
+
+def ftp_session(creds):
+    """
+    FTP connection kept open between calls (e.g. successive runs of the watch mode), reconnected when the server
+    closed it.
+    """
+    key = (creds["ftp"], int(creds.get("port", 21)), creds["user"])
+    ftp = FTP_SESSIONS.get(key, False)
+    if ftp:
+        try:
+            ftp.voidcmd("NOOP")
+            return ftp
+        except Exception:
+            ftp.close()
+    FTP_SESSIONS[key] = ftp_connect(creds)
+    return FTP_SESSIONS[key]
 
 
-def download_file(server, local, ftp):
-    with open(local, "wb") as f:
-        ftp.retrbinary("RETR " + server, f.write)
+@contextlib.contextmanager
+def transfer_connection(creds):
+    """
+    Transfer connection (see transfer_session), given back to the idle connections after the transfer. A connection
+    that failed (timeout, 421, connection reset, transfer interrupted) is closed and dropped, so that the next transfer
+    opens a new connection, only permanent errors of the server (e.g. 550 file not found) keep it.
+    """
+    ftp = transfer_session(creds)
+    try:
+        yield ftp
+    except ftplib.error_perm:
+        release_transfer_session(creds, ftp)
+        raise
+    except BaseException:
+        ftp.close()
+        raise
+    release_transfer_session(creds, ftp)
+
+
+def transfer_session(creds):
+    """
+    Idle transfer connection kept open since a previous transfer (e.g. previous run of the watch mode), checked with
+    NOOP, or a new connection. Connections are given back with release_transfer_session.
+    """
+    key = (creds["ftp"], int(creds.get("port", 21)), creds["user"])
+    while True:
+        with TRANSFER_LOCK:
+            idle = TRANSFER_SESSIONS.get(key, [])
+            ftp = idle.pop() if idle else False
+        if not ftp:
+            return ftp_connect(creds)
+        try:
+            ftp.voidcmd("NOOP")
+            return ftp
+        except Exception:
+            ftp.close()
+
+
+def release_transfer_session(creds, ftp):
+    key = (creds["ftp"], int(creds.get("port", 21)), creds["user"])
+    with TRANSFER_LOCK:
+        TRANSFER_SESSIONS.setdefault(key, []).append(ftp)
+
+
+def list_server_files(ftp, location):
+    """
+    List the files of a server directory with their size in one request (MLSD), falling back on NLST and one SIZE
+    request per file for servers that do not support MLSD.
+
+    Returns:
+        files (list of (str, int, float)): server path, size and modification time [s since epoch] of each file (None
+            if the size or modification time is not available)
+    """
+    try:
+        return [(location.rstrip("/") + "/" + name, int(facts["size"]) if "size" in facts else None,
+                 ftp_time(facts["modify"]) if "modify" in facts else None)
+                for name, facts in ftp.mlsd(location, facts=["type", "size", "modify"])
+                if facts.get("type", "file") == "file"]
+    except ftplib.error_perm:
+        files = []
+        for file in ftp.nlst(location):
+            try:
+                files.append((file, ftp.size(file), None))
+            except Exception:
+                files.append((file, None, None))
+        return files
+
+
+def ftp_time(value):
+    # MLSD modify fact (UTC YYYYMMDDHHMMSS[.sss]) in s since epoch
+    return datetime.strptime(value[:14], "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc).timestamp() + float("0" + value[14:])
+
+
+class ReplacedFile(Exception):
+    pass
+
+
+def download_file(server, local, ftp, offset=0, modify=None):
+    """
+    Download a server file, or only its bytes after offset. When resuming, the RESUME_OVERLAP bytes before offset are
+    downloaded again and compared with the local file: if they differ, the server file was replaced and it is
+    downloaded again from the start.
+
+    Parameters:
+        server (str): server path
+        local (str): local path
+        ftp (ftplib.FTP): FTP connection
+        offset (int): size of the local file to resume from, 0 to download the whole file
+        modify (float): modification time of the server file [s since epoch], given to the local file
+    Returns:
+        offset (int): offset the download was resumed from, 0 if the whole file was downloaded
+    """
+    if offset > 0:
+        start = max(0, offset - RESUME_OVERLAP)
+        with open(local, "r+b") as f:
+            f.seek(start)
+            expected = f.read(offset - start)
+            f.truncate(offset)
+            received = bytearray()
+
+            def write(data):
+                if len(received) < len(expected):
+                    n = len(expected) - len(received)
+                    received.extend(data[:n])
+                    if received != expected[:len(received)]:
+                        raise ReplacedFile()
+                    data = data[n:]
+                if data:
+                    f.write(data)
+            try:
+                ftp.retrbinary("RETR " + server, write, rest=start)
+            except ReplacedFile:
+                try:
+                    ftp.voidresp()  # Transfer aborted by the client
+                except ftplib.all_errors:
+                    pass
+            if received != expected:
+                offset = 0
+    if offset == 0:
+        with open(local, "wb") as f:
+            ftp.retrbinary("RETR " + server, f.write)
+    if modify is not None:
+        os.utime(local, (modify, modify))
+    return offset
 
 
 def fixed_grid_resample_guide(data, grid):
@@ -70,6 +274,27 @@ def resample(guide, data):
     out.append(np.nan)
     return out
     
+def measurement_period(time, valid, start_date=None, end_date=None):
+    """
+    Select the ensembles of the measurement period, i.e. strictly after the first and before the last ensemble with
+    valid data (correlation>20%), and strictly between start_date and end_date if specified.
+
+    Parameters:
+        time (np.array of np.datetime64): time of the ensembles
+        valid (np.array of ints): indices of the ensembles with valid data, only the first and last ones are used
+        start_date (np.datetime64): starting time of the period to extract, None for no limit
+        end_date (np.datetime64): end time of the period to extract, None for no limit
+    Returns:
+        idx (np.array of bools): =True for the ensembles of the measurement period
+    """
+    start = time[valid[0]]
+    end = time[valid[-1]]
+    if start_date is not None:
+        start = max(start, start_date)
+    if end_date is not None:
+        end = min(end, end_date)
+    return (start < time) & (time < end)
+
 def rotation_matrix_2d(alpha):
     M = np.zeros((2,2))
     M[0,0] = np.cos(alpha)
@@ -78,60 +303,87 @@ def rotation_matrix_2d(alpha):
     M[1,1] = np.cos(alpha)
     return M
 
-def perform_rotate_velocity(u,v, alpha = 40):
-    #rotates the velocities by an angle alpha (degrees)
-    for index in np.ndindex(u.shape):
-        M = rotation_matrix_2d(alpha/180*np.pi)
-        V = np.array([[u[index],v[index]]]).T
-        V2 = np.dot(M,V)
-        u[index] = V2[0]
-        v[index] = V2[1]
-    return u,v 
+def perform_rotate_velocity(u, v, alpha=40, inplace=True):
+    """
+    Rotate the horizontal velocities by an angle alpha (anticlockwise, degrees), for all cells at once.
+
+    Parameters:
+        u (n_bins*n_time np.array of floats): eastern velocity [m/s]
+        v (n_bins*n_time np.array of floats): northern velocity [m/s]
+        alpha (float or n_time np.array of floats): rotation angle [°], either one angle for the whole deployment
+            or one angle per time step (e.g. heading-dependent rotation)
+        inplace (bool): =True to write the rotated velocities into u and v, =False to return new arrays
+    Returns:
+        u, v (n_bins*n_time np.array of floats): rotated velocities [m/s]
+    """
+    alpha = np.asarray(alpha, dtype=float) / 180 * np.pi
+    if alpha.ndim == 1:
+        if alpha.shape[0] != u.shape[-1]:
+            raise ValueError("Rotation angle array must have one value per time step ({} != {})".format(alpha.shape[0], u.shape[-1]))
+    elif alpha.ndim > 1:
+        raise ValueError("Rotation angle must be a scalar or a 1D array of angles per time step")
+    if not inplace:
+        u = np.array(u, dtype=float)
+        v = np.array(v, dtype=float)
+    cos_alpha = np.cos(alpha)
+    sin_alpha = np.sin(alpha)
+    u_rotated = cos_alpha * u - sin_alpha * v
+    v *= cos_alpha
+    v += sin_alpha * u
+    u[...] = u_rotated
+    return u, v
 
 def moving_average_filter(array, m=3, n=7, valid_entries=3):
-    ## Filtering velocities by a moving average filter, 
-    ## keeping only elements that do not relay on zero-padding
+    """
+    Smooth a (depth, time) matrix with a NaN-aware moving average filter, keeping only elements that do not rely on
+    zero-padding. The windowed sums and counts are computed for the whole matrix at once (separable sliding sums along
+    depth then time), so the cost is proportional to the number of cells rather than to a Python loop over them.
 
-    # Define filter size: 4m vertical (m=3 element), 1h horizontal (n=7, elements)
+    Parameters:
+        array (n_bins*n_time np.array of floats): data to smooth, NaN values are ignored
+        m (int): vertical size of the window [bins] (default: 3 bins, i.e. 4 m for the 300 kHz ADCP)
+        n (int): horizontal size of the window [time steps] (default: 7 steps, i.e. 1 h for 10 min ensembles)
+        valid_entries (int): minimum number of valid entries in the window needed to perform the smoothing
+    Returns:
+        u_smoothed (n_bins*n_time np.array of floats): smoothed data. The value at [i, j] is the mean of
+        array[i:i+m, j:j+n], the last m-1 rows and n-1 columns are NaN.
+    """
+    array = np.asarray(array, dtype=float)
+    u_smoothed = np.full(array.shape, np.nan)
     y, x = array.shape
     y = y - m + 1
     x = x - n + 1
+    if y <= 0 or x <= 0:
+        return u_smoothed
+
+    # Mask data to only sum the valid entries
+    valid = ~np.isnan(array)
+    values = np.where(valid, array, 0.)
+
+    # Windowed sums and number of valid entries
+    sum_u = window_sum(window_sum(values, m, axis=0), n, axis=1)
+    count_u = window_sum(window_sum(valid.astype(np.int32), m, axis=0), n, axis=1)
+
+    # Perform smoothing only if minimum number of valid entries is satisfied, otherwise set to NaN
+    enough = count_u >= valid_entries
+    smoothed = np.full((y, x), np.nan)
+    np.divide(sum_u, count_u, out=smoothed, where=enough)
+    u_smoothed[:y, :x] = smoothed
+    return u_smoothed
 
-    u_smoothed = np.full(array.shape, np.nan)
-    
-    # Define minimum number of valid entries needed to perform the smoothing
-    valid_entries = 3
-    
-    # Filter velocities
-    for i in range(y):
-        for j in range(x):
-            
-            # Mask data to only sum the valid entries later
-            masked_u = np.ma.masked_invalid(array[i:i+m, j:j+n])
-
-            # Count number of valid entries
-            count_u = len(masked_u.compressed())
-
-            # Perform smoothing only if minimum number of valid entries is satisfied, otherwise set to NaN
-            if count_u >= valid_entries:
-                u_smoothed[i][j] = np.sum(masked_u)/count_u
-            else:
-                u_smoothed[i][j] = np.nan
+def window_sum(array, size, axis=0):
+    """
+    Sum of every window of length size along one axis (equivalent to array[i:i+size].sum(axis) for each valid i).
 
-            
-    #self.data["depth"] = self.z0[1:-1]
-    #self.data["time"] = self.time[3:-3]
-    # Adapt time and depth array
-    #self.z0 = self.z0[1:-1]
-    #self.time = self.time[3:-3]
-    #self.date = self.date[3:-3]
-    
-    # Adapt variables for calculating backscattering later
-    #self.r = self.r[1:-1]
-    #self.temp = self.temp[3:-3]
-    #self.batery = self.battery[3:-3]
-    #self.echo = self.echo[:, 1:-1, 3:-3]
-    return u_smoothed
+    Parameters:
+        array (np.array): input array
+        size (int): length of the window
+        axis (int): axis along which the windows are taken
+    Returns:
+        out (np.array): windowed sums, the length along axis is reduced by size-1
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(array, size, axis=axis)
+    return windows.sum(axis=-1)
 
 def absolute_backscatter(echo, temp, beam_freq, beam_angle, cabled, zrange, z0, xmit_length, battery, Er,bandwidth,
                                 kc = 0.45):
@@ -309,6 +561,7 @@ def advanced_quality_flags(df, json_path="quality_assurance.json"):
         output:
             - dictionnary where the dataframe is stored with updated advanced quality checks
         """
+    from envass import qualityassurance
     quality_assurance_dict = json.load(open(json_path))
     var_name = quality_assurance_dict.keys()
     advanced_df = df.copy()
@@ -1,22 +1,48 @@
 # -*- coding: utf-8 -*-
 import os
-import pytz
 import copy
 import json
-import ftplib
+import queue
+import fcntl
+import weakref
+import resource
+import functools
+import threading
+import traceback
 import netCDF4
-import requests
 import numpy as np
-import pandas as pd
-import xarray as xr
-import seawater as sw
-from shutil import move
-from scipy.interpolate import griddata
+from time import perf_counter
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from math import sin, cos, sqrt, atan2, radians
 from dateutil.relativedelta import relativedelta
-from envass import qualityassurance
-import matplotlib.pyplot as plt
+
+# envass (which loads pandas, scikit-learn and plotly), pandas, xarray and requests are only imported by the functions
+# using them (QA, maintenance periods, timeseries QA, bathymetry), so that importing the processing modules stays fast
+# for short runs and worker processes.
+
+NETCDF_LOCK = threading.RLock()
+
+
+def measured(stage):
+    """
+    Decorator of the instrument methods measured by the logger metrics (see logger.measure): the record has the
+    shape of the data (depth x time) after the method and the bytes of variables written by exports.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            if not (self.log.metrics or self.log.profiler):
+                return function(self, *args, **kwargs)
+            self.bytes_written = 0
+            with self.log.measure(stage, self.source) as record:
+                result = function(self, *args, **kwargs)
+                record["shape"] = self.data_shape()
+                record["bytes"] = self.bytes_written
+            return result
+        return wrapper
+    return decorator
 
 
 class GenericInstrument:
@@ -34,6 +60,12 @@ class GenericInstrument:
         self.variables = {}
         self.data = {}
         self.grid = {}
+        self.default_encoding = {"dtype": "f8", "complevel": 4}
+        self.encodings = {}
+        self.export_report = {}
+        self.parameters = {}  # Processing parameters (e.g. mooring parameters), recorded in the file catalog
+        self.source = False  # File the data was read from, recorded in the logger metrics
+        self.bytes_written = 0
         if log != False:
             self.log = log
         else:
@@ -45,12 +77,14 @@ class GenericInstrument:
         if not os.path.exists(file_path):
             self.log.warning("Cannot find QA file: {}, no QA applied.".format(file_path), indent=2)
             return False
+        from envass import qualityassurance
 
 
         # Maintenance periods or sensor issues
         periods = []
         if maintenance_file:
             print("Processing maintenance periods from {}".format(maintenance_file))
+            import pandas as pd
             df = pd.read_csv(maintenance_file, sep=";")
             df["start"] = df["start"].apply(
                 lambda x: datetime.timestamp(datetime.strptime(x, '%Y%m%d %H:%M:%S').replace(tzinfo=timezone.utc)))
@@ -88,7 +122,163 @@ class GenericInstrument:
 #        except:
 #            self.log.error("Unable to apply QA file, this is likely due to bad formatting of the file.")
 
-    def export(self, folder, title, output_period="file", time_label="time", profile_to_grid=False, overwrite=False, remove_existing=False):
+    def export(self, folder, title, output_period="file", time_label="time", profile_to_grid=False, overwrite=False, remove_existing=False, start=False, writer=False, zarr_store=False, catalog=False):
+        """
+        Export the data to NetCDF files. With a writer (ExportWriter), a snapshot of the data is written in the
+        background and a future of the list of output files is returned. Otherwise the files are written before
+        returning the list of output files.
+
+        With zarr_store, the data is also appended to a Zarr store (see export_zarr): zarr_store is the path of the
+        store, or True for the store {title}.zarr in folder. Existing times in the store are overwritten when
+        overwrite or remove_existing is True.
+
+        With a catalog (catalog.FileCatalog), the output files are recorded in the catalog, with the name of folder as
+        instrument and the start of title as level (e.g. RDI600 and L1 for Level1/RDI600 and L1_ADCP).
+        """
+        if writer:
+            return writer.submit("{} to {}".format(title, folder), self.snapshot(profile_to_grid).export, folder, title,
+                                 output_period=output_period, time_label=time_label, profile_to_grid=profile_to_grid,
+                                 overwrite=overwrite, remove_existing=remove_existing, start=start, zarr_store=zarr_store,
+                                 catalog=catalog)
+        with NETCDF_LOCK:
+            output_files = self.export_netcdf(folder, title, output_period, time_label, profile_to_grid, overwrite, remove_existing, start, catalog)
+            if zarr_store and output_files is not None:
+                store = os.path.join(folder, title + ".zarr") if zarr_store is True else zarr_store
+                output_files.append(self.export_zarr(store, time_label, profile_to_grid, overwrite or remove_existing))
+            return output_files
+
+    def data_shape(self):
+        return [int(np.size(self.data[key])) for key in ["depth", "time"] if key in self.data]
+
+    def snapshot(self, profile_to_grid=False):
+        """
+        Shallow copy of the instrument with copies of the variables, attributes and exported arrays, that later
+        changes of the data (e.g. mask_data, derive_variables) do not affect.
+        """
+        instrument = copy.copy(self)
+        instrument.general_attributes = copy.deepcopy(self.general_attributes)
+        if profile_to_grid:
+            instrument.grid_variables = copy.deepcopy(self.grid_variables)
+            instrument.grid = {key: np.array(self.grid[key], copy=True) for key in self.grid}
+        else:
+            instrument.variables = copy.deepcopy(self.variables)
+            instrument.data = {key: np.array(self.data[key], copy=True) for key in self.variables if key in self.data}
+        return instrument
+
+    @measured("export_zarr")
+    def export_zarr(self, store, time_label="time", profile_to_grid=False, overwrite=True, chunk_period=7*86400):
+        """
+        Append the data to a consolidated Zarr store holding all the data of an instrument, so that periods across
+        deployments can be sliced without opening one NetCDF file per Level0 file (e.g. xr.open_zarr(store)).
+
+        Variables are encoded as in the NetCDF files (see variable_encoding) and stored with the CF attributes read by
+        xarray. The time dimension is kept sorted and chunked in blocks of chunk_period, at the sampling interval of
+        the data that created the store. New values of the other dimensions (e.g. depths of a new deployment) are
+        appended to these dimensions and filled in the previous times, so they are not sorted across deployments.
+        The store is locked while written, so that processes can append to the same store.
+
+        Parameters:
+            store (str): path of the Zarr store
+            time_label (str): time dimension
+            profile_to_grid (bool): export the gridded data
+            overwrite (bool): =True to overwrite the times already in the store, =False to skip them
+            chunk_period (float): duration of the time chunks [s]
+        Returns:
+            store (str): path of the Zarr store
+        """
+        import zarr
+        from numcodecs import Blosc
+        if profile_to_grid:
+            variables, dimensions, data = self.grid_variables, self.grid_dimensions, self.grid
+        else:
+            variables, dimensions, data = self.variables, self.dimensions, self.data
+        self.log.info("Appending data to Zarr store {}".format(store), indent=2)
+
+        time = np.asarray(data[time_label], dtype=float)
+        valid = np.where(~np.isnan(time))[0]
+        valid = valid[np.argsort(time[valid], kind="stable")]
+        other_dims = [d for d in dimensions if d != time_label and d in data]
+
+        os.makedirs(store, exist_ok=True)
+        with open(os.path.join(store, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            root = zarr.open_group(store, mode="a")
+            if time_label not in root:
+                step = np.median(np.diff(time[valid])) if len(valid) > 1 else 0
+                chunk = int(max(1, round(chunk_period / step))) if step > 0 else 4096
+                for key, values in variables.items():
+                    encoding, packing = self.variable_encoding(key, values["dim"], data, profile_to_grid)
+                    shape = [0 if dim == time_label else np.size(data[dim]) for dim in values["dim"]]
+                    chunks = [chunk if dim == time_label else max(1, np.size(data[dim])) for dim in values["dim"]]
+                    var = root.create_dataset(key, shape=shape, chunks=chunks, dtype=encoding["datatype"],
+                                              fill_value=encoding["fill_value"],
+                                              compressor=Blosc(cname="zstd", clevel=min(encoding["complevel"], 9),
+                                                               shuffle=Blosc.SHUFFLE))
+                    var.attrs.update(dict(packing, _ARRAY_DIMENSIONS=list(values["dim"]), units=values["unit"],
+                                          long_name=values["long_name"]))
+                    if key in other_dims:
+                        var[:] = pack_values(data[key], encoding, packing)
+                root.attrs.update(self.general_attributes)
+
+            # Position of the values of the other dimensions in the store, new values are appended
+            rows = {}
+            for dim in other_dims:
+                stored = np.round(root[dim][:].astype(float), 6)
+                values = np.round(np.asarray(data[dim], dtype=float), 6)
+                added = values[~np.isin(values, stored)]
+                if len(added) > 0:
+                    for key in root.array_keys():
+                        dims = root[key].attrs["_ARRAY_DIMENSIONS"]
+                        if dim in dims:
+                            shape = list(root[key].shape)
+                            shape[dims.index(dim)] += len(added)
+                            root[key].resize(*shape)
+                    root[dim][len(stored):] = pack_values(added, *self.variable_encoding(dim, (dim,), data, profile_to_grid))
+                    stored = np.append(stored, added)
+                order = np.argsort(stored)
+                rows[dim] = order[np.searchsorted(stored, values, sorter=order)]
+
+            stored_time = root[time_label][:].astype(float)
+            duplicates = np.isin(time[valid], stored_time)
+            existing = valid[duplicates] if overwrite else valid[:0]
+            positions = np.searchsorted(stored_time, time[existing])
+            new = valid[~duplicates]
+            # Stored values after start are merged with the new times and rewritten, so appending only writes new times
+            start = np.searchsorted(stored_time, time[new[0]]) if len(new) > 0 else len(stored_time)
+            merged = np.argsort(np.append(stored_time[start:], time[new]), kind="stable")
+
+            for key, values in variables.items():
+                if time_label not in values["dim"]:
+                    continue
+                var = root[key]
+                encoding, packing = self.variable_encoding(key, values["dim"], data, profile_to_grid)
+                source = np.asarray(data[key])
+                if len(values["dim"]) == 1:
+                    if len(existing) > 0:
+                        var.oindex[positions] = pack_values(source[existing], encoding, packing)
+                    packed = pack_values(source[new], encoding, packing)
+                    if start < len(stored_time):
+                        packed = np.append(var[start:], packed)[merged]
+                    var.resize(start + len(packed))
+                    var[start:] = packed
+                elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
+                    row = rows.get(values["dim"][0], np.arange(source.shape[0]))
+                    if len(existing) > 0:
+                        var.oindex[row, positions] = pack_values(source[:, existing], encoding, packing)
+                    packed = np.full((var.shape[0], len(new)), encoding["fill_value"], dtype=encoding["datatype"])
+                    packed[row, :] = pack_values(source[:, new], encoding, packing)
+                    if start < len(stored_time):
+                        packed = np.concatenate((var[:, start:], packed), axis=1)[:, merged]
+                    var.resize(var.shape[0], start + packed.shape[1])
+                    var[:, start:] = packed
+                else:
+                    raise ValueError("Failed to write variable {} with dimensions: {} to file"
+                                     .format(key, ", ".join(values["dim"])))
+            zarr.consolidate_metadata(store)
+        return store
+
+    @measured("export")
+    def export_netcdf(self, folder, title, output_period="file", time_label="time", profile_to_grid=False, overwrite=False, remove_existing=False, start=False, catalog=False):
         if profile_to_grid:
             variables = self.grid_variables
             dimensions = self.grid_dimensions
@@ -99,12 +289,12 @@ class GenericInstrument:
             data = self.data
 
         time = data[time_label]
-        time_min = datetime.utcfromtimestamp(np.nanmin(time)).replace(tzinfo=pytz.utc)
-        time_max = datetime.utcfromtimestamp(np.nanmax(time)).replace(tzinfo=pytz.utc)
+        time_min = datetime.utcfromtimestamp(np.nanmin(time)).replace(tzinfo=timezone.utc)
+        time_max = datetime.utcfromtimestamp(np.nanmax(time)).replace(tzinfo=timezone.utc)
 
         if output_period == "file":
-            file_start = time_min
-            file_period = time_max - time_min
+            file_start = start if start else time_min  # Fixed start to append to the file of a previous export
+            file_period = time_max - file_start
         elif output_period == "daily":
             file_start = time_min.replace(hour=0, minute=0, second=0, microsecond=0)
             file_period = timedelta(days=1)
@@ -140,7 +330,9 @@ class GenericInstrument:
             if os.path.isfile(out_file) and remove_existing:
                 os.remove(out_file)
 
-            if not os.path.isfile(out_file):
+            report = {}
+            created = not os.path.isfile(out_file)
+            if created:
                 self.log.info("Creating new file.", indent=3)
                 with netCDF4.Dataset(out_file, mode='w', format='NETCDF4') as nc:
                     for key in self.general_attributes:
@@ -148,7 +340,10 @@ class GenericInstrument:
                     for key, values in dimensions.items():
                         nc.createDimension(values['dim_name'], values['dim_size'])
                     for key, values in variables.items():
-                        var = nc.createVariable(values["var_name"], np.float64, values["dim"], fill_value=np.nan, zlib=True, complevel=4, shuffle=True)
+                        encoding, packing = self.variable_encoding(key, values["dim"], data, profile_to_grid)
+                        var = nc.createVariable(values["var_name"], dimensions=values["dim"], **encoding)
+                        for attr, value in packing.items():
+                            setattr(var, attr, value)
                         var.units = values["unit"]
                         var.long_name = values["long_name"]
                         if profile_to_grid and key == time_label:
@@ -163,14 +358,14 @@ class GenericInstrument:
                         else:
                             if len(values["dim"]) == 1:
                                 if values["dim"][0] == time_label:
-                                    var[:] = data[key][valid_time]
+                                    self.write_variable(var, slice(None), np.asarray(data[key])[valid_time], report)
                                 else:
-                                    var[:] = data[key]
+                                    self.write_variable(var, slice(None), data[key], report)
                             elif len(values["dim"]) == 2:
                                 if values["dim"][0] == time_label:
-                                    var[:] = data[key][valid_time, :]
+                                    self.write_variable(var, slice(None), np.asarray(data[key])[valid_time, :], report)
                                 elif values["dim"][1] == time_label:
-                                    var[:] = data[key][:, valid_time]
+                                    self.write_variable(var, slice(None), np.asarray(data[key])[:, valid_time], report)
                             else:
                                 raise ValueError("Failed to write variable {} with dimensions: {} to file".format(key,", ".join(values["dim"])))
             else:
@@ -224,32 +419,116 @@ class GenericInstrument:
                         else:
                             non_duplicates = ~np.isin(time, nc_time)
                             valid = np.logical_and(valid_time, non_duplicates)
-                            combined_time = np.append(nc_time, time[valid])
-                            order = np.argsort(combined_time)
-                            nc_copy = copy_variables(nc.variables)
-                            for key, values in self.variables.items():
-                                if time_label in values["dim"]:
-                                    if len(values["dim"]) == 1:
-                                        combined = np.append(nc_copy[key][:], np.array(data[key])[valid])
-                                        if overwrite:
-                                            combined[np.isin(combined_time, time)] = np.array(data[key])[
-                                                np.isin(time, combined_time)]
-                                        out = combined[order]
-                                    elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
-                                        combined = np.concatenate(
-                                            (np.array(nc_copy[key][:]), np.array(data[key])[:, valid]), axis=1)
-                                        if overwrite:
-                                            combined[:, np.isin(combined_time, time)] = np.array(data[key])[
-                                                :, np.isin(time, combined_time)]
-                                        out = combined[:, order]
-                                    else:
-                                        raise ValueError(
-                                            "Failed to write variable {} with dimensions: {} to file"
-                                            .format(key, ", ".join(values["dim"])))
-                                    nc.variables[key][:] = out
+                            if len(nc_time) == 0 or np.all(time[valid] > np.nanmax(nc_time)):
+                                self.log.info("Appending data in place.", indent=3)
+                                self.append_variables(nc, data, time, valid, nc_time, overwrite, time_label, report)
+                            else:
+                                self.log.info("Merging data with existing data.", indent=3)
+                                combined_time = np.append(nc_time, time[valid])
+                                order = np.argsort(combined_time)
+                                nc_copy = copy_variables(nc.variables)
+                                for key, values in self.variables.items():
+                                    if time_label in values["dim"]:
+                                        if len(values["dim"]) == 1:
+                                            combined = np.append(nc_copy[key][:], np.array(data[key])[valid])
+                                            if overwrite:
+                                                combined[np.isin(combined_time, time)] = np.array(data[key])[
+                                                    np.isin(time, combined_time)]
+                                            out = combined[order]
+                                        elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
+                                            combined = np.concatenate(
+                                                (np.array(nc_copy[key][:]), np.array(data[key])[:, valid]), axis=1)
+                                            if overwrite:
+                                                combined[:, np.isin(combined_time, time)] = np.array(data[key])[
+                                                    :, np.isin(time, combined_time)]
+                                            out = combined[:, order]
+                                        else:
+                                            raise ValueError(
+                                                "Failed to write variable {} with dimensions: {} to file"
+                                                .format(key, ", ".join(values["dim"])))
+                                        self.write_variable(nc.variables[key], slice(None), out, report)
+            if report:
+                self.log_encoding_report(out_file, report)
+            if catalog and np.any(valid_time):
+                depth = np.asarray(data["depth"], dtype=float) if "depth" in data else np.array([np.nan])
+                catalog.record(out_file, os.path.basename(os.path.normpath(folder)), title.split("_")[0],
+                               np.nanmin(time[valid_time]), np.nanmax(time[valid_time]), np.nanmin(depth),
+                               np.nanmax(depth), parameters=self.parameters, merge=not created)
             file_start = file_start + file_period
         return output_files
 
+    def variable_encoding(self, key, dims, data, profile_to_grid=False):
+        """
+        NetCDF encoding of a variable: self.default_encoding updated with the entry of the variable in
+        self.encodings (the "_qual" entry applies to all the quality flags). Gridded data is written with the default
+        encoding.
+
+        Returns:
+            encoding (dict): datatype, fill_value, compression and chunksizes arguments of createVariable
+            packing (dict): scale_factor and add_offset attributes of packed variables
+        """
+        encoding = dict(self.default_encoding)
+        if not profile_to_grid:
+            encoding.update(self.encodings.get(key, self.encodings.get("_qual", {}) if key.endswith("_qual") else {}))
+        dtype = np.dtype(encoding["dtype"])
+        fill_value = encoding.get("fill_value", np.nan if dtype.kind == "f" else netCDF4.default_fillvals[dtype.str[1:]])
+        out = {"datatype": dtype, "fill_value": fill_value, "zlib": encoding["complevel"] > 0,
+               "complevel": encoding["complevel"], "shuffle": True}
+        if "chunks" in encoding:
+            # None chunks the full length of the dimension in the data
+            out["chunksizes"] = [encoding["chunks"].get(dim) or max(1, np.size(data[dim]) if dim in data else 1)
+                                 for dim in dims]
+        packing = {attr: encoding[attr] for attr in ["scale_factor", "add_offset"] if attr in encoding}
+        return out, packing
+
+    def write_variable(self, var, index, values, report=False):
+        start = perf_counter()
+        values = encode_values(values, var.dtype, getattr(var, "_FillValue", None), getattr(var, "scale_factor", 1.),
+                               getattr(var, "add_offset", 0.))
+        var[index] = values
+        if report is not False:
+            entry = report.setdefault(var.name, {"dtype": var.dtype.str[1:], "bytes": 0, "seconds": 0.})
+            entry["bytes"] += values.size * var.dtype.itemsize
+            entry["seconds"] += perf_counter() - start
+
+    def log_encoding_report(self, out_file, report):
+        self.export_report[out_file] = report
+        self.bytes_written += sum(entry["bytes"] for entry in report.values())
+        self.log.info("Wrote {:.2f} MB of variables in {:.2f} s, file size {:.2f} MB.".format(
+            sum(entry["bytes"] for entry in report.values()) / 1e6, sum(entry["seconds"] for entry in report.values()),
+            os.path.getsize(out_file) / 1e6), indent=3)
+        for key, entry in sorted(report.items(), key=lambda item: -item[1]["bytes"]):
+            self.log.info("{:<14}{:<4}{:>12} B{:>10.1f} ms".format(key, entry["dtype"], entry["bytes"],
+                                                                    entry["seconds"] * 1e3), indent=4)
+
+    def append_variables(self, nc, data, time, valid, nc_time, overwrite, time_label="time", report=False):
+        # New times sort after the existing data: written in place along the unlimited time dimension, existing times
+        # are only rewritten when overwrite is True.
+        new = np.where(valid)[0]
+        new = new[np.argsort(time[new], kind="stable")]
+        writes = [(slice(len(nc_time), len(nc_time) + len(new)), new)]
+        if overwrite:
+            existing = np.where(np.isin(time, nc_time))[0]
+            if len(existing) > 0:
+                idx = np.searchsorted(nc_time, time[existing])
+                order = np.argsort(idx)
+                idx, existing = idx[order], existing[order]
+                if idx[-1] - idx[0] == len(idx) - 1:
+                    idx = slice(int(idx[0]), int(idx[-1]) + 1)
+                writes.append((idx, existing))
+        for key, values in self.variables.items():
+            if time_label in values["dim"]:
+                var = nc.variables[key]
+                source = np.asarray(data[key])
+                for target, columns in writes:
+                    if len(values["dim"]) == 1:
+                        self.write_variable(var, target, source[columns], report)
+                    elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
+                        self.write_variable(var, (slice(None), target), source[:, columns], report)
+                    else:
+                        raise ValueError("Failed to write variable {} with dimensions: {} to file"
+                                         .format(key, ", ".join(values["dim"])))
+
     def mask_data(self):
         self.log.info("Masking L1 data.", indent=2)
         for var in self.variables:
@@ -291,8 +570,167 @@ class GenericInstrument:
                 self.data[key] = np.array(nc.variables[key][:])
 
 
+class ExportWriter:
+    """
+    Bounded pool of background threads writing the NetCDF exports (see GenericInstrument.export), so that the
+    processing continues while the files are written and compressed. At most max_pending exports are queued, submit
+    blocks when the queue is full. NetCDF files are written one at a time (NETCDF_LOCK, HDF5 is not thread-safe) and,
+    with one thread, in the order they were submitted. With threads=0, exports are written when submitted.
+
+    Parameters:
+        threads (int): number of writer threads
+        max_pending (int): maximum number of exports queued or being written
+    """
+    def __init__(self, threads=1, max_pending=4):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="export") if threads > 0 else False
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+
+    def submit(self, name, function, *args, **kwargs):
+        if not self.executor:
+            future = Future()
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            self.slots.acquire()
+            try:
+                future = self.executor.submit(function, *args, **kwargs)
+            except Exception:
+                self.slots.release()
+                raise
+            future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append((name, future))
+        return future
+
+    def flush(self, log):
+        """
+        Wait for all the submitted exports, log the failed ones and raise an error if any failed.
+
+        Returns:
+            output_files (list): output files of the exports, in the order they were submitted
+        """
+        output_files = []
+        failed = []
+        futures, self.futures = self.futures, []
+        for name, future in futures:
+            try:
+                output_files.extend(future.result())
+            except Exception:
+                log.warning("Failed to export {}:\n{}".format(name, traceback.format_exc()), indent=1)
+                failed.append(name)
+        if failed:
+            raise ValueError("{} of {} exports failed: {}".format(len(failed), len(futures), ", ".join(failed)))
+        return output_files
+
+
+class LogWriter:
+    """
+    Output of a logger: the lines are printed and appended to the log file through a single open handle, and the
+    structured records to a JSON-lines file. In the background, the lines are queued and written by a writer thread,
+    so that logging does not block the processing. The files are flushed whenever the queue is empty, on flush and on
+    close.
+
+    Parameters:
+        path (str): log file, =False to only print
+        json_path (str): JSON-lines file of the structured records, =False for none
+        background (bool): =True to write from a background thread, =False to write synchronously
+    """
+    def __init__(self, path=False, json_path=False, background=True):
+        self.file = open(path, "a") if path else False
+        self.json = open(json_path, "a") if json_path else False
+        self.queue = queue.SimpleQueue()
+        self.pid = os.getpid()
+        self.thread = False
+        if background:
+            self.thread = threading.Thread(target=self.run, name="logger", daemon=True)
+            self.thread.start()
+
+    def put(self, out, color=False, record=False, console=True):
+        if self.thread:
+            self.queue.put((out, color, record, console))
+        else:
+            self.output(out, color, record, console)
+            self.flush_files()
+
+    def output(self, out, color=False, record=False, console=True):
+        if console:
+            print(color + out + '\033[0m' if color else out)
+        if self.file:
+            self.file.write(out + "\n")
+        if self.json and record:
+            self.json.write(json.dumps(record, default=str) + "\n")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                self.flush_files()
+                item.set()
+                continue
+            try:
+                self.output(*item)
+            except Exception:
+                traceback.print_exc()
+            if self.queue.empty():
+                self.flush_files()
+        self.flush_files()
+
+    def flush_files(self):
+        for handle in [self.file, self.json]:
+            if handle:
+                handle.flush()
+
+    def flush(self):
+        """Wait until all the queued lines are written."""
+        if self.thread and self.thread.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+        else:
+            self.flush_files()
+
+    def close(self):
+        if os.getpid() != self.pid:
+            return  # Copy of the writer in a forked process, the lines are written by the parent
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        else:
+            while not self.queue.empty():  # Writer thread not running (e.g. in a forked process)
+                item = self.queue.get()
+                if isinstance(item, tuple):
+                    self.output(*item)
+        for handle in [self.file, self.json]:
+            if handle:
+                handle.close()
+        self.file = self.json = False
+
+
 class logger(object):
-    def __init__(self, path=False, time=True):
+    """
+    With a log file, the lines are written by a background writer thread (LogWriter) through a single open handle.
+    They are flushed on flush, error and end, and when the logger is garbage collected or the interpreter exits.
+    With structured, each line is also recorded as JSON in <log file>.jsonl, with the level, message, stage, elapsed
+    time [s] and the context set with set_context (e.g. file, instrument).
+
+    With metrics, the logger also measures the stages (begin_stage/end_stage, measure and the methods decorated with
+    measured): duration, peak RSS (see RSSSampler), data shape and bytes written, for each stage and each file. The
+    measurements are written with write_metrics to a JSON-lines file and a Prometheus textfile.
+
+    With a profiler (profiling.Profiler), the same stages are profiled with cProfile and tracemalloc.
+    """
+    def __init__(self, path=False, time=True, buffered=False, metrics=False, profiler=False, structured=False, background=True):
         if path != False:
             if os.path.exists(os.path.dirname(path)):
                 path.split(".")[0]
@@ -306,91 +744,279 @@ class logger(object):
         else:
             self.path = False
         self.stage = 1
+        self.stage_name = None
+        self.buffered = buffered
+        self.records = []
+        self.structured = structured
+        self.context = threading.local()
+        self.start_time = perf_counter()
+        self.writer = False
+        if not buffered:
+            # Without a log file, the lines are only printed, synchronously
+            self.writer = LogWriter(self.path, self.path[:-len(".log")] + ".jsonl" if self.path and structured else False,
+                                    background=background and bool(self.path))
+            weakref.finalize(self, self.writer.close)  # Also called at exit
+        self.metrics = metrics
+        self.profiler = profiler
+        self.measurements = []
+        self.started = datetime.now().timestamp()
+        self.current_stage = False
+        self.lock = threading.Lock()
+        self.sampler = RSSSampler()
+
+    def write(self, out, color=False, record=False, console=True):
+        if self.buffered:
+            self.records.append((out, color, record, console))
+            return
+        self.writer.put(out, color, record, console)
+
+    def replay(self, records):
+        for record in records:
+            self.write(*record)
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+
+    def set_context(self, **context):
+        """Context of the structured records of the current thread (e.g. file, instrument), None to remove a key."""
+        for key, value in context.items():
+            setattr(self.context, key, value)
+
+    def record(self, level, message, indent=0):
+        if not self.structured:
+            return False
+        record = {"time": datetime.now().isoformat(), "level": level, "message": message, "indent": indent,
+                  "stage": self.stage_name, "elapsed": round(perf_counter() - self.start_time, 6)}
+        record.update({key: value for key, value in vars(self.context).items() if value is not None})
+        return record
 
     def info(self, string, indent=0):
         out = datetime.now().strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + string
-        print(out)
-        if self.path:
-            with open(self.path, "a") as file:
-                file.write(out + "\n")
+        self.write(out, record=self.record("info", string, indent))
 
     def initialise(self, string):
+        # Start of a run, the stages, elapsed time and measurements restart (e.g. logger kept between runs)
+        self.stage = 1
+        self.stage_name = None
+        self.start_time = perf_counter()
+        self.started = datetime.now().timestamp()
+        with self.lock:
+            self.measurements = []
         out = "****** " + string + " ******"
-        print('\033[1m' + out + '\033[0m')
-        if self.path:
-            with open(self.path, "a") as file:
-                file.write(out + "\n")
+        self.write(out, '\033[1m', self.record("initialise", string))
 
     def begin_stage(self, string):
         self.newline()
         out = datetime.now().strftime("%H:%M:%S.%f") + "   Stage {}: ".format(self.stage) + string
         self.stage = self.stage + 1
-        print('\033[95m' + out + '\033[0m')
-        if self.path:
-            with open(self.path, "a") as file:
-                file.write(out + "\n")
+        self.stage_name = string
+        self.write(out, '\033[95m', self.record("begin_stage", string))
+        if self.metrics or self.profiler:
+            self.current_stage = self.measure(string)
+            self.current_stage.__enter__()
         return self.stage - 1
 
     def end_stage(self):
         out = datetime.now().strftime("%H:%M:%S.%f") + "   Stage {}: Completed.".format(self.stage - 1)
-        print('\033[92m' + out + '\033[0m')
-        if self.path:
-            with open(self.path, "a") as file:
-                file.write(out + "\n")
+        self.write(out, '\033[92m', self.record("end_stage", "Completed."))
+        self.stage_name = None
+        if self.current_stage:
+            self.current_stage.__exit__(None, None, None)
+            self.current_stage = False
 
     def warning(self, string, indent=0):
         out = datetime.now().strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + "WARNING: " + string
-        print('\033[93m' + out + '\033[0m')
-        if self.path:
-            with open(self.path, "a") as file:
-                file.write(out + "\n")
+        self.write(out, '\033[93m', self.record("warning", string, indent))
 
     def error(self, stage):
         out = datetime.now().strftime("%H:%M:%S.%f") + "   ERROR: Script failed on stage {}".format(stage)
-        print('\033[91m' + out + '\033[0m')
-        if self.path:
-            with open(self.path, "a") as file:
-                file.write(out + "\n")
-                file.write("\n")
-                traceback.print_exc(file=file)
+        record = self.record("error", "Script failed on stage {}".format(stage))
+        if record:
+            record["traceback"] = traceback.format_exc()
+        self.write(out, '\033[91m', record)
+        if self.path and not self.buffered:
+            self.write("\n" + traceback.format_exc().rstrip("\n"), console=False)
+        self.flush()
 
     def end(self, string):
         out = "****** " + string + " ******"
-        print('\033[92m' + out + '\033[0m')
-        if self.path:
-            with open(self.path, "a") as file:
-                file.write(out + "\n")
+        self.write(out, '\033[92m', self.record("end", string))
+        self.flush()
 
     def subprocess(self, process, error=""):
         failed = False
         while True:
             output = process.stdout.readline()
             out = output.strip()
-            print(out)
             if error != "" and error in out:
                 failed = True
-            if self.path:
-                with open(self.path, "a") as file:
-                    file.write(out + "\n")
+            self.write(out, record=self.record("subprocess", out))
             return_code = process.poll()
             if return_code is not None:
                 for output in process.stdout.readlines():
-                    out = output.strip()
-                    print(out)
-                    if self.path:
-                        with open(self.path, "a") as file:
-                            file.write(out + "\n")
+                    self.write(output.strip(), record=self.record("subprocess", output.strip()))
                 break
         return failed
 
     def newline(self):
-        print("")
-        if self.path:
-            with open(self.path, "a") as file:
-                file.write("\n")
+        self.write("")
+
+    @contextmanager
+    def measure(self, stage, file=False, shape=False):
+        """
+        Measure a stage when metrics are enabled, and profile it with a profiler. The yielded record can be completed
+        by the stage (e.g. shape, bytes). rss_peak is the largest RSS of the process sampled during the stage and
+        rss_peak_delta its growth from the start of the stage, stages running at the same time in other threads add to
+        it. Where /proc is not available, rss_peak_delta is the growth of ru_maxrss, the peak of the whole process,
+        which is 0 for the stages that do not exceed the largest previous stage.
+
+        Parameters:
+            stage (str): stage name
+            file (str): file processed by the stage, =False for stages of the whole run
+            shape (list): shape of the data processed by the stage (depth, time)
+        """
+        if not (self.metrics or self.profiler):
+            yield {}
+            return
+        record = {"stage": stage, "file": file if file else None, "start": datetime.now().timestamp(),
+                  "shape": list(shape) if shape else [], "bytes": 0}
+        unit = self.profiler.start(stage, file) if self.profiler else False
+        rss = current_rss() if self.metrics else None
+        sample = self.sampler.start(rss) if rss is not None else False
+        peak = peak_rss()
+        start = perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record["failed"] = True
+            raise
+        finally:
+            record["duration"] = perf_counter() - start
+            if unit:
+                self.profiler.stop(unit)
+            if sample:
+                record["rss_peak"] = self.sampler.stop(sample)
+                record["rss_peak_delta"] = record["rss_peak"] - rss
+            if self.metrics:
+                if not sample:
+                    record["rss_peak_delta"] = peak_rss() - peak
+                record["rss"] = current_rss()
+                record["cells"] = int(np.prod(record["shape"])) if record["shape"] else 0
+                with self.lock:
+                    self.measurements.append(record)
+
+    def add_measurements(self, measurements):
+        with self.lock:
+            self.measurements.extend(measurements)
+
+    def write_metrics(self, jsonl, textfile):
+        """
+        Append the measurements to a JSON-lines file (one record per stage and file, with the start of the run) and
+        write the totals of each stage to a Prometheus textfile (e.g. for the textfile collector of node_exporter).
+        """
+        with self.lock:
+            measurements, self.measurements = self.measurements, []
+        for path in [jsonl, textfile]:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(jsonl, "a") as f:
+            for record in measurements:
+                f.write(json.dumps(dict(record, run=self.started)) + "\n")
+
+        stages = {}
+        for record in measurements:
+            total = stages.setdefault(record["stage"], {"calls": 0, "failed": 0, "duration": 0., "rss": 0, "cells": 0, "bytes": 0})
+            total["calls"] += 1
+            total["failed"] += int(record.get("failed", False))
+            total["duration"] += record["duration"]
+            total["rss"] = max(total["rss"], record["rss_peak_delta"])
+            total["cells"] += record["cells"]
+            total["bytes"] += record["bytes"]
+        files = {record["file"] for record in measurements if record["file"]}
+        metrics = [("adcp_stage_calls_total", "counter", "Calls of the stage", "calls"),
+                   ("adcp_stage_failures_total", "counter", "Failed calls of the stage", "failed"),
+                   ("adcp_stage_duration_seconds_total", "counter", "Time spent in the stage", "duration"),
+                   ("adcp_stage_rss_peak_delta_bytes", "gauge", "Largest growth of the RSS during the stage", "rss"),
+                   ("adcp_stage_cells_total", "counter", "Depth x time cells processed by the stage", "cells"),
+                   ("adcp_stage_bytes_written_total", "counter", "Bytes of variables written by the stage", "bytes")]
+        lines = []
+        for name, kind, description, key in metrics:
+            lines.extend(["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, kind)])
+            for stage in sorted(stages):
+                lines.append('{}{{stage="{}"}} {}'.format(name, stage.replace('"', "'"), stages[stage][key]))
+        for name, kind, description, value in [
+                ("adcp_run_files", "gauge", "Files measured in the run", len(files)),
+                ("adcp_run_duration_seconds", "gauge", "Duration of the run", datetime.now().timestamp() - self.started),
+                ("adcp_run_peak_rss_bytes", "gauge", "Peak RSS of the process", peak_rss()),
+                ("adcp_run_timestamp_seconds", "gauge", "Start of the run", self.started)]:
+            lines.extend(["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, kind),
+                          "{} {}".format(name, value)])
+        tmp = textfile + ".tmp"  # Replaced atomically, so that the collector never reads a partial file
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, textfile)
+
+
+class RSSSampler:
+    """
+    Peak resident set size of the stages being measured, sampled every interval [s] by a background thread running
+    while stages are measured. Unlike ru_maxrss, the peak of the whole process which never decreases, it gives the
+    peak of each stage, e.g. of a file processed after a larger file. Allocations shorter than the interval can be
+    missed.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = False
+
+    def start(self, rss):
+        sample = [rss]
+        with self.lock:
+            self.active[id(sample)] = sample
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="rss-sampler", daemon=True)
+                self.thread.start()
+        return sample
+
+    def stop(self, sample):
+        rss = current_rss()
+        with self.lock:
+            self.active.pop(id(sample), None)
+            if rss is not None:
+                sample[0] = max(sample[0], rss)
+        return sample[0]
+
+    def run(self):
+        wait = threading.Event()
+        while True:
+            wait.wait(self.interval)
+            rss = current_rss()
+            with self.lock:
+                if not self.active:
+                    self.thread = False
+                    return
+                if rss is not None:
+                    for sample in self.active.values():
+                        sample[0] = max(sample[0], rss)
+
+
+def peak_rss():
+    """Peak resident set size of the process [B]."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss():
+    """Resident set size of the process [B], None where /proc is not available."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
 
 
 def get_bathymetry(file, depth):
+    import pandas as pd
     df_bath = pd.read_csv(file, header=0)
     df_bath["Isobath Area"] = df_bath["Isobath Area (m2)"].astype("float")
     df_bath["Depth"] = df_bath["Depth (m)"].astype("float")
@@ -413,18 +1039,28 @@ def pressure_correction(T,altitude):
     return press_corr
 
 def timeseries_quality_assurance(folder, period=365, time_label="time", datalakes=[], json_path="quality_assurance.json",
-                                 events="notes/events.csv", log=logger()):
+                                 events="notes/events.csv", log=logger(), catalog=False):
+    # With a catalog (catalog.FileCatalog), the files of folder (e.g. data/Level1/RDI600) overlapping the period are
+    # selected from the catalog instead of listing folder
     log.info("Running timeseries quality assurance for {}".format(folder), indent=1)
-    files = os.listdir(folder)
-    files.sort()
     cutoff = datetime.now() - timedelta(days=period)
     process = []
     log.info("Filtering files to the last {} days.".format(period), indent=2)
-    for file in files:
-        if datetime.strptime(file.split("_")[-2], '%Y%m%d') > cutoff:
-            process.append(os.path.join(folder, file))
+    if catalog:
+        folder = os.path.abspath(folder)
+        level = os.path.basename(os.path.dirname(folder)).replace("Level", "L")
+        for file in catalog.paths(os.path.basename(folder), level, start=cutoff.replace(tzinfo=timezone.utc)):
+            if os.path.dirname(file) == folder and file.endswith(".nc"):
+                process.append(file)
+    else:
+        files = os.listdir(folder)
+        files.sort()
+        for file in files:
+            if datetime.strptime(file.split("_")[-2], '%Y%m%d') > cutoff:
+                process.append(os.path.join(folder, file))
 
     log.info("Opening and merging {} files with xarray.".format(len(process)), indent=2)
+    import xarray as xr
     with xr.open_mfdataset(process, decode_times=False) as ds:
         log.info("Resetting QA to allow removal of conditions", indent=3)
         for var in ds.variables.keys():
@@ -445,6 +1081,7 @@ def timeseries_quality_assurance(folder, period=365, time_label="time", datalake
 
 def advanced_quality_flags(ds, json_path, log, time_label="time"):
     log.info("Applying advanced timeseries checks.", indent=2)
+    from envass import qualityassurance
     quality_assurance_dict = json_converter(json.load(open(json_path)))
     for var in quality_assurance_dict.keys():
         if var in quality_assurance_dict and var in ds and var + "_qual" in ds:
@@ -459,6 +1096,8 @@ def advanced_quality_flags(ds, json_path, log, time_label="time"):
 
 def event_quality_flags(ds, datalakes, events, log, time_label="time"):
     log.info("Applying manual timeseries checks.", indent=2)
+    import requests
+    import pandas as pd
     df = pd.read_csv(events, sep=";")
     df["start"] = df["start"].apply(lambda l: datetime.timestamp(datetime.strptime(l, '%Y%m%d %H:%M:%S').replace(tzinfo=timezone.utc)))
     df["stop"] = df["stop"].apply(lambda l: datetime.timestamp(datetime.strptime(l, '%Y%m%d %H:%M:%S').replace(tzinfo=timezone.utc)))
@@ -526,11 +1165,44 @@ def geographic_distance(latlng1, latlng2):
 def copy_variables(variables_dict):
     var_dict = dict()
     for var in variables_dict:
-        var_dict[var] = variables_dict[var][:]
+        var_dict[var] = np.ma.filled(np.ma.asarray(variables_dict[var][:], dtype=float), np.nan)
     nc_copy = copy.deepcopy(var_dict)
     return nc_copy
 
 
+def encode_values(values, dtype, fill_value=None, scale_factor=1., add_offset=0.):
+    """
+    Values to write to a variable as a masked array. NaNs are masked so they are written as the fill value of the
+    variable. For integer (packed) variables, the values outside of the range of the integer type are masked too.
+    """
+    values = np.ma.masked_invalid(np.asarray(values, dtype=float))
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        low, high = info.min, info.max
+        if fill_value == low:
+            low = low + 1
+        elif fill_value == high:
+            high = high - 1
+        packed = (values - add_offset) / scale_factor
+        mask = np.ma.getmaskarray(values) | np.ma.filled((packed < low - 0.5) | (packed > high + 0.5), True)
+        values = np.ma.masked_array(np.where(mask, 0., values.data), mask=mask)
+    return values
+
+
+def pack_values(values, encoding, packing):
+    """
+    Values packed in the dtype of the encoding (see GenericInstrument.variable_encoding), with the fill value for
+    NaNs and values outside of the range of the dtype.
+    """
+    dtype = encoding["datatype"]
+    scale_factor = packing.get("scale_factor", 1.)
+    add_offset = packing.get("add_offset", 0.)
+    values = encode_values(values, dtype, encoding["fill_value"], scale_factor, add_offset)
+    if dtype.kind in "iu":
+        values = np.round((values - add_offset) / scale_factor)
+    return np.ma.filled(values, encoding["fill_value"]).astype(dtype)
+
+
 def position_in_array(arr, value):
     for i in range(len(arr)):
         if value < arr[i]:
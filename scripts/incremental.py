@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+
+FINGERPRINT_BYTES = 4096  # Start of the file (first ensemble) included in the fingerprint
+
+
+class IncrementalState:
+    """
+    Per Level0 file record of what has already been processed, used to only decode the ensembles appended to a
+    growing .LTA file since the last run.
+
+    Each entry stores the byte offset of the end of the last complete ensemble processed ("end"), the number of
+    ensembles processed ("ensembles"), the byte offsets of the last ensembles kept as halo ("halo"), the start time
+    of the output files ("start"), the output files ("outputs"), the noise echo of the deployment ("Er") and a
+    fingerprint of the first bytes and of the halo bytes of the file ("fingerprint"), to detect files replaced on the
+    server.
+
+    Parameters:
+        path (str): JSON file where the state is stored
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.files = json.load(f)
+
+    def get(self, file):
+        entry = self.files.get(os.path.abspath(file), False)
+        if not entry:
+            return False
+        if (os.path.getsize(file) < entry["end"] or entry.get("fingerprint") != fingerprint(file, entry)
+                or not all(os.path.exists(f) for f in entry["outputs"])):
+            # File replaced or outputs removed, the file is processed from the start
+            return False
+        return entry
+
+    def set(self, file, entry):
+        entry["fingerprint"] = fingerprint(file, entry)
+        self.files[os.path.abspath(file)] = entry
+
+    def remove(self, file):
+        self.files.pop(os.path.abspath(file), None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.files, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def fingerprint(file, entry):
+    """
+    sha256 of the first FINGERPRINT_BYTES bytes of file and of its bytes from the first halo ensemble to the end of
+    the entry, which do not change when ensembles are appended.
+    """
+    h = hashlib.sha256()
+    start = entry["halo"][0] if entry["halo"] else 0
+    with open(file, "rb") as f:
+        h.update(f.read(min(FINGERPRINT_BYTES, entry["end"])))
+        f.seek(start)
+        h.update(f.read(entry["end"] - start))
+    return h.hexdigest()
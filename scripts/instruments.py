@@ -1,16 +1,48 @@
 # -*- coding: utf-8 -*-
 import os
-import netCDF4
 import numpy as np
-import xarray as xr
-import dolfyn as dlfn
 import distutils.util
 from functions import *
 from datetime import datetime
-from envass import qualityassurance
 from dateutil.relativedelta import relativedelta
-from general.functions import GenericInstrument
+from general.functions import GenericInstrument, measured
 from quality_checks_adcp import *
+from pd0 import read_pd0
+
+
+class ADCPData(dict):
+    """
+    Container for ADCP.data. The beam variables corr, prcnt_gd and echo are stored once, as (beam, range, time)
+    arrays of counts in their native uint8 dtype. The per-beam variables (corr1, ..., prcnt_gd4, echo1, ...) are not
+    stored: they are built on access, restricted to the valid depths and converted to floats in their usual units.
+    """
+    beam_variables = {"corr": 1 / 255., "prcnt_gd": 1., "echo": 1.} # Conversion factor from counts
+    range_variables = ["corr", "prcnt_gd"] # Stored for all range cells, restricted to depth_mask on access
+
+    def beam_key(self, key):
+        if isinstance(key, str) and key[-1:] in "1234":
+            name = key[:-1]
+            if name in self.beam_variables and dict.__contains__(self, name):
+                return name, int(key[-1]) - 1
+        return False
+
+    def __missing__(self, key):
+        beam = self.beam_key(key)
+        if not beam:
+            raise KeyError(key)
+        name, index = beam
+        values = dict.__getitem__(self, name)
+        if name in self.range_variables:
+            values = values[index, dict.__getitem__(self, "depth_mask"), :]
+        else:
+            values = values[index, :, :]
+        return values * self.beam_variables[name]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or bool(self.beam_key(key))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
 
 
 class ADCP(GenericInstrument):
@@ -65,9 +97,35 @@ class ADCP(GenericInstrument):
             'vel_mag': {'var_name': 'vel_mag', 'dim': ('depth', 'time'), 'unit': 'm/s', 'long_name': 'velocity magnitude'},
         }
 
-        self.data = {}
+        # NetCDF encoding of the variables (see GenericInstrument.variable_encoding): dtype, scale_factor/add_offset
+        # packing, chunks along each dimension (None for the full dimension) and compression level. Profiles are
+        # chunked whole in depth for time-slice access, time series in long chunks for time access.
+        profile = {"depth": None, "time": 256}
+        series = {"time": 8192}
+        velocity = {"dtype": "i2", "scale_factor": 0.001, "fill_value": -32768, "chunks": profile, "complevel": 4} # 1 mm s-1 resolution
+        self.encodings = {
+            'time': {"dtype": "f8", "chunks": series, "complevel": 4},
+            'depth': {"dtype": "f4", "chunks": {"depth": None}, "complevel": 4},
+            'u': velocity, 'v': velocity, 'w': velocity, 'eu': velocity, 'vel_mag': velocity,
+            'temp': {"dtype": "i2", "scale_factor": 0.01, "fill_value": -32768, "chunks": series, "complevel": 4},
+            'battery': {"dtype": "f4", "chunks": series, "complevel": 4},
+            'heading': {"dtype": "f4", "chunks": series, "complevel": 4},
+            'roll': {"dtype": "f4", "chunks": series, "complevel": 4},
+            'pitch': {"dtype": "f4", "chunks": series, "complevel": 4},
+            'mU': {"dtype": "f4", "chunks": series, "complevel": 4},
+            'mdir': {"dtype": "f4", "chunks": series, "complevel": 4},
+            'Sv': {"dtype": "f4", "chunks": profile, "complevel": 4},
+            '_qual': {"dtype": "u2", "fill_value": 65535, "chunks": profile, "complevel": 4}, # Bitmask of the quality checks
+        }
+        for beam in range(1, 5):
+            self.encodings['echo{}'.format(beam)] = {"dtype": "i2", "fill_value": -32768, "chunks": profile, "complevel": 4} # Counts
+            self.encodings['corr{}'.format(beam)] = {"dtype": "i2", "scale_factor": ADCPData.beam_variables["corr"], "fill_value": -32768, "chunks": profile, "complevel": 4} # Counts / 255
+            self.encodings['prcnt_gd{}'.format(beam)] = {"dtype": "i1", "fill_value": -128, "chunks": profile, "complevel": 4}
+
+        self.data = ADCPData()
 
-    def read_data(self, file, transducer_depth, bottom_depth=110., cabled=False, up=False, **kwargs):
+    @measured("read_data")
+    def read_data(self, file, transducer_depth, bottom_depth=110., cabled=False, up=False, cache=False, backend="dolfyn", **kwargs):
         """
         Read the ADCP data and store it in an ADCP object.
 
@@ -77,145 +135,154 @@ class ADCP(GenericInstrument):
             bottom_depth (float): total lake depth [m] (default: lake depth at the LéXPLORE platform)
             cabled (bool): =True is the ADCP is cable-linked, =False otherwise
             up (bool): =True is the ADCP is upward-looking, =False if the ADCP is downward-looking
+            cache (Level0Cache): cache of parsed Level0 files, =False to always parse the file
+            backend (str): Level0 reader, "dolfyn" or "pd0" (native reader of the PD0 format, see pd0.read_pd0)
     
         Additional arguments (**kwargs):
             start_date (str, %Y%m%d %H:%M format): starting time of the period to extract
             end_date (str, %Y%m%d %H:%M format): end time of the period to extract
-            
+            With the pd0 backend and no cache, only the ensembles of the period are decoded.
+            period (tuple of np.datetime64): measurement period (first and last ensembles with valid data, excluded)
+                determined beforehand, e.g. for the whole file when only a block of its ensembles is read
+
         Returns:
             True if the data was correctly read, False otherwise
         """
         
         self.log.info("Parsing data from {}.".format(file))
+        if not self.source:
+            self.source = file
 
         try:
-            dlfn_data = dlfn.read(file)
-            date= dlfn_data.time.data.astype('datetime64[s]')
-            time = date.astype('int')
+            window = [None, None]
+            if "start_date" in kwargs:
+                window[0] = np.datetime64(datetime.strptime(kwargs["start_date"], "%Y%m%d %H:%M"), "s")
+            if "end_date" in kwargs:
+                window[1] = np.datetime64(datetime.strptime(kwargs["end_date"], "%Y%m%d %H:%M"), "s")
+
+            parsed = False
+            selected = False
+            if cache:
+                parsed = cache.load(file)
+                if parsed:
+                    self.log.info("Using cached parsed data.", indent=1)
+            if not parsed and backend == "pd0" and not cache and "period" not in kwargs:
+                # Time window pushed down into the reader: only the ensembles of the measurement period are decoded
+                parsed = read_pd0(file, window=tuple(window))
+                selected = True
+            if not parsed:
+                parsed = self.parse_level0(file, backend=backend)
+                if cache:
+                    cache.store(file, *parsed)
+            raw, attrs = parsed
+            time = raw["time"].astype('int')
 
             if not isinstance(up, bool):
                 up = bool(distutils.util.strtobool(up))
             if not isinstance(cabled, bool):
                 cabled = bool(distutils.util.strtobool(cabled))
 
-            # Define the measurement period either from correlation>20% or from specified start and end dates:
-            idx = np.where(np.nanmean(np.nanmean(dlfn_data.corr/255.*100, axis=0), axis=0) > 20)[0]
-            start = date[idx[[0, -1]]]
-
-            date_subset = []
-            if "start_date" in kwargs:
-                start_date = datetime.strptime(kwargs["start_date"], "%Y%m%d %H:%M")
-                date_subset.append(max([start_date, start[0]]))
+            # Define the measurement period from correlation>20% and from specified start and end dates:
+            if selected:
+                idx_subset = slice(None)
+            elif "period" in kwargs:
+                idx_subset = (kwargs["period"][0] < raw["time"]) & (raw["time"] < kwargs["period"][1])
             else:
-                date_subset.append(start[0])
-            if "end_date" in kwargs:
-                end_date = datetime.strptime(kwargs["end_date"], "%Y%m%d %H:%M")
-                date_subset.append(min([end_date, start[1]]))
-            else:
-                date_subset.append(start[1])
-
-            time_subset = np.array(date_subset).astype('int')
-            idx_subset = (time_subset[0] < time) & (time < time_subset[1])
-
-            # Create a new dataset with the subset data:
-            dlfn_subset=xr.Dataset(coords={key: value.values for key, value in dlfn_data.coords.items() if key != "time"})
-            dlfn_subset=dlfn_subset.expand_dims({"time":dlfn_data.time.values[idx_subset]})
-            dlfn_subset=dlfn_subset.assign(timestamp=(["time"],time[idx_subset]))
-            for var in dlfn_data.variables:
-                dimvar=list(dlfn_data[var].dims)
-                if "time" in dimvar:
-                    dlfn_subset=dlfn_subset.assign({var:(dimvar,dlfn_data[var].isel(time=idx_subset).values)})
-            if dlfn_subset.time.size == 0:
+                corr_mean = raw["corr"].mean(axis=(0, 1)) / 255. * 100
+                idx_subset = measurement_period(raw["time"], np.where(corr_mean > 20)[0], *window)
+            if time[idx_subset].size == 0:
                 self.log.warning("No data found in file", indent=1)
                 return False
-            self.general_attributes["Er"] = np.nanmin(dlfn_subset.amp.values.astype(float))
+
+            # Subset the data in time:
+            vel = raw["vel"][..., idx_subset]
+            corr = raw["corr"][..., idx_subset]
+            amp = raw["amp"][..., idx_subset]
+            prcnt_gd = raw["prcnt_gd"][..., idx_subset]
+            self.general_attributes["Er"] = float(np.min(amp))
             self.general_attributes["cabled"] = str(cabled)
             self.general_attributes["up"] = str(up)
             self.general_attributes["bottom_depth"] = bottom_depth
             self.general_attributes["transducer_depth"] = transducer_depth
-            self.general_attributes["xmit_length"] = float(dlfn_data.attrs["transmit_pulse_m"]) # transmit pulse length [m] used for backscattering calculation
-            self.general_attributes["beam_angle"] = float(dlfn_data.attrs["beam_angle"]) 
-            self.general_attributes["blank_dist"] = float(dlfn_data.attrs["blank_dist"])
-            self.general_attributes["beam_freq"] = float(dlfn_data.attrs["freq"])
-            self.general_attributes["bandwidth"] = float(dlfn_data.attrs["bandwidth"])
+            self.general_attributes["xmit_length"] = float(attrs["transmit_pulse_m"]) # transmit pulse length [m] used for backscattering calculation
+            self.general_attributes["beam_angle"] = float(attrs["beam_angle"]) 
+            self.general_attributes["blank_dist"] = float(attrs["blank_dist"])
+            self.general_attributes["beam_freq"] = float(attrs["freq"])
+            self.general_attributes["bandwidth"] = float(attrs["bandwidth"])
             
             if up:
-                z0 = transducer_depth - dlfn_subset.range.values
+                z0 = transducer_depth - raw["range"]
             else:
-                z0 = transducer_depth + dlfn_subset.range.values
+                z0 = transducer_depth + raw["range"]
             depth_mask = z0 > 0
+            self.data["depth_mask"] = depth_mask
             self.data["depth"] = z0[depth_mask]
-            self.data["zrange"] =dlfn_subset.range.values[depth_mask] # Range values
-            self.data["eu"] = dlfn_subset.vel[3, depth_mask, :].values # Velocity error
-            self.data["corr"] = dlfn_subset.corr.values.astype(float)/255.
-            self.data["corr1"] = self.data["corr"][0, depth_mask, :]
-            self.data["corr2"] = self.data["corr"][1, depth_mask, :]
-            self.data["corr3"] = self.data["corr"][2, depth_mask, :]
-            self.data["corr4"] = self.data["corr"][3, depth_mask, :]
-            self.data["prcnt_gd"] = dlfn_subset.prcnt_gd.values.astype(float)
-            self.data["prcnt_gd1"] = self.data["prcnt_gd"][0, depth_mask, :]
-            self.data["prcnt_gd2"] = self.data["prcnt_gd"][1, depth_mask, :]
-            self.data["prcnt_gd3"] = self.data["prcnt_gd"][2, depth_mask, :]
-            self.data["prcnt_gd4"] = self.data["prcnt_gd"][3, depth_mask, :]
-            self.data["heading"] = dlfn_subset.heading.values
-            self.data["roll"] = dlfn_subset["roll"].values
-            self.data["pitch"] = dlfn_subset.pitch.values
-            self.data["time"] = dlfn_subset.timestamp.values.astype(float)
-            self.data["u"] = dlfn_subset.vel[0, depth_mask, :].values # Eastward velocity
-            self.data["v"] = dlfn_subset.vel[1, depth_mask, :].values # Northward velocity
-            self.data["w"] = dlfn_subset.vel[2, depth_mask, :].values # Upward velocity
-            echo = dlfn_subset.amp.values.astype(float)[:, depth_mask, :]
-            self.data["echo"] = echo
-            self.data["echo1"] = echo[0, :, :]
-            self.data["echo2"] = echo[1, :, :]
-            self.data["echo3"] = echo[2, :, :]
-            self.data["echo4"] = echo[3, :, :]
+            self.data["zrange"] = raw["range"][depth_mask] # Range values
+            self.data["eu"] = vel[3, depth_mask, :] # Velocity error
+            self.data["corr"] = corr.astype(np.uint8, copy=False) # Counts, corr1 to corr4 are derived on access [0-1]
+            self.data["prcnt_gd"] = prcnt_gd.astype(np.uint8, copy=False) # prcnt_gd1 to prcnt_gd4 are derived on access
+            self.data["heading"] = raw["heading"][idx_subset]
+            self.data["roll"] = raw["roll"][idx_subset]
+            self.data["pitch"] = raw["pitch"][idx_subset]
+            self.data["time"] = time[idx_subset].astype(float)
+            self.data["u"] = vel[0, depth_mask, :] # Eastward velocity
+            self.data["v"] = vel[1, depth_mask, :] # Northward velocity
+            self.data["w"] = vel[2, depth_mask, :] # Upward velocity
+            self.data["echo"] = amp.astype(np.uint8, copy=False)[:, depth_mask, :] # echo1 to echo4 are derived on access
             # Battery not available in the new dolfyn version
             self.data["battery"]=np.full(self.data["roll"].shape,np.nan)
-            self.data["temp"]=dlfn_subset.temp.values
+            self.data["temp"]=raw["temp"][idx_subset]
             self.dimensions["depth"]["dim_size"] = len(self.data["depth"])
             return True
         except:
             self.log.info("Failed to process {}.".format(file))
             return False
 
+    def parse_level0(self, file, backend="dolfyn"):
+        """
+        Parse a Level0 file with dolfyn and keep only the variables and attributes used by the processing.
+
+        Parameters:
+            file (str): path and ADCP filename (e.g., .LTA file)
+            backend (str): "dolfyn", or "pd0" to decode the file with pd0.read_pd0 instead of dolfyn
+        Returns:
+            raw (dict of np.arrays): time (datetime64[s]), range and the (beam, range, time) or (time) variables
+            attrs (dict): instrument attributes
+        """
+        if backend == "pd0":
+            return read_pd0(file)
+        import dolfyn as dlfn  # Only needed for the dolfyn backend
+        dlfn_data = dlfn.read(file)
+        raw = {"time": dlfn_data.time.data.astype('datetime64[s]'), "range": dlfn_data.range.values}
+        for var in ["vel", "corr", "amp", "prcnt_gd", "heading", "roll", "pitch", "temp"]:
+            raw[var] = dlfn_data[var].values
+        attrs = {key: dlfn_data.attrs[key] for key in ["transmit_pulse_m", "beam_angle", "blank_dist", "freq", "bandwidth"]}
+        return raw, attrs
+
+    def select_time(self, index):
+        """
+        Keep only some ensembles of the data, e.g. to drop the halo of a block of a file processed in chunks.
+
+        Parameters:
+            index (np.array of bools or slice): ensembles to keep
+        """
+        for key in list(self.data.keys()):
+            if key not in ["depth", "depth_mask", "zrange"]:  # All the other variables have time as last dimension
+                self.data[key] = self.data[key][..., index]
+
+    @measured("quality_flags")
     def quality_flags(self, envass_file = './quality_assurance.json', adcp_file='./quality_specific_adcp.json', simple=True):
 
         self.log.info("Performing quality assurance", indent=1)
         self.log.info("ADCP-specific quality checks",indent=2) # Additional ADCP tests on the velocity matrix, increases qa with a base-2 approach (check#2 returns 0 or 2, chech#3 returns 0 or 4, etc.)
         quality_adcp_dict = json_converter(json.load(open(adcp_file))) # Load parameters related to simple and advanced quality checks
         
-        varname0=quality_adcp_dict["variables"][0]
-        qa_adcp=init_flag_adcp(np.array(self.data[varname0])) # Initial qa array (zero values)
-        
-        if "interface" in quality_adcp_dict["tests"].keys():
-            if self.general_attributes['up']=='True': # Upward looking: surface detection
-                qa_adcp=qa_adcp_interface_top(qa_adcp,self.data["depth"],self.general_attributes['transducer_depth'],beam_angle=self.general_attributes["beam_angle"])
-            else: # Downward looking: sediment detection
-                qa_adcp=qa_adcp_interface_bottom(qa_adcp,self.data["depth"],self.general_attributes['transducer_depth'],self.general_attributes['bottom_depth'],beam_angle=self.general_attributes["beam_angle"])
-        
-        if "corr" in quality_adcp_dict["tests"].keys():
-            qa_adcp=qa_adcp_corr(qa_adcp,self.data["corr1"],self.data["corr2"],self.data["corr3"],self.data["corr4"],corr_threshold=quality_adcp_dict["tests"]["corr"]["corr_threshold"])
-        
-        if "PG14" in quality_adcp_dict["tests"].keys():
-            qa_adcp=qa_adcp_PG14(qa_adcp,self.data["prcnt_gd1"],self.data["prcnt_gd4"],percentage_threshold=quality_adcp_dict["tests"]["PG14"]["percentage_threshold"])
-        
-        if "PG3" in quality_adcp_dict["tests"].keys():
-            qa_adcp=qa_adcp_PG3(qa_adcp,self.data["prcnt_gd3"],percentage_threshold=quality_adcp_dict["tests"]["PG3"]["percentage_threshold"])
-        
-        if "velerror" in quality_adcp_dict["tests"].keys():
-            qa_adcp=qa_adcp_velerror(qa_adcp,self.data["eu"],vel_threshold=quality_adcp_dict["tests"]["velerror"]["vel_threshold"])
-        
-        if "tilt" in quality_adcp_dict["tests"].keys():
-            qa_adcp=qa_adcp_tilt(qa_adcp,self.data["roll"],self.data["pitch"],tilt_threshold=quality_adcp_dict["tests"]["tilt"]["tilt_threshold"])
-        
-        if "corrstd" in quality_adcp_dict["tests"].keys():
-            qa_adcp=qa_adcp_corrstd(qa_adcp,self.data["corr1"],self.data["corr2"],self.data["corr3"],self.data["corr4"],std_threshold=quality_adcp_dict["tests"]["corrstd"]["std_threshold"])
-        
-        if "echodiff" in quality_adcp_dict["tests"].keys():
-            qa_adcp=qa_adcp_echodiff(qa_adcp,self.data["echo1"],self.data["echo2"],self.data["echo3"],self.data["echo4"],diff_threshold=quality_adcp_dict["tests"]["echodiff"]["diff_threshold"])
-        
+        qa_adcp=qa_adcp_bitmask(quality_adcp_dict["tests"],self.data["corr"],self.data["prcnt_gd"],self.data["echo"],self.data["eu"],self.data["roll"],self.data["pitch"],
+                                self.data["depth"],self.general_attributes['transducer_depth'],self.general_attributes['bottom_depth'],self.general_attributes["beam_angle"],
+                                up=self.general_attributes['up']=='True',depth_mask=self.data["depth_mask"],corr_scale=ADCPData.beam_variables["corr"]) # Compact uint16 bitmask, one bit per test
+
         self.log.info("envass quality checks", indent=2) # Corresponds to quality check #1: qa is 0 (all good) or 1 (flagged)
+        from envass import qualityassurance # Loads pandas, scikit-learn and plotly, only needed for the QA
         quality_assurance_dict = json_converter(json.load(open(envass_file))) # Load parameters related to simple and advanced quality checks
         
         for key, values in self.variables.copy().items():
@@ -225,17 +292,20 @@ class ADCP(GenericInstrument):
                                         'unit': '0 = nothing to report, 1 = more investigation',
                                         'long_name': name, }
                 if key in quality_adcp_dict["variables"] and self.data[key].shape==qa_adcp.shape:
-                    prior_qa=qa_adcp
+                    qual=qa_adcp.copy()
                 else:
-                    prior_qa=np.zeros(self.data[key].shape)
+                    qual=np.zeros(self.data[key].shape, dtype=np.uint16)
                 if simple: # Simple quality check only
-                    self.data[name] = prior_qa+qualityassurance(np.array(self.data[key]), np.array(self.data["time"]), **quality_assurance_dict[key]["simple"])
+                    qa=qualityassurance(np.array(self.data[key]), np.array(self.data["time"]), **quality_assurance_dict[key]["simple"])
                 else:
                     quality_assurance_all = dict(quality_assurance_dict[key]["simple"], **quality_assurance_dict[key]["advanced"])
-                    self.data[name] = prior_qa+qualityassurance(np.array(self.data[key]), np.array(self.data["time"]), **quality_assurance_all)
+                    qa=qualityassurance(np.array(self.data[key]), np.array(self.data["time"]), **quality_assurance_all)
+                np.add(qual, qa, out=qual, casting="unsafe") # Flag #1 from envass, added in place to the ADCP bitmask
+                self.data[name] = qual
                
 
 
+    @measured("derive_variables")
     def derive_variables(self, rotate_velocity):
         self.log.info("Computing derived variables.", indent=1)
         self.variables.update(self.derived_variables)
@@ -251,9 +321,10 @@ class ADCP(GenericInstrument):
         self.data["u"], self.data["v"] = perform_rotate_velocity(self.data["u"], self.data["v"], rotate_velocity)
 
         self.log.info("Smooth data with moving average filter", indent=2)
-        self.data["u"] = moving_average_filter(self.data["u"])
-        self.data["v"] = moving_average_filter(self.data["v"])
-        self.data["w"] = moving_average_filter(self.data["w"])
+        with self.log.measure("moving_average_filter", self.source, self.data_shape()):
+            self.data["u"] = moving_average_filter(self.data["u"])
+            self.data["v"] = moving_average_filter(self.data["v"])
+            self.data["w"] = moving_average_filter(self.data["w"])
 
         self.data["vel_mag"] = (self.data["u"] ** 2 + self.data["v"] ** 2) ** 0.5
 
@@ -1,22 +1,331 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import shutil
 import argparse
+import tempfile
+import traceback
+import numpy as np
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from instruments import ADCP
-from general.functions import logger, files_in_directory
-from functions import retrieve_new_files, select_parameters
+from general.functions import logger, files_in_directory, ExportWriter
+from functions import retrieve_new_files, select_parameters, server_transfers, transfer_connection, download_file
+from cache import Level0Cache
+from pd0 import ensemble_offsets
+from incremental import IncrementalState
+from aggregates import AggregatePyramid, RESOLUTIONS, merge_statistics
+from catalog import FileCatalog
+from dependencies import DependencyGraph, qa_hash
+from stream import Stage, run_stages
+from profiling import Profiler
 
-def main(server=False, logs=False):
+INCREMENTAL_HALO = 8  # Trailing NaNs of the moving average filter (n=7) minus one, plus the first and last ensembles dropped by read_data
+MOVING_AVERAGE_HALO = 6  # Ensembles after a block used by the moving average filter (n=7) of its last ensembles
+STREAM_WORKERS = {"fetch": 4, "read": 2, "qa": 1, "export_l1": 1, "derive": 2, "export_l2": 1, "upload": 4}
+LOGGERS = {}  # Loggers kept between runs in the same process (watch mode), so that a log file is written per process
+
+
+def process_file(file, parameter_dict, directories, repo, log, read_options={}, state=False, offsets=False, end=False, read_file=False, writer=False, zarr=False, aggregates=False, catalog=False):
+    # With a writer, the exports are written in the background and their output files are returned by writer.flush.
+    # Returns the edited files and =False if the Level0 data could not be read.
+    edited_files = []
+    sensor = ADCP(log=log)
+    sensor.source = file
+    p = select_parameters(file, parameter_dict)
+    log.set_context(file=file, instrument=p["name"])
+    entry = state.get(file) if read_file else False
+    export = {"output_period": "file", "remove_existing": True, "zarr_store": zarr, "catalog": catalog}
+    if entry:
+        export = {"output_period": "file", "overwrite": True, "start": datetime.fromtimestamp(entry["start"], tz=timezone.utc), "zarr_store": zarr, "catalog": catalog}
+    if read_file:
+        read_options = dict(read_options, cache=False)
+    if sensor.read_data(read_file if read_file else file, transducer_depth=p["transducer_depth"], bottom_depth=p["bottom_depth"], cabled=p["cabled"], up=p["up"], **read_options):
+        if entry:
+            sensor.general_attributes["Er"] = entry["Er"]
+        sensor.parameters = p
+        if catalog:
+            catalog.record(file, p["name"], "L0", np.nanmin(sensor.data["time"]), np.nanmax(sensor.data["time"]),
+                           np.nanmin(sensor.data["depth"]), np.nanmax(sensor.data["depth"]), parameters=p, merge=bool(entry))
+        sensor.quality_flags(envass_file=os.path.join(repo, "notes/quality_assurance.json"), adcp_file=os.path.join(repo, 'notes/quality_specific_adcp.json'))
+        outputs = [sensor.export(os.path.join(directories["Level1"], p["name"]), "L1_ADCP", writer=writer, **export)]
+        sensor.mask_data()
+        sensor.derive_variables(p["rotate_velocity"])
+        outputs.append(sensor.export(os.path.join(directories["Level2"], p["name"]), "L2_ADCP", writer=writer, **export))
+        if not writer:
+            edited_files = outputs[0] + outputs[1]
+        if aggregates:
+            # The decoded halo covers the hours of the recomputed ensembles, see incremental_halo
+            since = np.nanmin(sensor.data["time"]) + RESOLUTIONS["hourly"] if entry else None
+            pyramid = AggregatePyramid(os.path.join(directories["Level2"], p["name"], "aggregates"), "L2_ADCP", log=log)
+            edited_files.extend(pyramid.update(sensor.data, sensor.variables, source=file, since=since))
+        if state:
+            state.set(file, {"end": end,
+                             "ensembles": entry["ensembles"] - len(entry["halo"]) + len(offsets) if entry else len(offsets),
+                             "halo": offsets[-incremental_halo(sensor.data["time"]):].tolist(),
+                             "start": entry["start"] if entry else float(np.nanmin(sensor.data["time"])),
+                             "outputs": entry["outputs"] if entry else edited_files,
+                             "Er": float(sensor.general_attributes["Er"])})
+        return edited_files, True
+    return edited_files, False
+
+
+def incremental_halo(time):
+    # Ensembles decoded again by the next incremental run: INCREMENTAL_HALO plus one hour of ensembles, so that the
+    # hourly aggregates of the recomputed ensembles are updated from all their samples
+    interval = np.nanmedian(np.diff(time)) if len(time) > 1 else np.nan
+    return INCREMENTAL_HALO + (int(np.ceil(RESOLUTIONS["hourly"] / interval)) if interval > 0 else 0)
+
+
+def process_file_incremental(file, parameter_dict, directories, repo, log, state, read_options={}, zarr=False, aggregates=False, catalog=False):
+    # Only decodes the ensembles appended since the last run, plus a halo of previous ensembles so that the first
+    # ensemble dropped by read_data and the trailing NaNs of the moving average filter are recomputed and overwritten.
+    entry = state.get(file)
+    start = entry["halo"][0] if entry else 0
+    offsets, end = ensemble_offsets(file, start=start)
+    if entry and end <= entry["end"]:
+        log.info("No new ensembles in {}.".format(file))
+        return [], True
+    if not entry:
+        return process_file(file, parameter_dict, directories, repo, log, read_options, state=state, offsets=offsets, end=end, zarr=zarr, aggregates=aggregates, catalog=catalog)
+
+    log.info("Decoding {} new ensembles of {} from byte {}.".format(len(offsets) - len(entry["halo"]), file, start))
+    folder = tempfile.mkdtemp()
+    try:
+        chunk = copy_bytes(file, start, end, folder)
+        edited_files, success = process_file(file, parameter_dict, directories, repo, log, read_options, state=state, offsets=offsets, end=end, read_file=chunk, zarr=zarr, aggregates=aggregates, catalog=catalog)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return edited_files, success
+
+
+def process_file_chunked(file, parameter_dict, directories, repo, log, read_options={}, block=4320, zarr=False, aggregates=False, catalog=False):
+    """
+    Process a Level0 file in blocks of ensembles, so that the memory used does not depend on the length of the file.
+
+    A first pass decodes the blocks to find the measurement period (see functions.measurement_period) and the noise
+    echo Er of the whole file from per-ensemble statistics. The second pass reads each block with a halo of
+    ensembles on both sides, applies the quality checks, exports the block to Level1, masks, derives the variables
+    and exports the block to Level2 without the halo. The halo covers the moving average filter and the rolling
+    windows of the QA configuration, so the results are identical to processing the whole file at once. The Level0
+    data is decoded twice.
+
+    Parameters:
+        block (int): number of ensembles processed at once (e.g. 4320 for 30 days of 10 min ensembles)
+    Returns:
+        edited_files (list): output files
+        success (bool): =False if the Level0 data could not be read
+    """
+    p = select_parameters(file, parameter_dict)
+    log.set_context(file=file, instrument=p["name"])
+    envass_file = os.path.join(repo, "notes/quality_assurance.json")
+    adcp_file = os.path.join(repo, 'notes/quality_specific_adcp.json')
+    halo = max(MOVING_AVERAGE_HALO, qa_window(envass_file))
+    read_options = dict(read_options, cache=False)
+    offsets, end = ensemble_offsets(file)
+    if len(offsets) == 0:
+        log.warning("No complete ensemble found in {}.".format(file))
+        return [], False
+    bounds = np.append(offsets, end)
+    folder = tempfile.mkdtemp()
+    edited_files = []
+    statistics = False
+    pyramid = AggregatePyramid(os.path.join(directories["Level2"], p["name"], "aggregates"), "L2_ADCP", log=log)
+    try:
+        log.info("Scanning {} ensembles of {} in blocks of {}.".format(len(offsets), file, block))
+        time, corr_mean, amp_min = [], [], []
+        for i in range(0, len(offsets), block):
+            chunk = copy_bytes(file, bounds[i], bounds[min(i + block, len(offsets))], folder)
+            raw, attrs = ADCP(log=log).parse_level0(chunk, backend=read_options.get("backend", "dolfyn"))
+            if len(raw["time"]) != min(block, len(offsets) - i):
+                raise ValueError("Decoded {} ensembles instead of {} from byte {} of {}".format(len(raw["time"]), min(block, len(offsets) - i), bounds[i], file))
+            time.append(raw["time"])
+            corr_mean.append(raw["corr"].mean(axis=(0, 1)) / 255. * 100)
+            amp_min.append(raw["amp"].min(axis=(0, 1)))
+            del raw
+        time, corr_mean, amp_min = np.concatenate(time), np.concatenate(corr_mean), np.concatenate(amp_min)
+        valid = np.where(corr_mean > 20)[0]
+        if len(valid) == 0:
+            log.warning("No data found in file", indent=1)
+            return [], False
+        period = (time[valid[0]], time[valid[-1]])
+        inside = np.where((period[0] < time) & (time < period[1]))[0]
+        if len(inside) == 0:
+            log.warning("No data found in file", indent=1)
+            return [], False
+        er = float(np.min(amp_min[inside]))
+
+        start = False
+        for i in range(0, len(inside), block):
+            core = inside[i:i + block]
+            chunk = copy_bytes(file, bounds[max(core[0] - halo, 0)], bounds[min(core[-1] + 1 + halo, len(offsets))], folder)
+            log.info("Processing ensembles {} to {} of {}.".format(core[0], core[-1], file))
+            sensor = ADCP(log=log)
+            sensor.source = file
+            sensor.parameters = p
+            if not sensor.read_data(chunk, transducer_depth=p["transducer_depth"], bottom_depth=p["bottom_depth"], cabled=p["cabled"], up=p["up"], period=period, **read_options):
+                log.warning("Failed to read ensembles {} to {} of {}.".format(core[0], core[-1], file), indent=1)
+                return list(dict.fromkeys(edited_files)), False
+            sensor.general_attributes["Er"] = er
+            sensor.quality_flags(envass_file=envass_file, adcp_file=adcp_file)
+            keep = (sensor.data["time"] >= time[core[0]].astype(int)) & (sensor.data["time"] <= time[core[-1]].astype(int))
+            export = {"output_period": "file", "zarr_store": zarr, "catalog": catalog}
+            export.update({"overwrite": True, "start": start} if start else {"remove_existing": True})
+            level1 = sensor.snapshot()
+            level1.select_time(keep)
+            if not start:
+                start = datetime.fromtimestamp(np.nanmin(level1.data["time"]), tz=timezone.utc)  # Later blocks are appended
+            edited_files.extend(level1.export(os.path.join(directories["Level1"], p["name"]), "L1_ADCP", **export))
+            del level1
+            sensor.mask_data()
+            sensor.derive_variables(p["rotate_velocity"])
+            sensor.select_time(keep)
+            edited_files.extend(sensor.export(os.path.join(directories["Level2"], p["name"]), "L2_ADCP", **export))
+            if aggregates:
+                statistics = merge_statistics(statistics, pyramid.statistics(sensor.data))
+        if aggregates:
+            # The blocks share their first and last hours, the file replaces its contribution at once
+            edited_files.extend(pyramid.update_statistics(statistics, sensor.variables, source=file))
+        if catalog:
+            catalog.record(file, p["name"], "L0", float(time[inside[0]].astype(int)), float(time[inside[-1]].astype(int)),
+                           np.nanmin(sensor.data["depth"]), np.nanmax(sensor.data["depth"]), parameters=p, merge=False)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return list(dict.fromkeys(edited_files)), True
+
+
+def copy_bytes(file, start, end, folder):
+    # Copy of the bytes start to end of file (e.g. a range of complete ensembles) in folder, with the same name
+    chunk = os.path.join(folder, os.path.basename(file))
+    with open(file, "rb") as f, open(chunk, "wb") as c:
+        f.seek(start)
+        c.write(f.read(end - start))
+    return chunk
+
+
+def qa_window(envass_file):
+    # Largest rolling window [samples] of the tests of the QA configuration, 0 without rolling tests
+    with open(envass_file, "r") as f:
+        config = json.load(f)
+    windows = [0]
+
+    def search(value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if "window" in key.lower() and isinstance(item, (int, float)) and not isinstance(item, bool):
+                    windows.append(int(np.ceil(item)))
+                else:
+                    search(item)
+        elif isinstance(value, list):
+            for item in value:
+                search(item)
+    search(config)
+    return max(windows)
+
+
+def process_file_worker(file, parameter_dict, directories, repo, read_options={}, zarr=False, aggregates=False, catalog=False, metrics=False, profile=False, structured=False):
+    # Runs in a worker process, logs, metrics and profiles are buffered and returned to be written in file order by the
+    # main process. profile is the folder of the profiles.
+    log = logger(buffered=True, metrics=metrics, profiler=Profiler(profile) if profile else False, structured=structured)
+    try:
+        with log.measure("process_file", file):
+            edited_files, success = process_file(file, parameter_dict, directories, repo, log, read_options, zarr=zarr, aggregates=aggregates, catalog=catalog)
+        error = False if success else "Failed to read {}".format(file)
+    except Exception:
+        edited_files, error = [], traceback.format_exc()
+    return edited_files, log.records, error, log.measurements, log.profiler.units if log.profiler else []
+
+
+def process_files_parallel(files, parameter_dict, directories, repo, log, workers, read_options={}, zarr=False, aggregates=False, catalog=False):
+    log.info("Processing {} files with {} workers".format(len(files), workers))
+    results = {}
+    pending = list(files)
+    retried = False
+    while pending:
+        crashed = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {file: executor.submit(process_file_worker, file, parameter_dict, directories, repo, read_options, zarr, aggregates, catalog, log.metrics, log.profiler.folder if log.profiler else False, log.structured) for file in pending}
+            for file in pending:
+                try:
+                    results[file] = futures[file].result()
+                except BrokenProcessPool:
+                    crashed.append(file)
+        if crashed and not retried:
+            log.warning("Worker process crashed, retrying {} unfinished files.".format(len(crashed)))
+            pending = crashed
+            retried = True
+        else:
+            for file in crashed:
+                results[file] = ([], [], "Worker process crashed while processing {}".format(file), [], [])
+            pending = []
+
+    edited_files = []
+    failed = []
+    for file in files:
+        edited, records, error, measurements, profiles = results[file]
+        log.replay(records)
+        log.add_measurements(measurements)
+        if log.profiler:
+            log.profiler.units.extend(profiles)
+        if error:
+            log.warning("Failed to process {}:\n{}".format(file, error), indent=1)
+            failed.append(file)
+        edited_files.extend(edited)
+    return edited_files, failed
+
+
+def level0_files(directories, catalog, log):
+    # Level0 files, selected from the catalog when it has Level0 files (recorded when they are downloaded or processed
+    # with a catalog) instead of walking the Level0 folder
+    if catalog:
+        removed = catalog.remove_missing()
+        if removed:
+            log.info("Removed {} missing files from the catalog.".format(len(removed)), indent=1)
+        files = [f for f in catalog.paths(level="L0") if f.startswith(os.path.abspath(directories["Level0"]) + os.sep)]
+        if files:
+            log.info("Selected {} Level0 files from the catalog.".format(len(files)), indent=1)
+            return sorted(files)
+    return sorted(files_in_directory(directories["Level0"]))
+
+
+def select_outdated(files, parameter_dict, graph, qa, log, incremental=False):
+    # Files whose Level0 content, matched mooring parameters or QA configuration changed since they were processed.
+    # Files without parameters are kept so that processing reports the error.
+    selected = []
+    dependencies = {}
+    for file in files:
+        try:
+            p = select_parameters(file, parameter_dict)
+        except ValueError:
+            selected.append(file)
+            continue
+        file_dependencies = graph.dependencies(file, p, qa)
+        reasons = graph.outdated(file, file_dependencies)
+        if reasons:
+            log.info("{}: {}".format(file, ", ".join(reasons)), indent=1)
+            selected.append(file)
+            dependencies[file] = file_dependencies
+            if incremental and set(reasons) != {"input"}:
+                incremental.remove(file)  # Processed from the start, not only the appended ensembles
+    log.info("{} of {} files to process.".format(len(selected), len(files)))
+    return selected, dependencies
+
+
+def main(server=False, logs=False, workers=1, cache=False, incremental=False, backend="dolfyn", writers=1, zarr=False, aggregates=False, changed=False, metrics=False, profile=False, json_logs=False, chunk=False, catalog=False):
     repo = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    if logs:
-        log = logger(os.path.join(repo, "logs/adcp"))
-    else:
-        log = logger()
+    profiler = Profiler(os.path.join(repo, "logs/adcp/profiles")) if profile else False
+    log = run_logger(repo, logs, metrics, profiler, json_logs)
     log.initialise("Processing LéXPLORE ADCP data")
     directories = {f: os.path.join(repo, "data", f) for f in ["Level0", "Level1", "Level2"]}
     for directory in directories:
         os.makedirs(directories[directory], exist_ok=True)
     edited_files = []
+    read_options = {"cache": Level0Cache(os.path.join(repo, "cache", "level0")) if cache else False, "backend": backend}
+    if catalog:
+        catalog = FileCatalog(os.path.join(repo, "cache", "catalog.sqlite"))
+    if incremental:
+        incremental = IncrementalState(os.path.join(repo, "cache", "incremental.json"))
 
     log.begin_stage("Collecting mooring parameters")
     with open(os.path.join(repo, 'notes/parameters.json'), 'r') as f:
@@ -30,31 +339,209 @@ def main(server=False, logs=False):
             raise ValueError("Credential file required to retrieve live data from the fstp server.")
         with open(os.path.join(repo, "creds.json"), 'r') as f:
             creds = json.load(f)
-        files = retrieve_new_files(directories["Level0"], creds, server_location=["data/ADCP_300", "data/ADCP_600", "data/ADCP_300_up"], filetype=".LTA")
+        files = retrieve_new_files(directories["Level0"], creds, server_location=["data/ADCP_300", "data/ADCP_600", "data/ADCP_300_up"], filetype=".LTA", log=log, catalog=catalog)
         edited_files = edited_files + files
     else:
-        files = files_in_directory(directories["Level0"])
-        files.sort()
+        files = level0_files(directories, catalog, log)
         log.info("Reprocessing complete dataset from {}".format(directories["Level0"]))
+    if changed:
+        log.info("Selecting Level0 files with changed inputs")
+        graph = DependencyGraph(os.path.join(repo, "cache", "dependencies.json"))
+        qa = qa_hash(os.path.join(repo, "notes/quality_assurance.json"), os.path.join(repo, 'notes/quality_specific_adcp.json'), ADCP().variables)
+        files = level0_files(directories, catalog, log)
+        files, dependencies = select_outdated(files, parameter_dict, graph, qa, log, incremental)
     log.end_stage()
 
     log.begin_stage("Processing data")
-    for file in files:
-        sensor = ADCP(log=log)
-        p = select_parameters(file, parameter_dict)
-        if sensor.read_data(file, transducer_depth=p["transducer_depth"], bottom_depth=p["bottom_depth"], cabled=p["cabled"], up=p["up"]):
-            sensor.quality_flags(envass_file=os.path.join(repo, "notes/quality_assurance.json"), adcp_file=os.path.join(repo, 'notes/quality_specific_adcp.json'))
-            edited_files.extend(sensor.export(os.path.join(directories["Level1"], p["name"]), "L1_ADCP", output_period="file", remove_existing=True))
-            sensor.mask_data()
-            sensor.derive_variables(p["rotate_velocity"])
-            edited_files.extend(sensor.export(os.path.join(directories["Level2"], p["name"]), "L2_ADCP", output_period="file", remove_existing=True))
+    failed = []
+    if incremental:
+        if workers > 1:
+            log.warning("Incremental mode processes files sequentially.")
+        for file in files:
+            with log.measure("process_file", file):
+                edited, success = process_file_incremental(file, parameter_dict, directories, repo, log, incremental, read_options, zarr, aggregates, catalog)
+            edited_files.extend(edited)
+            if not success:
+                failed.append(file)
+            incremental.save()
+    elif chunk:
+        if workers > 1:
+            log.warning("Chunked mode processes files sequentially.")
+        for file in files:
+            with log.measure("process_file", file):
+                edited, success = process_file_chunked(file, parameter_dict, directories, repo, log, read_options, chunk, zarr, aggregates, catalog)
+            edited_files.extend(edited)
+            if not success:
+                failed.append(file)
+    elif workers > 1 and len(files) > 1:
+        edited, failed = process_files_parallel(files, parameter_dict, directories, repo, log, workers, read_options, zarr, aggregates, catalog)
+        edited_files.extend(edited)
+    else:
+        with ExportWriter(writers) as writer:
+            for file in files:
+                with log.measure("process_file", file):
+                    edited, success = process_file(file, parameter_dict, directories, repo, log, read_options, writer=writer, zarr=zarr, aggregates=aggregates, catalog=catalog)
+                edited_files.extend(edited)  # Aggregates, the exports are returned by writer.flush
+                if not success:
+                    failed.append(file)
+            edited_files.extend(writer.flush(log))
+    if failed:
+        log.warning("{} of {} files failed: {}".format(len(failed), len(files), ", ".join(failed)))
+    if changed:
+        for file in dependencies:
+            if file not in failed:
+                graph.set(file, dependencies[file])
+        graph.save()
+    log.set_context(file=None, instrument=None)
     log.end_stage()
 
+    if metrics:
+        write_metrics(log, repo)
+    if profile:
+        profiler.summary(log)
+        profiler.close()
+    log.flush()
+    return edited_files, failed
+
+
+def run_logger(repo, logs, metrics, profiler, structured):
+    # Logger of a run, the logger of the previous run in the process is kept so that its log file is reused
+    key = (logs, structured)
+    if key not in LOGGERS:
+        LOGGERS[key] = logger(os.path.join(repo, "logs/adcp") if logs else False, structured=structured)
+    log = LOGGERS[key]
+    log.metrics, log.profiler = metrics, profiler
+    return log
+
+
+def write_metrics(log, repo):
+    # Metrics of the run: appended to logs/adcp/metrics.jsonl, totals of the last run in logs/adcp/metrics.prom
+    log.write_metrics(os.path.join(repo, "logs/adcp/metrics.jsonl"), os.path.join(repo, "logs/adcp/metrics.prom"))
+
+def stream(server=False, logs=False, cache=False, backend="dolfyn", zarr=False, aggregates=False, upload=False, workers={}, queue_size=2, metrics=False, profile=False, json_logs=False, catalog=False):
+    """
+    Process the files as a stream: each file goes through the stages fetch, read, qa, export_l1, derive, export_l2
+    and upload as soon as the previous stage is done with it, so that downloads, processing and uploads of different
+    files overlap. Stages are connected by bounded queues of queue_size files and process workers[stage] files in
+    parallel (default: STREAM_WORKERS).
+
+    Parameters:
+        upload (function): function uploading a list of files (e.g. upload_remote_data.upload_files), =False to skip
+    Returns:
+        edited_files (list): Level0 and output files of the files that went through all the stages
+    Raises:
+        ValueError: if files failed in a stage, after the other files went through all the stages
+    """
+    repo = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    profiler = Profiler(os.path.join(repo, "logs/adcp/profiles")) if profile else False
+    log = run_logger(repo, logs, metrics, profiler, json_logs)
+    log.initialise("Streaming LéXPLORE ADCP data")
+    directories = {f: os.path.join(repo, "data", f) for f in ["Level0", "Level1", "Level2"]}
+    for directory in directories:
+        os.makedirs(directories[directory], exist_ok=True)
+    with open(os.path.join(repo, 'notes/parameters.json'), 'r') as f:
+        parameter_dict = json.load(f)
+    read_options = {"cache": Level0Cache(os.path.join(repo, "cache", "level0")) if cache else False, "backend": backend}
+    if catalog:
+        catalog = FileCatalog(os.path.join(repo, "cache", "catalog.sqlite"))
+    workers = dict(STREAM_WORKERS, **workers)
+    edited_files = []
+
+    if server:
+        if not os.path.exists(os.path.join(repo, "creds.json")):
+            raise ValueError("Credential file required to retrieve live data from the fstp server.")
+        with open(os.path.join(repo, "creds.json"), 'r') as f:
+            creds = json.load(f)
+        items = server_transfers(directories["Level0"], creds, server_location=["data/ADCP_300", "data/ADCP_600", "data/ADCP_300_up"], filetype=".LTA", log=log)
+    else:
+        items = [(False, file, 0, None) for file in level0_files(directories, catalog, log)]
+    log.info("Streaming {} files".format(len(items)))
+
+    def fetch(item):
+        server_file, file, offset, modify = item
+        if server_file:
+            with transfer_connection(creds) as ftp:
+                os.makedirs(os.path.dirname(file), exist_ok=True)
+                log.info("Downloading file {}".format(file), indent=1)
+                download_file(server_file, file, ftp, offset=offset, modify=modify)
+            if catalog:
+                catalog.record(file, os.path.basename(os.path.dirname(file)), "L0")  # Time and depth ranges recorded by read
+        return {"file": file, "outputs": [file] if server_file else []}
+
+    def read(job):
+        job["p"] = select_parameters(job["file"], parameter_dict)
+        job["sensor"] = ADCP(log=log)
+        job["sensor"].source = job["file"]
+        job["sensor"].parameters = job["p"]
+        log.set_context(instrument=job["p"]["name"])
+        p = job["p"]
+        if not job["sensor"].read_data(job["file"], transducer_depth=p["transducer_depth"], bottom_depth=p["bottom_depth"], cabled=p["cabled"], up=p["up"], **read_options):
+            raise ValueError("Failed to read {}".format(job["file"]))
+        if catalog:
+            time, depth = job["sensor"].data["time"], job["sensor"].data["depth"]
+            catalog.record(job["file"], p["name"], "L0", np.nanmin(time), np.nanmax(time), np.nanmin(depth), np.nanmax(depth), parameters=p, merge=False)
+        return job
+
+    def qa(job):
+        job["sensor"].quality_flags(envass_file=os.path.join(repo, "notes/quality_assurance.json"), adcp_file=os.path.join(repo, 'notes/quality_specific_adcp.json'))
+        return job
+
+    def export_l1(job):
+        job["outputs"].extend(job["sensor"].export(os.path.join(directories["Level1"], job["p"]["name"]), "L1_ADCP", output_period="file", remove_existing=True, zarr_store=zarr, catalog=catalog))
+        return job
+
+    def derive(job):
+        job["sensor"].mask_data()
+        job["sensor"].derive_variables(job["p"]["rotate_velocity"])
+        return job
+
+    def export_l2(job):
+        job["outputs"].extend(job["sensor"].export(os.path.join(directories["Level2"], job["p"]["name"]), "L2_ADCP", output_period="file", remove_existing=True, zarr_store=zarr, catalog=catalog))
+        if aggregates:
+            pyramid = AggregatePyramid(os.path.join(directories["Level2"], job["p"]["name"], "aggregates"), "L2_ADCP", log=log)
+            job["outputs"].extend(pyramid.update(job["sensor"].data, job["sensor"].variables, source=job["file"]))
+        job["sensor"] = False  # Release the data before the upload
+        return job
+
+    def send(job):
+        if upload:
+            upload(job["outputs"])
+        edited_files.extend(job["outputs"])
+        return job
+
+    stages = [Stage(name, function, workers[name], queue_size) for name, function in
+              [("fetch", fetch), ("read", read), ("qa", qa), ("export_l1", export_l1), ("derive", derive),
+               ("export_l2", export_l2), ("upload", send)]]
+    failed = run_stages(items, stages, log)
+    for name, files in failed.items():
+        log.warning("{} files failed in stage {}: {}".format(len(files), name, ", ".join(files)))
+    log.end("Streamed {} files".format(len(items)))
+    if metrics:
+        write_metrics(log, repo)
+    if profile:
+        profiler.summary(log)
+        profiler.close()
+    if failed:
+        raise ValueError("Files failed in stages {}".format(", ".join(failed)))
     return edited_files
 
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--server', '-s', help="Collect and process new files from FTP server", action='store_true')
     parser.add_argument('--logs', '-l', help="Write logs to file", action='store_true')
+    parser.add_argument('--workers', '-w', help="Number of files processed in parallel", type=int, default=1)
+    parser.add_argument('--cache', '-c', help="Cache parsed Level0 files to speed up reprocessing", action='store_true')
+    parser.add_argument('--incremental', '-i', help="Only decode ensembles appended to Level0 files since the last run", action='store_true')
+    parser.add_argument('--backend', '-b', help="Level0 reader: dolfyn or pd0 (native PD0 reader)", choices=["dolfyn", "pd0"], default="dolfyn")
+    parser.add_argument('--writers', '-x', help="Number of background NetCDF writer threads, 0 to write files synchronously", type=int, default=1)
+    parser.add_argument('--zarr', '-z', help="Also append the data to one Zarr store per instrument and level", action='store_true')
+    parser.add_argument('--aggregates', '-a', help="Update the hourly, daily and weekly aggregates of the Level2 data", action='store_true')
+    parser.add_argument('--changed', '-g', help="Only process the Level0 files whose content, parameters or QA configuration changed", action='store_true')
+    parser.add_argument('--metrics', '-m', help="Write the duration, memory, data size and bytes written of each stage and file to logs/adcp/metrics.jsonl and metrics.prom", action='store_true')
+    parser.add_argument('--profile', '-pr', help="Write cProfile and tracemalloc profiles of each file and stage to logs/adcp/profiles", action='store_true')
+    parser.add_argument('--json-logs', '-jl', help="Also write the log lines as JSON records to the .jsonl file of the log", action='store_true')
+    parser.add_argument('--chunk', '-k', help="Process each Level0 file in blocks of CHUNK ensembles to bound the memory used", type=int, default=False)
+    parser.add_argument('--catalog', '-ct', help="Record the Level0, Level1 and Level2 files in the catalog cache/catalog.sqlite and select the Level0 files from it", action='store_true')
     args = vars(parser.parse_args())
-    main(server=args["server"], logs=args["logs"])
\ No newline at end of file
+    main(server=args["server"], logs=args["logs"], workers=args["workers"], cache=args["cache"], incremental=args["incremental"], backend=args["backend"], writers=args["writers"], zarr=args["zarr"], aggregates=args["aggregates"], changed=args["changed"], metrics=args["metrics"], profile=args["profile"], json_logs=args["json_logs"], chunk=args["chunk"], catalog=args["catalog"])
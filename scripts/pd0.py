@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+from functions import measurement_period
+
+# Data type IDs (LSB, MSB) of the RDI PD0 format
+FIXED_LEADER = 0x0000
+VARIABLE_LEADER = 0x0080
+VELOCITY = 0x0100
+CORRELATION = 0x0200
+ECHO_INTENSITY = 0x0300
+PERCENT_GOOD = 0x0400
+
+FREQUENCIES = {0: 75., 1: 150., 2: 300., 3: 600., 4: 1200., 5: 2400.}  # [kHz]
+BEAM_ANGLES = {0: 15., 1: 20., 2: 30.}  # [°]
+
+
+def ensemble_offsets(file, start=0):
+    """
+    Locate the complete ensembles of an RDI PD0 file (e.g., .LTA file) from a byte offset. An ensemble starts with
+    the 0x7F7F header ID followed by the number of bytes in the ensemble, and ends with a 2-byte checksum. An ensemble
+    still being written (incomplete or with a wrong checksum) at the end of the file is not returned.
+
+    Parameters:
+        file (str): path and ADCP filename
+        start (int): byte offset where the search starts, should be the start of an ensemble
+    Returns:
+        offsets (np.array of ints): byte offset of the start of each complete ensemble
+        end (int): byte offset of the end of the last complete ensemble
+    """
+    if os.path.getsize(file) <= start:
+        return np.array([], dtype=np.int64), start
+    buffer = np.memmap(file, dtype=np.uint8, mode="r", offset=start)
+    # Candidate header positions, found at once for the whole file
+    candidates = np.where((buffer[:-1] == 0x7f) & (buffer[1:] == 0x7f))[0]
+    offsets = []
+    pos = 0
+    end = 0
+    size = len(buffer)
+    while pos + 4 <= size:
+        if buffer[pos] != 0x7f or buffer[pos + 1] != 0x7f:
+            i = np.searchsorted(candidates, pos)
+            if i >= len(candidates):
+                break
+            pos = int(candidates[i])
+            continue
+        nbytes = int(buffer[pos + 2]) + (int(buffer[pos + 3]) << 8)
+        if pos + nbytes + 2 > size:
+            break
+        checksum = int(buffer[pos + nbytes]) + (int(buffer[pos + nbytes + 1]) << 8)
+        if nbytes > 4 and int(np.sum(buffer[pos:pos + nbytes], dtype=np.uint64)) & 0xffff == checksum:
+            offsets.append(start + pos)
+            pos = pos + nbytes + 2
+            end = start + pos
+        else:
+            pos = pos + 1
+    return np.array(offsets, dtype=np.int64), end
+
+
+def read_pd0(file, window=False, corr_threshold=20, block=1000):
+    """
+    Read the variables used by the processing from an RDI PD0 file (e.g., .LTA file) without dolfyn. The file is
+    memory-mapped and every field is decoded for all ensembles at once by gathering its bytes at the ensemble offsets.
+    Only the fixed leader, variable leader, velocity, correlation, echo intensity and percent good data types are read.
+    Ensembles are grouped by layout (data types and their offsets), so files where the configuration changes are
+    supported as long as the number of cells stays the same.
+
+    When a time window is given, only the ensembles of the measurement period (see functions.measurement_period)
+    are decoded. The ensemble times are read for the whole file, and the first and last ensembles with a mean
+    correlation above corr_threshold are found by decoding the correlation in blocks from each end of the file.
+
+    Parameters:
+        file (str): path and ADCP filename
+        window (tuple of np.datetime64 or None): (start_date, end_date) of the period to decode, None for no limit,
+            =False to decode all the ensembles
+        corr_threshold (float): minimum mean correlation of the ensembles of the measurement period [%]
+        block (int): number of ensembles decoded at once when searching for the measurement period
+    Returns:
+        raw (dict of np.arrays): same variables as ADCP.parse_level0, i.e. time (datetime64[s]), range [m],
+            vel (4*n_range*n_time) [m/s], corr, amp, prcnt_gd (4*n_range*n_time) [counts], heading, roll, pitch [°]
+            and temp [°C] (n_time)
+        attrs (dict): transmit_pulse_m, beam_angle, blank_dist, freq and bandwidth
+    """
+    offsets, end = ensemble_offsets(file)
+    if len(offsets) == 0:
+        raise ValueError("No complete PD0 ensemble found in {}".format(file))
+    buffer = np.memmap(file, dtype=np.uint8, mode="r")
+    layout_index, types = ensemble_layouts(buffer, offsets, file)
+
+    fixed = gather(buffer, offsets[:1], types[layout_index[0]][FIXED_LEADER], 59)[0]
+    nbeams = int(fixed[8])
+    ncells = int(fixed[9])
+    for k in np.unique(layout_index):
+        first = offsets[np.argmax(layout_index == k)]
+        if buffer[first + types[k][FIXED_LEADER] + 8] != nbeams or buffer[first + types[k][FIXED_LEADER] + 9] != ncells:
+            raise ValueError("Number of cells or beams changes within {}".format(file))
+    cell_size = uint16(fixed, 12) / 100.
+    bin1_dist = uint16(fixed, 32) / 100.
+    config = int(fixed[4]) + (int(fixed[5]) << 8)
+    attrs = {"freq": FREQUENCIES.get(config & 0x7, np.nan),
+             "beam_angle": BEAM_ANGLES.get((config >> 8) & 0x3, float(fixed[58])),
+             "blank_dist": uint16(fixed, 14) / 100.,
+             "transmit_pulse_m": uint16(fixed, 34) / 100.,
+             "bandwidth": uint16(fixed, 50)}
+
+    def decode(type_id, ens, length):
+        # Bytes of a data type (after its ID) for the ensembles ens, as a (len(ens), length) uint8 array
+        out = np.zeros((len(ens), length), dtype=np.uint8)
+        for k in np.unique(layout_index[ens]):
+            group = layout_index[ens] == k
+            if type_id in types[k]:
+                out[group] = gather(buffer, offsets[ens[group]], types[k][type_id] + 2, length)
+        return out
+
+    ens = np.arange(len(offsets))
+    variable = decode(VARIABLE_LEADER, ens, 63)
+    time = rtc_time(variable)
+
+    if window is not False:
+        size = ncells * nbeams
+
+        def first_valid(order):
+            for i in range(0, len(order), block):
+                corr_mean = decode(CORRELATION, order[i:i + block], size).mean(axis=1) / 255. * 100
+                valid = np.where(corr_mean > corr_threshold)[0]
+                if len(valid) > 0:
+                    return order[i + valid[0]]
+            raise ValueError("No ensemble with correlation > {}% in {}".format(corr_threshold, file))
+
+        valid = [first_valid(ens), first_valid(ens[::-1])]
+        ens = np.where(measurement_period(time, valid, *window))[0]
+        variable = variable[ens]
+        time = time[ens]
+
+    n = len(ens)
+    size = ncells * nbeams
+    raw = {"time": time, "range": bin1_dist + np.arange(ncells) * cell_size}
+    raw["heading"] = field(variable, 16, "<u2") / 100.
+    raw["pitch"] = field(variable, 18, "<i2") / 100.
+    raw["roll"] = field(variable, 20, "<i2") / 100.
+    raw["temp"] = field(variable, 24, "<i2") / 100.
+    vel = decode(VELOCITY, ens, 2 * size).view("<i2").reshape(n, ncells, nbeams)
+    vel = np.where(vel == -32768, np.nan, vel / 1000.).astype(np.float32)
+    vel[~np.array([VELOCITY in t for t in types])[layout_index[ens]]] = np.nan
+    raw["vel"] = vel.transpose(2, 1, 0)
+    for var, type_id in [("corr", CORRELATION), ("amp", ECHO_INTENSITY), ("prcnt_gd", PERCENT_GOOD)]:
+        raw[var] = decode(type_id, ens, size).reshape(n, ncells, nbeams).transpose(2, 1, 0)
+    return raw, attrs
+
+
+def ensemble_layouts(buffer, offsets, file):
+    """
+    Group the ensembles by layout (header with the number of data types and their offsets).
+
+    Returns:
+        layout_index (np.array of ints): layout of each ensemble
+        types (list of dicts): for each layout, offset of each data type ID from the start of the ensemble
+    """
+    ntypes = buffer[offsets + 5].astype(np.int64)
+    width = 6 + 2 * int(ntypes.max())
+    headers = gather(buffer, offsets, 0, width)
+    headers[np.arange(width)[None, :] >= (6 + 2 * ntypes)[:, None]] = 0
+    headers[:, 2:4] = 0  # The number of bytes does not change the layout
+    layouts, layout_index = np.unique(headers, axis=0, return_inverse=True)
+    layout_index = layout_index.ravel()
+    types = []
+    for k, layout in enumerate(layouts):
+        start = offsets[np.argmax(layout_index == k)]
+        layout_types = {}
+        for i in range(int(layout[5])):
+            type_offset = int(layout[6 + 2 * i]) + (int(layout[7 + 2 * i]) << 8)
+            layout_types[uint16(buffer, start + type_offset)] = type_offset
+        if FIXED_LEADER not in layout_types or VARIABLE_LEADER not in layout_types:
+            raise ValueError("Missing fixed or variable leader in {}".format(file))
+        types.append(layout_types)
+    return layout_index, types
+
+
+def gather(buffer, starts, offset, length):
+    """
+    Bytes [start+offset, start+offset+length) of every ensemble start, as a (n_ensembles, length) uint8 array.
+    """
+    return np.ascontiguousarray(buffer[starts[:, None] + offset + np.arange(length)[None, :]])
+
+
+def uint16(values, i):
+    return int(values[i]) + (int(values[i + 1]) << 8)
+
+
+def field(values, i, dtype):
+    """
+    2-byte field starting at byte i of each row of a (n_ensembles, length) uint8 array, as floats.
+    """
+    return np.ascontiguousarray(values[:, i:i + 2]).view(dtype)[:, 0].astype(float)
+
+
+def rtc_time(variable):
+    """
+    Ensemble time from the Y2K real time clock of the variable leader (bytes 57-64), or from the 2-digit year clock
+    (bytes 4-10) when the Y2K clock is not set. The variable leader is given without its 2-byte ID.
+    """
+    v = variable.astype(np.int64)
+    year = v[:, 55] * 100 + v[:, 56]
+    month, day, hour, minute, second = v[:, 57], v[:, 58], v[:, 59], v[:, 60], v[:, 61]
+    old = v[:, 55] == 0
+    year[old] = 2000 + v[old, 2]
+    month[old], day[old], hour[old] = v[old, 3], v[old, 4], v[old, 5]
+    minute[old], second[old] = v[old, 6], v[old, 7]
+    date = (year - 1970).astype("datetime64[Y]") + (month - 1).astype("timedelta64[M]")
+    date = date.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")
+    seconds = hour * 3600 + minute * 60 + second  # Hundredths are truncated, as with the datetime64[s] dolfyn time
+    return date.astype("datetime64[s]") + seconds.astype("timedelta64[s]")
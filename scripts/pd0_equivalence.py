@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import struct
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from datetime import datetime, timedelta
+from instruments import ADCP
+
+VARIABLES = ["time", "range", "vel", "corr", "amp", "prcnt_gd", "heading", "pitch", "roll", "temp"]
+ATTRIBUTES = ["transmit_pulse_m", "beam_angle", "blank_dist", "freq", "bandwidth"]
+FREQUENCY_CODES = {75: 0, 150: 1, 300: 2, 600: 3, 1200: 4, 2400: 5}
+BEAM_ANGLE_CODES = {15: 0, 20: 1, 30: 2}
+
+# Instrument settings of the synthetic files, close to the LéXPLORE deployments
+SETTINGS = {
+    "600": {"freq": 600, "beam_angle": 20, "up": True, "cell_size": 0.25, "blank_dist": 0.88, "bin1_dist": 1.5,
+            "transmit_pulse_m": 0.43, "bandwidth": 1},
+    "300": {"freq": 300, "beam_angle": 20, "up": False, "cell_size": 1., "blank_dist": 1.76, "bin1_dist": 3.26,
+            "transmit_pulse_m": 1.1, "bandwidth": 1},
+}
+
+
+def synthetic_ensemble(time, number, vel, corr, amp, prcnt_gd, heading, pitch, roll, temp, settings):
+    """
+    One RDI Workhorse PD0 ensemble (firmware 51.41) with the fixed leader, variable leader, velocity, correlation,
+    echo intensity and percent good data types.
+
+    Parameters:
+        time (datetime): ensemble time
+        number (int): ensemble number
+        vel (n_cells*n_beams np.array of ints): velocities [mm/s], -32768 for missing values
+        corr, amp, prcnt_gd (n_cells*n_beams np.arrays of uint8): counts
+        heading, pitch, roll, temp (ints): [0.01 °] and [0.01 °C]
+        settings (dict): instrument settings, see SETTINGS
+    Returns:
+        ensemble (bytes): ensemble with its checksum
+    """
+    cells, beams = vel.shape
+    fixed = bytearray(59)
+    fixed[2:4] = bytes([51, 41])  # Firmware version
+    fixed[4] = FREQUENCY_CODES[settings["freq"]] | 0x08 | (0x80 if settings["up"] else 0)  # Convex, orientation
+    fixed[5] = BEAM_ANGLE_CODES[settings["beam_angle"]] | 0x40  # Janus 4 beams
+    fixed[8] = beams
+    fixed[9] = cells
+    struct.pack_into("<HHHBBBBHBBBB", fixed, 10, 60, int(round(settings["cell_size"] * 100)),
+                     int(round(settings["blank_dist"] * 100)), 1, 64, 1, 0, 2000, 0, 10, 0, 0x1f)
+    struct.pack_into("<HH", fixed, 32, int(round(settings["bin1_dist"] * 100)), int(round(settings["transmit_pulse_m"] * 100)))
+    struct.pack_into("<H", fixed, 50, settings["bandwidth"])
+    fixed[58] = settings["beam_angle"]
+
+    variable = bytearray(65)
+    variable[0:2] = struct.pack("<H", 0x0080)
+    struct.pack_into("<H", variable, 2, number & 0xffff)
+    variable[4:11] = bytes([time.year % 100, time.month, time.day, time.hour, time.minute, time.second, 0])
+    variable[11] = (number >> 16) & 0xff
+    struct.pack_into("<HHHhhHh", variable, 14, 1480, int(settings["up"]) * 10, heading, pitch, roll, 35, temp)
+    variable[57:65] = bytes([time.year // 100, time.year % 100, time.month, time.day, time.hour, time.minute, time.second, 0])
+
+    blocks = [bytes(fixed), bytes(variable),
+              struct.pack("<H", 0x0100) + vel.astype("<i2").tobytes(),
+              struct.pack("<H", 0x0200) + corr.astype(np.uint8).tobytes(),
+              struct.pack("<H", 0x0300) + amp.astype(np.uint8).tobytes(),
+              struct.pack("<H", 0x0400) + prcnt_gd.astype(np.uint8).tobytes()]
+    position = 6 + 2 * len(blocks)
+    offsets = []
+    for block in blocks:
+        offsets.append(position)
+        position += len(block)
+    header = b"\x7f\x7f" + struct.pack("<HBB", position, 0, len(blocks)) + struct.pack("<{}H".format(len(blocks)), *offsets)
+    ensemble = header + b"".join(blocks)
+    return ensemble + struct.pack("<H", sum(ensemble) & 0xffff)
+
+
+def synthetic_pd0(file, frequency="600", ensembles=50, cells=30, seed=0):
+    """
+    Write a synthetic PD0 file of 10 min ensembles with missing velocities and an incomplete ensemble at the end (file
+    still being written).
+    """
+    settings = SETTINGS[frequency]
+    rng = np.random.default_rng(seed)
+    vel = rng.integers(-3000, 3000, (ensembles, cells, 4))
+    vel[rng.random(vel.shape) < 0.05] = -32768
+    corr = rng.integers(0, 256, (ensembles, cells, 4), dtype=np.uint8)
+    amp = rng.integers(0, 256, (ensembles, cells, 4), dtype=np.uint8)
+    prcnt_gd = rng.integers(0, 101, (ensembles, cells, 4), dtype=np.uint8)
+    heading = rng.integers(0, 36000, ensembles)
+    pitch, roll = rng.integers(-2000, 2000, (2, ensembles))
+    temp = rng.integers(400, 2500, ensembles)
+    start = datetime(2024, 7, 11, 12, 0, 5)
+    with open(file, "wb") as f:
+        for i in range(ensembles):
+            f.write(synthetic_ensemble(start + timedelta(minutes=10 * i), i + 1, vel[i], corr[i], amp[i], prcnt_gd[i],
+                                       int(heading[i]), int(pitch[i]), int(roll[i]), int(temp[i]), settings))
+        f.write(synthetic_ensemble(start + timedelta(minutes=10 * ensembles), ensembles + 1, vel[0], corr[0], amp[0],
+                                   prcnt_gd[0], 0, 0, 0, 0, settings)[:100])
+
+
+def compare(file):
+    """
+    Compare the variables and attributes of a Level0 file parsed with the pd0 and dolfyn backends of
+    ADCP.parse_level0.
+
+    Returns:
+        differences (list of str): variables and attributes that differ, empty if the backends are equivalent
+    """
+    raw_pd0, attrs_pd0 = ADCP().parse_level0(file, backend="pd0")
+    raw_dolfyn, attrs_dolfyn = ADCP().parse_level0(file, backend="dolfyn")
+    differences = []
+    for var in VARIABLES:
+        a, b = np.asarray(raw_pd0[var]), np.asarray(raw_dolfyn[var])
+        if a.shape != b.shape:
+            differences.append("{}: shape {} instead of {}".format(var, a.shape, b.shape))
+        elif var == "time":
+            if not np.array_equal(a, b):
+                differences.append("time: {} different values".format(int(np.sum(a != b))))
+        elif not np.allclose(a.astype(float), b.astype(float), rtol=1e-6, atol=1e-6, equal_nan=True):  # float32 in dolfyn
+            differences.append("{}: max difference {}".format(var, np.nanmax(np.abs(a.astype(float) - b.astype(float)))))
+    for key in ATTRIBUTES:
+        if not np.isclose(float(attrs_pd0[key]), float(attrs_dolfyn[key])):
+            differences.append("{}: {} instead of {}".format(key, attrs_pd0[key], attrs_dolfyn[key]))
+    return differences
+
+
+def pd0_equivalence(files=()):
+    """
+    Check that the pd0 backend returns the same data as dolfyn, for synthetic files of each SETTINGS and for files.
+
+    Returns:
+        passed (bool): =True if all the files are read identically
+    """
+    folder = tempfile.mkdtemp()
+    passed = True
+    try:
+        cases = []
+        for frequency in SETTINGS:
+            file = os.path.join(folder, "synthetic_{}.LTA".format(frequency))
+            synthetic_pd0(file, frequency)
+            cases.append(file)
+        for file in cases + list(files):
+            differences = compare(file)
+            print("{}: {}".format(os.path.basename(file), "identical" if not differences else "DIFFERENT"))
+            for difference in differences:
+                print("    " + difference)
+            passed = passed and not differences
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the pd0 reader returns the same data as dolfyn")
+    parser.add_argument('files', nargs="*", help="Level0 files compared in addition to the synthetic files")
+    args = vars(parser.parse_args())
+    sys.exit(0 if pd0_equivalence(args["files"]) else 1)
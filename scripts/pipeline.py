@@ -5,21 +5,37 @@ import json
 import time
 import argparse
 import requests
+import traceback
 from download_remote_data import download_remote_data
 from upload_remote_data import upload_files, sync_files
-from main import main
+from main import main, stream
+from watch import watch
 
-def pipeline(download=False, process=False, reprocess=False, logs=False, upload=False, uploadfiles=False, datalakes=False):
+def pipeline(download=False, process=False, reprocess=False, logs=False, upload=False, uploadfiles=False, datalakes=False, workers=1, cache=False, incremental=False, backend="dolfyn", writers=1, zarr=False, aggregates=False, changed=False, streaming=False, stage_workers={}, metrics=False, profile=False, json_logs=False, chunk=False, catalog=False):
     if download:
         print("Download sync with remote bucket")
         download_remote_data(warning=False, delete=True)
 
     failed = False
+    edited_files = []
+    failed_files = []
+    if streaming:
+        # Download, processing and upload overlap, each file is uploaded as soon as it is processed
+        try:
+            edited_files = stream(not reprocess, logs, cache, backend, zarr, aggregates, upload_files if uploadfiles else False, stage_workers, metrics=metrics, profile=profile, json_logs=json_logs, catalog=catalog)
+        except Exception as e:
+            print("Streaming failed:\n{}".format(traceback.format_exc()))
+            failed = True
+            if reprocess:
+                raise
+        process = False
+        uploadfiles = uploadfiles and failed
+
     if process:
         try:
-            edited_files = main(not reprocess, logs)
+            edited_files, failed_files = main(not reprocess, logs, workers, cache, incremental, backend, writers, zarr, aggregates, changed, metrics, profile, json_logs, chunk, catalog)
         except Exception as e:
-            print("Processing failed")
+            print("Processing failed:\n{}".format(traceback.format_exc()))
             failed = True
             if reprocess:
                 raise
@@ -36,6 +52,8 @@ def pipeline(download=False, process=False, reprocess=False, logs=False, upload=
             requests.get("https://api.datalakes-eawag.ch/update/{}".format(datalakes_id))
             time.sleep(30)
 
+    return edited_files, failed, failed_files
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--download', '-d', help="Download sync with remote bucket", action='store_true')
@@ -45,5 +63,38 @@ if __name__ == "__main__":
     parser.add_argument('--upload', '-u', help="Upload sync with remote bucket", action='store_true')
     parser.add_argument('--uploadfiles', '-uf', help="Upload edited files to remote bucket", action='store_true')
     parser.add_argument('--datalakes', '-dl', type=lambda s: list(map(int, s.split(','))) if s else False, nargs="?", const=False, default=False, help="Datalakes ID's to update, or False if not provided.")
+    parser.add_argument('--workers', '-w', help="Number of files processed in parallel", type=int, default=1)
+    parser.add_argument('--cache', '-c', help="Cache parsed Level0 files to speed up reprocessing", action='store_true')
+    parser.add_argument('--incremental', '-i', help="Only decode ensembles appended to Level0 files since the last run", action='store_true')
+    parser.add_argument('--backend', '-b', help="Level0 reader: dolfyn or pd0 (native PD0 reader)", choices=["dolfyn", "pd0"], default="dolfyn")
+    parser.add_argument('--writers', '-x', help="Number of background NetCDF writer threads, 0 to write files synchronously", type=int, default=1)
+    parser.add_argument('--zarr', '-z', help="Also append the data to one Zarr store per instrument and level", action='store_true')
+    parser.add_argument('--aggregates', '-a', help="Update the hourly, daily and weekly aggregates of the Level2 data", action='store_true')
+    parser.add_argument('--changed', '-g', help="Only process the Level0 files whose content, parameters or QA configuration changed", action='store_true')
+    parser.add_argument('--stream', '-st', help="Stream each new file from the FTP server through processing to upload, cannot be combined with --incremental, --changed, --chunk, --workers or --writers (see --stage-workers)", action='store_true')
+    parser.add_argument('--stage-workers', '-sw', type=lambda s: {k: int(v) for k, v in (i.split("=") for i in s.split(","))}, default={}, help="Workers of the streaming stages, e.g. fetch=4,read=2,upload=4")
+    parser.add_argument('--watch', '-wa', type=float, default=False, help="Run the pipeline every WATCH seconds in a long-running process")
+    parser.add_argument('--port', '-pt', type=int, default=False, help="Port of the health and metrics endpoint of the watch mode")
+    parser.add_argument('--runs', '-rn', type=int, default=False, help="Number of runs of the watch mode before exiting")
+    parser.add_argument('--metrics', '-m', help="Write the duration, memory, data size and bytes written of each stage and file to logs/adcp/metrics.jsonl and metrics.prom", action='store_true')
+    parser.add_argument('--profile', '-pr', help="Write cProfile and tracemalloc profiles of each file and stage to logs/adcp/profiles", action='store_true')
+    parser.add_argument('--json-logs', '-jl', help="Also write the log lines as JSON records to the .jsonl file of the log", action='store_true')
+    parser.add_argument('--chunk', '-k', help="Process each Level0 file in blocks of CHUNK ensembles to bound the memory used", type=int, default=False)
+    parser.add_argument('--catalog', '-ct', help="Record the Level0, Level1 and Level2 files in the catalog cache/catalog.sqlite and select the Level0 files from it", action='store_true')
     args = vars(parser.parse_args())
-    pipeline(download=args["download"], process=args["process"], reprocess=args["reprocess"], logs=args["logs"], upload=args["upload"], uploadfiles=args["uploadfiles"], datalakes=args["datalakes"])
\ No newline at end of file
+    if args["stream"]:
+        ignored = [flag for flag, used in [("--incremental", args["incremental"]), ("--changed", args["changed"]), ("--chunk", args["chunk"]),
+                                           ("--workers", args["workers"] != 1), ("--writers", args["writers"] != 1)] if used]
+        if ignored:
+            parser.error("--stream cannot be combined with {}".format(", ".join(ignored)))
+    options = dict(download=args["download"], process=args["process"], reprocess=args["reprocess"], logs=args["logs"], upload=args["upload"], uploadfiles=args["uploadfiles"], datalakes=args["datalakes"], workers=args["workers"], cache=args["cache"], incremental=args["incremental"], backend=args["backend"], writers=args["writers"], zarr=args["zarr"], aggregates=args["aggregates"], changed=args["changed"], streaming=args["stream"], stage_workers=args["stage_workers"], metrics=args["metrics"], profile=args["profile"], json_logs=args["json_logs"], chunk=args["chunk"], catalog=args["catalog"])
+    if args["watch"]:
+        def run():
+            edited_files, failed, failed_files = pipeline(**options)
+            if failed:
+                raise RuntimeError("Processing failed")
+            return edited_files, failed_files
+        state = watch(run, args["watch"], port=args["port"], runs=args["runs"])
+        sys.exit(1 if state.failures else 0)
+    else:
+        pipeline(**options)
\ No newline at end of file
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import cProfile
+import threading
+import tracemalloc
+from time import perf_counter
+
+
+class Profiler:
+    """
+    cProfile and tracemalloc profiles of the stages measured by the logger (logger.measure: logger stages, files and
+    the methods decorated with measured). For each stage of each file, the cProfile statistics are dumped to
+    <file>.<stage>.prof (e.g. python -m pstats or snakeviz) and the largest allocations still held at the end of the
+    stage to <file>.<stage>.tracemalloc.txt. Stages without a file are named run.<stage>.
+
+    Nested stages are profiled separately: the profile of a stage excludes the time of the stages it contains. Only
+    one cProfile profiler can be active at a time with Python >= 3.12, stages running at the same time in other
+    threads are then only timed.
+
+    Parameters:
+        folder (str): output folder of the profiles
+        top (int): number of allocations written for each stage
+        frames (int): number of frames stored by tracemalloc for each allocation
+    """
+    def __init__(self, folder, top=25, frames=10):
+        self.folder = folder
+        self.top = top
+        self.units = []
+        self.names = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def start(self, stage, file=False):
+        stack = self.stack()
+        if stack and stack[-1]["profile"]:
+            stack[-1]["profile"].disable()
+        peak = tracemalloc.get_traced_memory()[1]
+        for parent in stack:
+            parent["peak"] = max(parent["peak"], peak)
+        tracemalloc.reset_peak()
+        unit = {"stage": stage, "file": file if file else None, "parent": stack[-1]["file"] if stack else None,
+                "snapshot": tracemalloc.take_snapshot(), "peak": 0, "children": 0., "profile": cProfile.Profile()}
+        try:
+            unit["profile"].enable()
+        except ValueError:
+            unit["profile"] = False  # Another profiler is active in another thread
+        unit["start"] = perf_counter()
+        stack.append(unit)
+        return unit
+
+    def stop(self, unit):
+        duration = perf_counter() - unit["start"]
+        if unit["profile"]:
+            unit["profile"].disable()
+        stack = self.stack()
+        stack.remove(unit)
+        unit["peak"] = max(unit["peak"], tracemalloc.get_traced_memory()[1])
+        name = self.name(unit)
+        if unit["profile"]:
+            unit["profile"].dump_stats(os.path.join(self.folder, name + ".prof"))
+        differences = tracemalloc.take_snapshot().compare_to(unit["snapshot"], "lineno")
+        with open(os.path.join(self.folder, name + ".tracemalloc.txt"), "w") as f:
+            f.write("Peak traced memory: {:.1f} MB\n".format(unit["peak"] / 1e6))
+            f.write("Largest allocations still held at the end of the stage:\n")
+            for difference in differences[:self.top]:
+                f.write(str(difference) + "\n")
+        record = {"stage": unit["stage"], "file": unit["file"], "parent": unit["parent"], "duration": duration,
+                  "self": duration - unit["children"], "peak": unit["peak"], "name": name}
+        with self.lock:
+            self.units.append(record)
+        if stack:
+            stack[-1]["children"] += duration
+            stack[-1]["peak"] = max(stack[-1]["peak"], unit["peak"])
+            if stack[-1]["profile"]:
+                stack[-1]["profile"].enable()
+        tracemalloc.reset_peak()
+        return record
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def name(self, unit):
+        # <file>.<stage>, numbered when a stage runs several times for a file (e.g. the Level1 and Level2 exports)
+        name = "{}.{}".format(os.path.basename(unit["file"]) if unit["file"] else "run", re.sub(r"[^\w\-]+", "_", unit["stage"]))
+        with self.lock:
+            count = self.names.get(name, 0) + 1
+            self.names[name] = count
+        return name if count == 1 else "{}.{}".format(name, count)
+
+    def summary(self, log, worst=10):
+        """
+        Log the files that took the longest, with their peak traced memory and their slowest stages.
+        """
+        files = {}
+        for unit in self.units:
+            if not unit["file"]:
+                continue
+            entry = files.setdefault(unit["file"], {"duration": 0., "peak": 0, "stages": []})
+            if unit["parent"] != unit["file"]:
+                entry["duration"] += unit["duration"]
+            entry["peak"] = max(entry["peak"], unit["peak"])
+            entry["stages"].append(unit)
+        if not files:
+            return
+        log.info("Slowest files (profiles in {}):".format(self.folder))
+        for file, entry in sorted(files.items(), key=lambda item: -item[1]["duration"])[:worst]:
+            stages = sorted(entry["stages"], key=lambda unit: -unit["self"])[:3]
+            log.info("{:>9.2f} s {:>9.1f} MB  {}: {}".format(entry["duration"], entry["peak"] / 1e6, os.path.basename(file),
+                     ", ".join("{} {:.2f} s".format(unit["stage"], unit["self"]) for unit in stages)), indent=1)
+
+    def close(self):
+        tracemalloc.stop()
@@ -191,3 +191,113 @@ def qa_adcp_echodiff(prior_flags,echo1,echo2,echo3,echo4,diff_threshold=30,flag_
     flags[(decho1>diff_threshold)|(decho2>diff_threshold)|(decho3>diff_threshold)|(decho4>diff_threshold)]=flag_nb
     flags=flags+prior_flags 
     return flags
+
+ADCP_FLAGS = {"interface": 2, "corr": 2**2, "PG14": 2**3, "PG3": 2**4, "velerror": 2**5, "tilt": 2**6, "corrstd": 2**7, "echodiff": 2**8}
+
+def qa_adcp_bitmask(tests, corr, prcnt_gd, echo, vel_error, roll, pitch, depthval, depthADCP, depth_bottom, beam_angle, up, depth_mask=None, flags=None, corr_scale=1.):
+    """
+    Evaluate all the ADCP-specific tests in one pass and write them to a compact bitmask. Each test sets the bit
+    given by ADCP_FLAGS, i.e. the same 2**k numbers as the individual qa_adcp_* functions, so the result is identical
+    to chaining them. The 4-beam arrays are read one beam at a time and are never stacked or copied as a whole.
+
+    Parameters:
+        tests (dict): tests to apply and their parameters, "tests" section of quality_specific_adcp.json
+        corr (4*n_range*n_time np.array): correlation values of the 4 beams [0-1], or counts with corr_scale=1/255
+        prcnt_gd (4*n_range*n_time np.array): Percentage Good 1 to 4 [%]
+        echo (4*n_bins*n_time np.array): echo values of the 4 beams, already restricted to depth_mask [counts]
+        vel_error (n_bins*n_time np.array of floats): velocity error [m/s]
+        roll (np.array of floats): roll angle time series [°]
+        pitch (np.array of floats): pitch angle time series [°]
+        depthval (np.array of floats): positive depth values, already corrected for the ADCP location [m]
+        depthADCP (float): depth of the ADCP [m]
+        depth_bottom (float): depth of the sediment interface [m]
+        beam_angle (float): angle of the beams of the ADCP to compute sidelobe interference [°]
+        up (bool): =True is the ADCP is upward-looking (surface interface), =False otherwise (sediment interface)
+        depth_mask (n_range np.array of bools): range bins of corr and prcnt_gd kept in the velocity matrix
+        flags (n_bins*n_time np.array of uint16): existing flags to update in place (default: new array of zeros)
+        corr_scale (float): factor converting corr to [0-1]
+    Returns:
+        flags (n_bins*n_time np.array of uint16): data array where flagged data is shown with a number>0 and 0 = no flag.
+    """
+    shape = vel_error.shape
+    if flags is None:
+        flags = np.zeros(shape, dtype=np.uint16)
+    if depth_mask is None:
+        depth_mask = slice(None)
+    mask = np.empty(shape, dtype=bool)
+    buffer = np.empty(shape, dtype=bool)
+
+    def set_flag(test):
+        np.bitwise_or(flags, ADCP_FLAGS[test], out=flags, where=mask)
+
+    if "interface" in tests:
+        if up:
+            dist_sidelobe = depthADCP * (1 - np.cos(beam_angle * np.pi / 180))
+            ind = np.where(depthval < dist_sidelobe)[0][0] - 1
+        else:
+            dist_sidelobe = (depth_bottom - depthADCP) * (1 - np.cos(beam_angle * np.pi / 180))
+            ind = np.where(depthval > (depth_bottom - dist_sidelobe))[0][0] - 1
+        flags[ind:, :] |= ADCP_FLAGS["interface"]
+
+    if "corr" in tests:
+        corr_threshold = tests["corr"]["corr_threshold"] / 255 / corr_scale # In the units of corr
+        mask[:] = False
+        for beam in range(4):
+            np.less(corr[beam, depth_mask, :], corr_threshold, out=buffer)
+            mask |= buffer
+        set_flag("corr")
+
+    if "PG14" in tests:
+        np.less(signed(prcnt_gd[0, depth_mask, :]) + prcnt_gd[3, depth_mask, :], tests["PG14"]["percentage_threshold"], out=mask)
+        set_flag("PG14")
+
+    if "PG3" in tests:
+        np.greater(prcnt_gd[2, depth_mask, :], tests["PG3"]["percentage_threshold"], out=mask)
+        set_flag("PG3")
+
+    if "velerror" in tests:
+        np.greater(np.abs(vel_error), tests["velerror"]["vel_threshold"], out=mask)
+        set_flag("velerror")
+
+    if "tilt" in tests:
+        tilt_threshold = tests["tilt"]["tilt_threshold"]
+        flags[:, (np.abs(roll) > tilt_threshold) | (np.abs(pitch) > tilt_threshold)] |= ADCP_FLAGS["tilt"]
+
+    if "corrstd" in tests:
+        corr_mean = np.zeros(shape)
+        for beam in range(4):
+            corr_mean += corr[beam, depth_mask, :] * corr_scale
+        corr_mean /= 4
+        corr_var = np.zeros(shape)
+        for beam in range(4):
+            deviation = corr[beam, depth_mask, :] * corr_scale - corr_mean
+            deviation *= deviation
+            corr_var += deviation
+        corr_var /= 4
+        del corr_mean, deviation
+        corr_std = np.sqrt(corr_var, out=corr_var)
+        np.greater(corr_std, tests["corrstd"]["std_threshold"], out=mask)
+        set_flag("corrstd")
+        del corr_var, corr_std
+
+    if "echodiff" in tests:
+        diff_threshold = tests["echodiff"]["diff_threshold"]
+        mask[0, :] = False
+        for beam in range(4):
+            np.greater(np.diff(signed(echo[beam]), axis=0), diff_threshold, out=buffer[1:, :])
+            if beam == 0:
+                mask[1:, :] = buffer[1:, :]
+            else:
+                mask[1:, :] |= buffer[1:, :]
+        set_flag("echodiff")
+
+    return flags
+
+
+def signed(values):
+    """
+    Counts stored as unsigned integers converted to int16, so that sums and differences do not wrap around.
+    """
+    if np.issubdtype(values.dtype, np.unsignedinteger):
+        return values.astype(np.int16)
+    return values
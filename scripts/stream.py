@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+import traceback
+
+STOP = object()  # Marks the end of the items of a queue
+
+
+class Stage:
+    """
+    Stage of a streaming pipeline: workers threads take the items of the input queue, apply function and put the
+    results in the bounded queue of the next stage, so that a slow stage blocks the stages before it (backpressure).
+    The function returns the item passed to the next stage, or None to drop the item. Items raising an exception
+    are logged and dropped.
+
+    Parameters:
+        name (str): stage name, used in the logs
+        function (function): function applied to each item
+        workers (int): number of items processed in parallel
+        queue_size (int): maximum number of items waiting for the stage
+    """
+    def __init__(self, name, function, workers=1, queue_size=2):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.input = queue.Queue(maxsize=max(1, queue_size))
+        self.output = False
+        self.failed = []
+        self.threads = []
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def start(self, log):
+        self.running = self.workers
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, args=(log,), name="{}-{}".format(self.name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self, log):
+        while True:
+            item = self.input.get()
+            if item is STOP:
+                break
+            log.set_context(file=describe(item), instrument=None)
+            try:
+                result = self.function(item)
+            except Exception:
+                log.warning("Stage {} failed for {}:\n{}".format(self.name, describe(item), traceback.format_exc()), indent=1)
+                with self.lock:
+                    self.failed.append(describe(item))
+                continue
+            if result is not None and self.output:
+                self.output.put(result)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            # The last worker of the stage forwards the end of the items to the next stage
+            if self.output:
+                self.output.put(STOP)
+        else:
+            self.input.put(STOP)
+
+
+def run_stages(items, stages, log):
+    """
+    Stream items through stages connected by bounded queues. Items are only taken from the iterable (e.g. a generator
+    listing new files) when the first stage has room for them.
+
+    Returns:
+        failed (dict): items that failed in each stage
+    """
+    for stage, following in zip(stages[:-1], stages[1:]):
+        stage.output = following.input
+    for stage in stages:
+        stage.start(log)
+    for item in items:
+        stages[0].input.put(item)
+    stages[0].input.put(STOP)
+    for stage in stages:
+        for thread in stage.threads:
+            thread.join()
+    return {stage.name: stage.failed for stage in stages if stage.failed}
+
+
+def describe(item):
+    if isinstance(item, dict) and "file" in item:
+        return item["file"]
+    return str(item)
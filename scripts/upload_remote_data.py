@@ -10,7 +10,11 @@ def upload_files(files):
     print("Attempting to upload {} files from {} to {}".format(len(files), data_folder, uri))
     for file in files:
         relative_path = os.path.relpath(file, data_folder)
-        process = Popen(["aws", "s3", "cp", file, "{}/{}".format(uri, relative_path)], stdout=PIPE)
+        if os.path.isdir(file): # Zarr stores, only the chunks and metadata changed since the last upload are sent
+            command = ["aws", "s3", "sync", file, "{}/{}".format(uri, relative_path), "--exclude", ".lock"]
+        else:
+            command = ["aws", "s3", "cp", file, "{}/{}".format(uri, relative_path)]
+        process = Popen(command, stdout=PIPE)
         while True:
             output = process.stdout.readline()
             if process.poll() is not None:
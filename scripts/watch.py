@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import signal
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class WatchState:
+    """
+    Counters of the runs of the watch mode, served by the health and metrics endpoint.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.started = time.time()
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.files = 0
+        self.failed_files = 0
+        self.last_failed_files = []
+        self.last_start = None
+        self.last_duration = None
+        self.last_success = None
+        self.last_error = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def begin(self):
+        with self.lock:
+            self.running = True
+            self.last_start = time.time()
+
+    def end(self, files=0, error=None, failed_files=()):
+        # A run with failed files is a failed run, its edited files are still counted
+        with self.lock:
+            self.running = False
+            self.runs += 1
+            self.last_duration = time.time() - self.last_start
+            self.files += files
+            self.failed_files += len(failed_files)
+            self.last_failed_files = list(failed_files)
+            if error is None and failed_files:
+                error = "{} files failed: {}".format(len(failed_files), ", ".join(failed_files))
+            if error is None:
+                self.last_success = time.time()
+                self.consecutive_failures = 0
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.last_error = error
+
+    def health(self):
+        """
+        Returns:
+            healthy (bool): =False if the last successful run is older than three intervals (or no run succeeded
+                within three intervals of the start)
+            status (dict): state of the watch mode
+        """
+        with self.lock:
+            now = time.time()
+            reference = self.last_success if self.last_success is not None else self.started
+            healthy = now - reference < 3 * self.interval + (self.last_duration or 0)
+            status = {"status": "ok" if healthy else "stale", "uptime": now - self.started, "runs": self.runs,
+                      "failures": self.failures, "consecutive_failures": self.consecutive_failures,
+                      "files": self.files, "failed_files": self.failed_files,
+                      "last_failed_files": self.last_failed_files, "running": self.running, "last_start": self.last_start,
+                      "last_duration": self.last_duration, "last_success": self.last_success,
+                      "last_error": self.last_error}
+        return healthy, status
+
+    def metrics(self):
+        healthy, status = self.health()
+        values = [("adcp_watch_up", 1 if healthy else 0, "gauge", "Last successful run within three intervals"),
+                  ("adcp_watch_uptime_seconds", status["uptime"], "gauge", "Time since the watch mode started"),
+                  ("adcp_watch_runs_total", status["runs"], "counter", "Completed runs"),
+                  ("adcp_watch_failures_total", status["failures"], "counter", "Failed runs"),
+                  ("adcp_watch_files_total", status["files"], "counter", "Files edited by the runs"),
+                  ("adcp_watch_failed_files_total", status["failed_files"], "counter", "Files that failed to process"),
+                  ("adcp_watch_running", int(status["running"]), "gauge", "A run is in progress"),
+                  ("adcp_watch_last_duration_seconds", status["last_duration"], "gauge", "Duration of the last run"),
+                  ("adcp_watch_last_success_timestamp_seconds", status["last_success"], "gauge", "End of the last successful run")]
+        lines = []
+        for name, value, kind, description in values:
+            if value is None:
+                continue
+            lines.extend(["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, kind),
+                          "{} {}".format(name, value)])
+        return "\n".join(lines) + "\n"
+
+
+def serve(state, port, host="0.0.0.0"):
+    """
+    Serve /health (JSON status, 503 when unhealthy) and /metrics (Prometheus text format) in a background thread.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/health"):
+                healthy, status = state.health()
+                body = json.dumps(status).encode("utf-8")
+                self.respond(200 if healthy else 503, "application/json", body)
+            elif self.path.startswith("/metrics"):
+                self.respond(200, "text/plain; version=0.0.4", state.metrics().encode("utf-8"))
+            else:
+                self.respond(404, "text/plain", b"Not found\n")
+
+        def respond(self, code, content_type, body):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    return server
+
+
+def watch(run, interval, port=False, runs=False):
+    """
+    Call run every interval seconds in the same process, so that the imports and FTP session stay warm, until
+    SIGINT/SIGTERM or after runs runs. A failed run is reported and the next run happens at the next interval.
+
+    The watch mode is checked against a local FTP server and a local S3 server with watch_check.py.
+
+    Parameters:
+        run (function): one run, returns the edited files and the failed files and raises an exception on failure
+        interval (float): time between the start of two runs [s]
+        port (int): port of the health and metrics endpoint, =False for no endpoint
+        runs (int): number of runs before returning, =False to run until stopped
+    Returns:
+        state (WatchState): counters of the runs
+    """
+    state = WatchState(interval)
+    stop = threading.Event()
+    server = serve(state, port) if port else False
+    if threading.current_thread() is threading.main_thread():
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(sig, lambda *args: stop.set())
+    print("Watching every {} s{}".format(interval, ", health on port {}".format(port) if port else ""))
+    while not stop.is_set():
+        state.begin()
+        try:
+            files, failed_files = run()
+            state.end(len(files), failed_files=failed_files)
+            if failed_files:
+                print("Run failed for {} files: {}".format(len(failed_files), ", ".join(failed_files)))
+        except Exception:
+            error = traceback.format_exc()
+            print("Run failed:\n{}".format(error))
+            state.end(error=error.strip().splitlines()[-1])
+        if runs and state.runs >= runs:
+            break
+        stop.wait(max(0., interval - state.last_duration))
+    if server:
+        server.shutdown()
+    return state
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib.request import urlopen
+from pd0 import ensemble_offsets
+from pd0_equivalence import synthetic_pd0
+
+SERVER_FILE = "data/ADCP_600/ADCP600_20240801T000000_0_0.LTA"
+BUCKET = "eawag-data"
+REMOTE = "https://github.com/eawag-surface-waters-research/lexplore-adcp.git"
+CREDENTIALS = {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_DEFAULT_REGION": "eu-central-1"}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def ftp_server(folder, port):
+    """
+    Local FTP server (pyftpdlib) serving folder, in a background thread.
+
+    Returns:
+        server (pyftpdlib.servers.FTPServer): server, stopped with close_all
+        logins (list): one entry per login, to count the connections opened by the pipeline
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+    logins = []
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("user", "password", folder, perm="elr")
+
+    class Handler(FTPHandler):
+        def on_login(self, username):
+            logins.append(username)
+    Handler.authorizer = authorizer
+    server = FTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True).start()
+    return server, logins
+
+
+def growing_file(file, ensembles, appended, cells):
+    """
+    Write the first ensembles of a synthetic PD0 file to file.
+
+    Returns:
+        grow (function): appends the next ensembles to file, as written by the instrument
+    """
+    synthetic_pd0(file, ensembles=ensembles + appended, cells=cells)
+    offsets, end = ensemble_offsets(file)
+    with open(file, "rb") as f:
+        data = f.read()
+    with open(file, "wb") as f:
+        f.write(data[:offsets[ensembles]])
+
+    def grow():
+        with open(file, "ab") as f:
+            f.write(data[offsets[ensembles]:])
+    return grow
+
+
+def watch_check(runs=2, interval=2., ensembles=40, cells=120, keep=False):
+    """
+    Run the watch mode of pipeline.py on a copy of the repository against a local FTP server (pyftpdlib) and a local
+    S3 server (moto), and check that:
+        - every run succeeds and /health reports the runs,
+        - the file growing on the FTP server between the runs is resumed,
+        - the FTP connections are kept between the runs (one listing and one transfer connection),
+        - the log of the runs is written to a single log file,
+        - the Level2 files are uploaded to the bucket.
+    Requires pyftpdlib, moto[server] and the aws CLI.
+
+    Returns:
+        passed (bool): =True if all the checks passed
+    """
+    from moto.server import ThreadedMotoServer
+    repo = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    folder = tempfile.mkdtemp()
+    checks = []
+    s3 = False
+    ftp = False
+    try:
+        copy = os.path.join(folder, "repo")
+        for name in ["scripts", "notes"]:
+            shutil.copytree(os.path.join(repo, name), os.path.join(copy, name), ignore=shutil.ignore_patterns("__pycache__"))
+        os.makedirs(os.path.join(copy, "logs"))
+        with open(os.path.join(copy, ".bucket"), "w") as f:
+            f.write("https://{}.s3.eu-central-1.amazonaws.com".format(BUCKET))
+        subprocess.run(["git", "init", "-q", copy], check=True)
+        subprocess.run(["git", "-C", copy, "remote", "add", "origin", REMOTE], check=True)
+
+        server_file = os.path.join(folder, "ftp", SERVER_FILE)
+        for location in ["data/ADCP_300", "data/ADCP_600", "data/ADCP_300_up"]:  # Listed by main
+            os.makedirs(os.path.join(folder, "ftp", location))
+        grow = growing_file(server_file, ensembles, 10, cells)
+        ftp_port, s3_port, health_port = free_port(), free_port(), free_port()
+        ftp, logins = ftp_server(os.path.join(folder, "ftp"), ftp_port)
+        with open(os.path.join(copy, "creds.json"), "w") as f:
+            json.dump({"ftp": "127.0.0.1", "port": ftp_port, "user": "user", "password": "password"}, f)
+        s3 = ThreadedMotoServer(ip_address="127.0.0.1", port=s3_port)
+        s3.start()
+        env = dict(os.environ, AWS_ENDPOINT_URL="http://127.0.0.1:{}".format(s3_port), **CREDENTIALS)
+        subprocess.run(["aws", "s3", "mb", "s3://{}".format(BUCKET)], env=env, check=True, stdout=subprocess.DEVNULL)
+
+        command = [sys.executable, os.path.join(copy, "scripts", "pipeline.py"), "--process", "--uploadfiles", "--logs",
+                   "--backend", "pd0", "--watch", str(interval), "--runs", str(runs), "--port", str(health_port)]
+        process = subprocess.Popen(command, cwd=copy, env=env)
+        local_file = os.path.join(copy, "data", "Level0", "RDI600", os.path.basename(SERVER_FILE))
+        status = {"runs": 0, "failures": 0}
+        grown = False
+        while process.poll() is None:
+            try:
+                with urlopen("http://127.0.0.1:{}/health".format(health_port), timeout=5) as response:
+                    status = json.loads(response.read())
+            except Exception as e:
+                status = json.loads(e.read()) if hasattr(e, "read") else status
+            if not grown and os.path.isfile(local_file) and os.path.getsize(local_file) == os.path.getsize(server_file):
+                grow()  # Downloaded by the first run, resumed by the next run
+                grown = True
+            time.sleep(0.05)
+
+        checks.append(("pipeline exit code 0", process.returncode == 0))
+        checks.append(("runs reported by /health ({})".format(status["runs"]), status["runs"] >= 1 and status["failures"] == 0))
+        log_files = [os.path.join(copy, "logs", f) for f in os.listdir(os.path.join(copy, "logs")) if f.endswith(".log")]
+        checks.append(("single log file ({})".format(len(log_files)), len(log_files) == 1))
+        log = "".join(open(f, encoding="utf-8").read() for f in log_files)
+        checks.append(("growing file resumed", grown and "Resuming file" in log and os.path.isfile(local_file) and
+                       os.path.getsize(local_file) == os.path.getsize(server_file)))
+        checks.append(("FTP connections kept between runs ({} logins)".format(len(logins)), len(logins) == 2))
+        listing = subprocess.run(["aws", "s3", "ls", "--recursive", "s3://{}".format(BUCKET)], env=env,
+                                 stdout=subprocess.PIPE, check=True).stdout.decode("utf-8")
+        checks.append(("Level2 files uploaded", "/data/Level2/RDI600/" in listing))
+    finally:
+        if ftp:
+            ftp.close_all()
+        if s3:
+            s3.stop()
+        if keep:
+            print("Files kept in {}".format(folder))
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+    for name, passed in checks:
+        print("{}: {}".format(name, "ok" if passed else "FAILED"))
+    return len(checks) > 0 and all(passed for name, passed in checks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the watch mode against local FTP and S3 servers")
+    parser.add_argument('--runs', '-rn', help="Number of runs of the watch mode", type=int, default=2)
+    parser.add_argument('--keep', '-k', help="Keep the temporary repository, data and logs", action='store_true')
+    args = vars(parser.parse_args())
+    sys.exit(0 if watch_check(runs=args["runs"], keep=args["keep"]) else 1)